@@ -1,7 +1,8 @@
 import varietybenchmark
 
-man = varietybenchmark.managers.VarietyBenchmark()
+if __name__ == '__main__':
+    man = varietybenchmark.managers.VarietyBenchmark()
 
-man.run_params['IO']['store'] = 'aurrera'
+    man.run_params['IO']['store'] = 'aurrera'
 
-man.run()
\ No newline at end of file
+    man.run()
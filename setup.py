@@ -3,7 +3,9 @@ from setuptools import find_packages, setup
 setup(
     name='varietybenchmark',
     packages=find_packages(),
-    version='0.1.4',
+    package_data={'varietybenchmark.benchmarks': ['baseline.json']},
+    entry_points={'console_scripts': ['varietybenchmark=varietybenchmark.cli.cli:main']},
+    version='0.1.60',
     description='Benchmarking of products in competitor shops',
     author='NetaMX Data Science Lab',
     license='',
@@ -0,0 +1,28 @@
+import json
+import logging
+
+from varietybenchmark.benchmarks import benchmarks
+
+
+def test_bench_stages_runs_the_pipeline(tmp_path):
+    stages = benchmarks.bench_stages(2_000, n_categories=20, path=str(tmp_path))
+
+    for stage in ['query_neta', 'dtypes', 'clean_neta', 'shape_neta', 'aurrera/query_scrape', 'aurrera/dtypes',
+                  'aurrera/preprocess', 'aurrera/shape_store', 'aurrera/match', 'aurrera/coincidences',
+                  'aurrera/price_gaps', 'aurrera/push_table', 'aurrera/write_local']:
+        assert stage in stages
+    assert stages['aurrera/query_scrape']['rows_out'] == 2_000
+    assert stages['aurrera/push_table']['rows_in'] == stages['aurrera/match']['rows_out']
+
+def test_sizes_without_baseline_are_reported(tmp_path, caplog):
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps({'sizes': {'10': {'aurrera/match': {'wall_s': 1.0}}}}))
+    results = {'sizes': {'10': {'aurrera/match': {'wall_s': 2.0}, 'aurrera/push_table': {'wall_s': 1.0}},
+                         '10000000': {'aurrera/match': {'wall_s': 1.0}}}}
+
+    with caplog.at_level(logging.WARNING):
+        regressions = benchmarks.compare_to_baseline(results, path=str(baseline))
+
+    assert regressions == [{'size': 10, 'stage': 'aurrera/match', 'baseline_s': 1.0, 'current_s': 2.0}]
+    warnings = ' '.join(r.getMessage() for r in caplog.records)
+    assert '10000000' in warnings and 'aurrera/push_table' in warnings
@@ -0,0 +1,136 @@
+import logging
+
+import pandas as pd
+import pytest
+from sqlalchemy import inspect
+
+from varietybenchmark.ion import ion
+
+
+@pytest.fixture
+def sqlite_backend(tmp_path):
+    """SQL backend on a SQLite file standing in for the rds 'data' database"""
+    previous = ion._backend
+    backend = ion.set_backend({'kind': 'sql', 'urls': {'data': f'sqlite:///{tmp_path}/data.db'}, 'schemas': []})
+    yield backend
+    backend.dispose()
+    ion._backend = previous
+
+def products(n_rows, start=0):
+    return pd.DataFrame({'ean': range(start, start + n_rows),
+                         'BA_Name': [f'product {i}' for i in range(start, start + n_rows)],
+                         'BA_Price': [i + 0.5 for i in range(start, start + n_rows)]})
+
+def read(table_name):
+    return pd.read_sql(f'select * from {table_name} order by ean', ion.get_engine('data'))
+
+def tables():
+    return inspect(ion.get_engine('data')).get_table_names()
+
+
+def test_creates_table(sqlite_backend):
+    df = products(25)
+    ion.bulk_replace_table(df, 'products_variety_ba', 'data', logging, batch_size=10)
+
+    assert tables() == ['products_variety_ba']
+    pd.testing.assert_frame_equal(read('products_variety_ba'), df)
+
+def test_replaces_existing_table(sqlite_backend):
+    ion.bulk_replace_table(products(25), 'products_variety_ba', 'data', logging, batch_size=10)
+    df = products(7, start=100)
+    ion.bulk_replace_table(df, 'products_variety_ba', 'data', logging, batch_size=10)
+
+    assert tables() == ['products_variety_ba']
+    pd.testing.assert_frame_equal(read('products_variety_ba'), df)
+
+def test_loads_staging_in_batches(sqlite_backend, caplog):
+    with caplog.at_level(logging.INFO):
+        ion.bulk_replace_table(products(25), 'products_variety_ba', 'data', logging, batch_size=10)
+
+    loaded = [r.getMessage() for r in caplog.records if 'loaded' in r.getMessage()]
+    assert loaded == ['products_variety_ba: loaded 10/25 rows', 'products_variety_ba: loaded 20/25 rows',
+                      'products_variety_ba: loaded 25/25 rows']
+    assert len(read('products_variety_ba')) == 25
+
+def test_failed_load_keeps_table(sqlite_backend, monkeypatch):
+    old = products(5)
+    ion.bulk_replace_table(old, 'products_variety_ba', 'data', logging)
+
+    to_sql = pd.DataFrame.to_sql
+    calls = []
+    def failing_to_sql(self, *args, **kwargs):
+        # Create the staging table and load the first batch, then fail
+        calls.append(len(self))
+        if len(calls) == 3:
+            raise RuntimeError('connection lost')
+        return to_sql(self, *args, **kwargs)
+    monkeypatch.setattr(pd.DataFrame, 'to_sql', failing_to_sql)
+
+    with pytest.raises(RuntimeError):
+        ion.bulk_replace_table(products(25, start=100), 'products_variety_ba', 'data', logging, batch_size=10)
+
+    assert tables() == ['products_variety_ba']
+    pd.testing.assert_frame_equal(read('products_variety_ba'), old)
+
+def test_empty_frame(sqlite_backend):
+    ion.bulk_replace_table(products(25), 'products_variety_ba', 'data', logging)
+    ion.bulk_replace_table(products(0), 'products_variety_ba', 'data', logging)
+
+    assert tables() == ['products_variety_ba']
+    assert read('products_variety_ba').empty
+
+def test_staging_name_is_unique(sqlite_backend):
+    # Staging table of another writer of the same table
+    other = products(3)
+    other.to_sql('products_variety_ba_staging', ion.get_engine('data'), index=False)
+
+    df = products(25)
+    ion.bulk_replace_table(df, 'products_variety_ba', 'data', logging, batch_size=10)
+
+    assert sorted(tables()) == ['products_variety_ba', 'products_variety_ba_staging']
+    pd.testing.assert_frame_equal(read('products_variety_ba'), df)
+    pd.testing.assert_frame_equal(read('products_variety_ba_staging'), other)
+
+def test_chunks_are_swapped_in_at_commit(sqlite_backend):
+    old = products(5)
+    ion.bulk_replace_table(old, 'products_variety_ba', 'data', logging)
+
+    writer = ion.TableChunkWriter('products_variety_ba', 'data', logging, batch_size=10)
+    writer.write(products(25, start=100))
+    # Readers still see the previous table
+    pd.testing.assert_frame_equal(read('products_variety_ba'), old)
+    writer.write(products(3, start=200))
+    writer.commit()
+
+    assert tables() == ['products_variety_ba']
+    pd.testing.assert_frame_equal(read('products_variety_ba'),
+                                  pd.concat([products(25, start=100), products(3, start=200)], ignore_index=True))
+
+def test_aborted_chunks_keep_table(sqlite_backend):
+    old = products(5)
+    ion.bulk_replace_table(old, 'products_variety_ba', 'data', logging)
+
+    writer = ion.TableChunkWriter('products_variety_ba', 'data', logging)
+    writer.write(products(25, start=100))
+    writer.abort()
+
+    assert tables() == ['products_variety_ba']
+    pd.testing.assert_frame_equal(read('products_variety_ba'), old)
+
+def test_chunks_without_engine(tmp_path):
+    # Snapshot backend: no engine, the table is pushed whole at commit
+    previous = ion._backend
+    backend = ion.set_backend({'kind': 'snapshot', 'path': str(tmp_path)})
+    try:
+        ion.push_table(products(5), 'products_variety_ba', 'data')
+        writer = ion.TableChunkWriter('products_variety_ba', 'data', logging)
+        writer.write(products(25, start=100))
+        writer.write(products(3, start=200))
+        assert len(backend.query('data', 'select * from products_variety_ba')) == 5
+        writer.commit()
+
+        assert len(backend.query('data', 'select * from products_variety_ba')) == 28
+        assert sorted(p.name for p in (tmp_path / 'data').iterdir()) == ['products_variety_ba.parquet']
+    finally:
+        backend.dispose()
+        ion._backend = previous
@@ -0,0 +1,41 @@
+import time
+import logging
+import threading
+
+from varietybenchmark.vis import vis
+
+
+def test_submit_charts_from_threads(tmp_path, monkeypatch):
+    pools = []
+
+    class Pool:
+        """Stand-in of ProcessPoolExecutor that counts the pools created"""
+        def __init__(self, *args, **kwargs):
+            # Starting processes takes time: other threads see no pool meanwhile
+            time.sleep(0.05)
+            pools.append(self)
+        def submit(self, fn, *args, **kwargs):
+            from concurrent.futures import Future
+            future = Future()
+            future.set_result(None)
+            return future
+        def shutdown(self):
+            pass
+
+    monkeypatch.setattr('concurrent.futures.ProcessPoolExecutor', Pool)
+    start = threading.Barrier(8)
+
+    def submit(i):
+        start.wait()
+        specs = [([f'c{j}'], [j], 'chart', str(tmp_path / f'{i}_{j}.jpg')) for j in range(50)]
+        vis.submit_charts(specs, logging)
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(pools) == 1
+    assert vis.wait_charts(logging) == (8 * 50, 0)
+    assert vis._pool is None and vis._futures == []
@@ -0,0 +1,39 @@
+import copy
+
+import pandas as pd
+
+from varietybenchmark.checkpoints import checkpoints
+from varietybenchmark.ion import ion
+from varietybenchmark.managers.managers import VarietyBenchmark
+
+
+def manager(tmp_path, run_id, **options):
+    man = VarietyBenchmark(copy.deepcopy(VarietyBenchmark.run_params))
+    man.checkpoint_store = checkpoints.CheckpointStore(run_id, path=str(tmp_path), **options)
+    return man
+
+
+def test_watermark_only_with_checkpoints(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(ion, 'data_watermark', lambda store=None, as_of=None: calls.append(store) or {'n_rows': '1'})
+
+    plain = manager(tmp_path, 'run1', enabled=False)
+    assert plain.query_inputs('aurrera')['data'] is None
+    assert calls == []
+
+    assert manager(tmp_path, 'run2', enabled=True).query_inputs('aurrera')['data'] == {'n_rows': '1'}
+    assert calls == ['aurrera']
+
+def test_save_is_never_resumed(tmp_path):
+    first = manager(tmp_path, 'run1', enabled=True)
+    first.checkpoint_stage('match', 'aurrera', lambda: pd.DataFrame({'ean': [1]}), ['inputs'])
+    first.checkpoint_stage('save', 'aurrera', lambda: None, ['inputs'], resumable=False)
+    first.checkpoint_store.write(first.run_params, first.version)
+
+    pushed = []
+    second = manager(tmp_path, 'run2', enabled=True, resume_from='run1')
+    match, _ = second.checkpoint_stage('match', 'aurrera', lambda: pushed.append('match'), ['inputs'])
+    second.checkpoint_stage('save', 'aurrera', lambda: pushed.append('save'), ['inputs'], resumable=False)
+
+    assert match['ean'].tolist() == [1]
+    assert pushed == ['save']
@@ -0,0 +1,32 @@
+import copy
+
+import pytest
+
+from varietybenchmark.cli import cli
+from varietybenchmark.managers.managers import VarietyBenchmark
+
+
+def test_whole_history_by_default():
+    # Every scraped row, as before snapshots were added. 'latest' is opt-in
+    assert cli.build_parser().parse_args(['run']).snapshot == 'all'
+    assert VarietyBenchmark.run_params['IO']['snapshot'] is None
+    assert cli.build_parser().parse_args(['run', '--snapshot', 'latest']).snapshot == 'latest'
+
+def test_sql_backend_urls(tmp_path, monkeypatch):
+    # The log file is written in the working directory
+    monkeypatch.chdir(tmp_path)
+    # The command sets the parameters of the class
+    monkeypatch.setattr(VarietyBenchmark, 'run_params', copy.deepcopy(VarietyBenchmark.run_params))
+    runs = []
+    monkeypatch.setattr(VarietyBenchmark, 'run', lambda self: runs.append(self.run_params['IO']['backend']))
+
+    assert cli.main(['run', '--backend', 'sql', '--backend-url', 'data=sqlite:///data.db',
+                     '--backend-url', 'prod=sqlite:///prod.db']) == 0
+    assert runs[0]['kind'] == 'sql'
+    assert runs[0]['urls'] == {'data': 'sqlite:///data.db', 'prod': 'sqlite:///prod.db'}
+
+def test_sql_backend_needs_urls():
+    with pytest.raises(SystemExit):
+        cli.main(['run', '--backend', 'sql'])
+    with pytest.raises(SystemExit):
+        cli.main(['run', '--backend', 'sql', '--backend-url', 'sqlite:///data.db'])
@@ -0,0 +1,39 @@
+import os
+import logging
+
+import pandas as pd
+import pytest
+
+from varietybenchmark.history import history
+from varietybenchmark.ion import ion
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in tmp_path, where ./data/history is written, with a SQLite 'data' database"""
+    monkeypatch.chdir(tmp_path)
+    previous = ion._backend
+    backend = ion.set_backend({'kind': 'sql', 'urls': {'data': f'sqlite:///{tmp_path}/data.db'}, 'schemas': []})
+    yield tmp_path
+    backend.dispose()
+    ion._backend = previous
+
+def chedraui():
+    return pd.DataFrame({'CH_upc': ['7501', '7502'], 'CH_product_name': ['leche', 'pan'],
+                         'CH_input_category': ['lacteos', 'panaderia'], 'CH_normal_price': [12.5, 30.0]})
+
+
+def test_history_after_push(workdir):
+    ion.save_chedraui(chedraui(), logging, run_ts='2022-03-28T14:43:30')
+
+    assert len(pd.read_sql('select * from products_variety_chedraui', ion.get_engine('data'))) == 2
+    assert len(history.read('assortment', store='chedraui')) == 2
+
+def test_no_history_when_push_fails(workdir, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('connection lost')
+    monkeypatch.setattr(ion, 'bulk_replace_table', fail)
+
+    with pytest.raises(RuntimeError):
+        ion.save_chedraui(chedraui(), logging, run_ts='2022-03-28T14:43:30')
+    assert not os.path.exists('./data/history')
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from varietybenchmark.ion import ion
+
+
+def chunks():
+    first = pd.DataFrame({'BA_ean': [7501, 7502, 7503], 'BA_product_name': ['leche', 'pan', 'huevo'],
+                          'BA_category': pd.Categorical(['lacteos', 'panaderia', 'lacteos']),
+                          'BA_subcategory': ['leches', None, 'huevos'],
+                          'BA_normal_price': np.array([12.99, 30.5, 45.0], dtype=np.float32),
+                          'is_in': ['ambos', 'BA', 'BA']})
+    second = pd.DataFrame({'BA_ean': [7504], 'BA_product_name': ['queso'],
+                           'BA_category': pd.Categorical(['lacteos']), 'BA_subcategory': ['quesos'],
+                           'BA_normal_price': np.array([80.0], dtype=np.float32), 'is_in': ['ambos']})
+    # Neta products without a store category nor subcategory
+    neta_only = pd.DataFrame({'BA_ean': [7505], 'BA_category': [np.nan], 'is_in': ['neta']})
+    return [first, second, neta_only]
+
+def sort(df):
+    return df.sort_values('BA_ean', ignore_index=True)
+
+
+def test_chunks_have_the_layout_of_save_local(tmp_path):
+    writer = ion.LocalChunkWriter(str(tmp_path / 'streamed'), 'aurrera', 'BA_category')
+    for chunk in chunks():
+        writer.write(chunk)
+    writer.close()
+    ion.save_local(pd.concat(chunks(), ignore_index=True), str(tmp_path / 'whole'), 'aurrera', 'BA_category',
+                   'parquet', False)
+
+    streamed, whole = ion.read_table(str(tmp_path / 'streamed')), ion.read_table(str(tmp_path / 'whole'))
+    assert writer.rows == 5
+    assert sorted(p.name for p in (tmp_path / 'streamed').iterdir()) == ['store=aurrera']
+    assert (sorted(p.name for p in (tmp_path / 'streamed' / 'store=aurrera').iterdir())
+            == sorted(p.name for p in (tmp_path / 'whole' / 'store=aurrera').iterdir()))
+    pd.testing.assert_frame_equal(sort(streamed)[whole.columns].astype(object), sort(whole).astype(object))
+
+def test_chunks_replace_the_previous_run_of_the_store(tmp_path):
+    for run in range(2):
+        writer = ion.LocalChunkWriter(str(tmp_path / 'streamed'), 'aurrera', 'BA_category')
+        for chunk in chunks():
+            writer.write(chunk)
+        writer.close()
+
+    assert len(ion.read_table(str(tmp_path / 'streamed'))) == 5
@@ -0,0 +1,21 @@
+import numpy as np
+
+from varietybenchmark.metrics import metrics
+
+
+def test_sparse_integer_groups_are_factorized():
+    # Ean sized ids: a sum per id up to the largest would need terabytes
+    groups = np.array([7501055300075, 7501055300075, 3], dtype=np.int64)
+    codes, labels, present = metrics._group_codes(groups, 3)
+
+    assert codes.tolist() == [1, 1, 0]
+    assert labels.tolist() == [3, 7501055300075]
+    assert present.all()
+
+    result = metrics.mae(np.array([1., 2., 3.]), np.array([2., 2., 5.]), groups=groups)
+    assert result.to_dict() == {3: 2.0, 7501055300075: 0.5}
+
+def test_dense_integer_groups_are_used_as_codes():
+    result = metrics.evaluate(np.array([1., 2., 3.]), np.array([2., 2., 5.]), groups=np.array([0, 2, 2]))
+    assert result.index.tolist() == [0, 2]
+    assert result['n'].tolist() == [1, 2]
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import NearestNeighbors
+
+from varietybenchmark.models.models import NearestNeighborClassifier
+
+
+@pytest.mark.parametrize('offset', [0, 1e2, 1e4])
+def test_brute_force_with_offset_features(offset):
+    rng = np.random.default_rng(0)
+    # float32 values, so the reference sees the same inputs
+    X = (rng.normal(size=(2000, 32)) + offset).astype(np.float32).astype(np.float64)
+    Q = (rng.normal(size=(300, 32)) + offset).astype(np.float32).astype(np.float64)
+    y = rng.integers(0, 5, len(X))
+
+    dist, ind = NearestNeighborClassifier(algorithm='brute').fit(X, y).kneighbors(Q, n_neighbors=5)
+    ref_dist, ref_ind = NearestNeighbors(n_neighbors=5, algorithm='brute').fit(X).kneighbors(Q)
+
+    np.testing.assert_array_equal(ind, ref_ind)
+    np.testing.assert_allclose(dist, ref_dist, rtol=1e-4)
+
+@pytest.mark.parametrize('algorithm', ['brute', 'kd_tree'])
+@pytest.mark.parametrize('n_jobs', [None, 1, 2, -1])
+def test_n_jobs(algorithm, n_jobs):
+    rng = np.random.default_rng(1)
+    X, Q = rng.normal(size=(500, 8)), rng.normal(size=(200, 8))
+    y = rng.integers(0, 3, len(X))
+
+    expected = NearestNeighborClassifier(n_neighbors=3, algorithm=algorithm).fit(X, y).predict(Q)
+    model = NearestNeighborClassifier(n_neighbors=3, algorithm=algorithm, max_chunk_elements=5_000, n_jobs=n_jobs)
+    np.testing.assert_array_equal(model.fit(X, y).predict(Q), expected)
+
+def test_chunks_share_the_memory_budget(monkeypatch):
+    rng = np.random.default_rng(2)
+    X, Q = rng.normal(size=(100, 4)), rng.normal(size=(1000, 4))
+    model = NearestNeighborClassifier(algorithm='brute', max_chunk_elements=10_000, n_jobs=4).fit(X, rng.integers(0, 2, 100))
+
+    chunks = []
+    chunk_kneighbors = model._chunk_kneighbors
+    monkeypatch.setattr(model, '_chunk_kneighbors', lambda X, k: chunks.append(len(X)) or chunk_kneighbors(X, k))
+    model.kneighbors(Q)
+
+    # 4 threads x 25 rows x 100 training rows
+    assert max(chunks) * len(X) * 4 <= 10_000
+    assert sum(chunks) == len(Q)
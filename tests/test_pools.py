@@ -0,0 +1,142 @@
+import copy
+import sys
+import time
+import types
+import logging
+import threading
+
+import pandas as pd
+import pytest
+from sqlalchemy import event, text
+
+from varietybenchmark.backends import backends
+from varietybenchmark.ion import ion
+from varietybenchmark.managers.managers import VarietyBenchmark
+
+
+@pytest.fixture
+def rds_url(tmp_path, monkeypatch):
+    """RDS_DATA_URL pointing to a SQLite file, without reading the .env file"""
+    monkeypatch.setattr(backends.RDSBackend, '_load_env', lambda self: None)
+    monkeypatch.setenv('RDS_DATA_URL', f'sqlite:///{tmp_path}/data.db')
+    monkeypatch.delenv('RDS_PROD_URL', raising=False)
+    previous = ion._backend
+    yield
+    ion._backend = previous
+
+def closed_connections(engine):
+    closed = []
+    event.listen(engine, 'close', lambda dbapi_connection, connection_record: closed.append(1))
+    return closed
+
+
+def test_queries_and_pushes_share_one_pool(rds_url):
+    backend = backends.RDSBackend()
+    backend.push_table(pd.DataFrame({'ean': [1, 2, 3]}), 'products', 'data')
+    for _ in range(3):
+        assert len(backend.query('data', 'select * from products')) == 3
+    backend.push_table(pd.DataFrame({'ean': [4]}), 'products', 'data', if_exists='append')
+
+    stats = backend.pool_stats()['data']
+    assert list(backend._engines) == ['data']
+    assert stats['connections_opened'] == 1
+    assert stats['checkouts'] >= 5
+    assert stats['queries'] >= 5
+    backend.dispose()
+
+def test_checkout_wait(rds_url):
+    backend = backends.RDSBackend({'pool_size': 1, 'max_overflow': 0, 'pool_timeout': 5})
+    engine = backend.engine('data')
+    held = threading.Event()
+
+    def hold():
+        with engine.connect() as conn:
+            conn.execute(text('select 1'))
+            held.set()
+            time.sleep(0.3)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait()
+    backend.query('data', 'select 1 as one')
+    thread.join()
+
+    stats = backend.pool_stats()['data']
+    assert stats['checkouts'] == 2
+    assert stats['connections_opened'] == 1
+    assert stats['max_checkout_wait_s'] >= 0.2
+    backend.dispose()
+
+def test_connections_disposed_at_run_end(rds_url):
+    man = VarietyBenchmark(copy.deepcopy(VarietyBenchmark.run_params))
+    man.run_params['log'] = {}
+    with man.connect_run() as backend:
+        backend.query('data', 'select 1 as one')
+        engine = backend.engine('data')
+        closed = closed_connections(engine)
+        assert engine.pool.checkedin() == 1
+
+    assert closed == [1]
+    assert backend._engines == {}
+    assert man.run_params['log']['connections']['data']['checkouts'] == 1
+
+def test_connections_disposed_when_run_fails(rds_url):
+    with pytest.raises(RuntimeError):
+        with ion.connections({'kind': 'rds'}) as backend:
+            backend.query('data', 'select 1 as one')
+            closed = closed_connections(backend.engine('data'))
+            raise RuntimeError('store failed')
+
+    assert closed == [1]
+    assert backend._engines == {}
+
+def test_warns_without_url(rds_url, monkeypatch, caplog):
+    monkeypatch.delenv('RDS_DATA_URL')
+    netadata_ion = types.SimpleNamespace(query_rds=lambda db, sql, cache: pd.DataFrame({'one': [1]}),
+                                         push_table=lambda df, table_name, db, if_exists: None)
+    monkeypatch.setitem(sys.modules, 'netadata', types.SimpleNamespace(ion=netadata_ion))
+    monkeypatch.setitem(sys.modules, 'netadata.ion', netadata_ion)
+
+    backend = backends.RDSBackend()
+    with caplog.at_level(logging.WARNING):
+        backend.query('data', 'select 1 as one')
+        backend.push_table(pd.DataFrame({'one': [1]}), 'products', 'data')
+
+    warnings = [r.getMessage() for r in caplog.records if r.levelno == logging.WARNING]
+    assert len(warnings) == 1
+    assert 'RDS_DATA_URL' in warnings[0]
+    assert backend.pool_stats() == {}
+
+def test_saves_without_url_go_through_netadata(rds_url, monkeypatch, caplog):
+    monkeypatch.delenv('RDS_DATA_URL')
+    pushed = []
+    netadata_ion = types.SimpleNamespace(push_table=lambda df, table_name, db, if_exists: pushed.append(
+        (table_name, if_exists, len(df))))
+    monkeypatch.setitem(sys.modules, 'netadata', types.SimpleNamespace(ion=netadata_ion))
+    monkeypatch.setitem(sys.modules, 'netadata.ion', netadata_ion)
+
+    ion.set_backend({'kind': 'rds'})
+    with caplog.at_level(logging.WARNING):
+        assert ion.get_engine('data') is None
+        ion.bulk_replace_table(pd.DataFrame({'ean': [1, 2]}), 'products_variety_ba', 'data', logging)
+
+    assert pushed == [('products_variety_ba', 'replace', 2)]
+    assert len([r for r in caplog.records if r.levelno == logging.WARNING]) == 1
+
+def test_upsert_without_url_goes_through_netadata(rds_url, monkeypatch):
+    # Incremental runs upsert their delta
+    monkeypatch.delenv('RDS_DATA_URL')
+    current = pd.DataFrame({'ean': ['1', '2', None], 'name': ['a', 'b', 'neta']})
+    pushed = []
+    netadata_ion = types.SimpleNamespace(query_rds=lambda db, sql, cache: current.copy(),
+                                         push_table=lambda df, table_name, db, if_exists: pushed.append(
+                                             (table_name, if_exists, df)))
+    monkeypatch.setitem(sys.modules, 'netadata', types.SimpleNamespace(ion=netadata_ion))
+    monkeypatch.setitem(sys.modules, 'netadata.ion', netadata_ion)
+
+    ion.set_backend({'kind': 'rds'})
+    ion.upsert_table(pd.DataFrame({'ean': ['2'], 'name': ['b2']}), 'products_variety_ba', 'data', ['ean'], logging)
+
+    [(table_name, if_exists, df)] = pushed
+    assert (table_name, if_exists) == ('products_variety_ba', 'replace')
+    assert df['name'].tolist() == ['a', 'neta', 'b2']
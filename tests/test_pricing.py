@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from varietybenchmark.pricing import pricing
+
+
+@pytest.mark.parametrize('n_groups', [1, 5, 5_000])
+def test_grouped_quantiles_match_np_percentile(n_groups):
+    # Few large groups sort each group in place, many small ones argsort the values
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=20_000)
+    values[rng.random(len(values)) < 0.1] = np.nan
+    codes = rng.integers(0, n_groups, len(values))
+    qs = [0, 10, 50, 90, 100]
+
+    result = pricing.grouped_quantiles(values, codes, n_groups + 1, qs)
+
+    for group in range(n_groups):
+        in_group = values[(codes == group) & ~np.isnan(values)]
+        expected = np.percentile(in_group, qs) if len(in_group) else np.full(len(qs), np.nan)
+        np.testing.assert_allclose(result[group], expected)
+    # The last group is empty
+    assert np.isnan(result[n_groups]).all()
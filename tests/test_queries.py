@@ -0,0 +1,82 @@
+import logging
+
+import pandas as pd
+import pytest
+
+from varietybenchmark.backends import backends
+from varietybenchmark.ion import ion
+
+
+@pytest.fixture
+def scrape(tmp_path):
+    """SQLite stand-in of dataprocessing.benchmark_aurrera with three scraping days"""
+    previous = ion._backend
+    backend = ion.set_backend({'kind': 'sql', 'urls': {'data': f'sqlite:///{tmp_path}/data.db'},
+                               'schemas': ['dataprocessing']})
+    rows = pd.DataFrame({'ean': ['1', '1', '2'], 'product_id': ['a', 'a', 'b'], 'product_name': ['x', 'x', 'y'],
+                         'category': 'c', 'subcategory': 's', 'normal_price': [10.0, 11.0, 12.0],
+                         'current_price': [10.0, 11.0, 12.0], 'url': 'u',
+                         'scraping_datetime': ['2022-03-01 00:00:00', '2022-03-02 00:00:00', '2022-03-03 00:00:00']})
+    rows.to_sql('benchmark_aurrera', backend.engine('data'), schema='dataprocessing', index=False)
+    yield backend
+    backend.dispose()
+    ion._backend = previous
+
+
+@pytest.mark.parametrize('snapshot', ['latest', 'batch'])
+def test_as_of_is_a_bind_parameter(snapshot):
+    as_of = "2022-03-02' or '1'='1"
+    query, params = ion.scraper_query('aurrera', snapshot=snapshot, as_of=as_of)
+
+    assert as_of not in query
+    assert ':as_of' in query
+    assert params == {'as_of': as_of}
+
+def test_since_is_a_bind_parameter():
+    for store in ('aurrera', 'chedraui'):
+        query, params = ion.scraper_query(store, since='2022-03-02 00:00:00')
+        assert ':since' in query and '2022-03-02' not in query
+        assert params == {'since': '2022-03-02 00:00:00'}
+
+def test_as_of_filters_rows(scrape):
+    latest = ion.query_scraped_store('aurrera', logging, snapshot='latest', as_of='2022-03-02 00:00:00')
+    assert latest[['ean', 'normal_price']].values.tolist() == [['1', 11.0]]
+
+    since = ion.query_scraped_store('aurrera', logging, since='2022-03-01 00:00:00')
+    assert since['scraping_datetime'].tolist() == ['2022-03-03 00:00:00', '2022-03-02 00:00:00']
+
+def test_as_of_with_quotes_does_not_change_the_query(scrape):
+    rows = ion.query_scraped_store('aurrera', logging, snapshot='latest', as_of="2022-03-02' or '1'='1")
+    # Compared as a string, not injected into the query (which would return both products)
+    assert rows['ean'].tolist() == ['1']
+
+def test_chunks_bind_as_of(scrape):
+    chunks = list(ion.query_scraped_store_chunks('aurrera', logging, 1, snapshot='latest', as_of='2022-03-01 00:00:00'))
+    assert pd.concat(chunks)['normal_price'].tolist() == [10.0]
+
+def test_literal_sql_escapes_quotes():
+    sql = backends._literal_sql('select * from t where d <= :as_of', {'as_of': "x' or '1'='1"})
+    assert sql == "select * from t where d <= 'x'' or ''1''=''1'"
+
+def test_latest_is_one_row_per_ean(scrape):
+    # Same ean under a new product_id
+    more = pd.DataFrame({'ean': ['2'], 'product_id': ['b2'], 'product_name': ['y'], 'category': 'c',
+                         'subcategory': 's', 'normal_price': [13.0], 'current_price': [13.0], 'url': 'u',
+                         'scraping_datetime': ['2022-03-04 00:00:00']})
+    more.to_sql('benchmark_aurrera', scrape.engine('data'), schema='dataprocessing', index=False, if_exists='append')
+
+    latest = ion.query_scraped_store('aurrera', logging, snapshot='latest')
+    assert sorted(latest[['ean', 'normal_price']].values.tolist()) == [['1', 11.0], ['2', 13.0]]
+
+def test_watermark_follows_the_data(scrape):
+    before = ion.data_watermark('aurrera')
+    assert before == {'max_scraping_datetime': '2022-03-03 00:00:00', 'n_rows': '3'}
+    assert ion.data_watermark('aurrera', as_of='2022-03-02 00:00:00')['n_rows'] == '2'
+
+    more = pd.DataFrame({'ean': ['3'], 'product_id': ['c'], 'product_name': ['z'], 'category': 'c',
+                         'subcategory': 's', 'normal_price': [1.0], 'current_price': [1.0], 'url': 'u',
+                         'scraping_datetime': ['2022-03-04 00:00:00']})
+    more.to_sql('benchmark_aurrera', scrape.engine('data'), schema='dataprocessing', index=False, if_exists='append')
+    assert ion.data_watermark('aurrera') != before
+    # Rows scraped after as_of do not change a reproducible run
+    assert ion.data_watermark('aurrera', as_of='2022-03-02 00:00:00')['n_rows'] == '2'
@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+
+from varietybenchmark.ion import ion
+
+
+def test_snapshot_round_trip(tmp_path):
+    df = pd.DataFrame({'BA_ean': pd.array([7501, 7502, None], dtype='Int64'),
+                       'BA_product_name': ['leche', 'pan', None],
+                       'BA_category': pd.Categorical(['lacteos', 'panaderia', 'lacteos']),
+                       'BA_normal_price': np.array([12.99, 30.5, np.nan], dtype=np.float32),
+                       'BA_display_order': [1, 1, 2],
+                       'BA_scraping_datetime': pd.to_datetime(['2022-03-01', '2022-03-02', None]),
+                       'is_in': ['ambos', 'BA', 'neta']},
+                      index=[10, 3, 7])
+
+    assert not ion.has_snapshot('aurrera', tmp_path)
+    assert ion.load_snapshot('aurrera', tmp_path) is None
+
+    ion.save_snapshot('aurrera', df, tmp_path)
+    assert ion.has_snapshot('aurrera', tmp_path)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['aurrera_snapshot.parquet']
+    pd.testing.assert_frame_equal(ion.load_snapshot('aurrera', tmp_path), df)
@@ -0,0 +1,34 @@
+import logging
+
+import pandas as pd
+import pytest
+
+from varietybenchmark.ion import ion
+
+
+@pytest.fixture(params=['sql', 'snapshot'])
+def backend(request, tmp_path):
+    """SQLite 'data' database (upsert in SQL), or parquet files (upsert in pandas)"""
+    previous = ion._backend
+    if request.param == 'sql':
+        backend = ion.set_backend({'kind': 'sql', 'urls': {'data': f'sqlite:///{tmp_path}/data.db'}, 'schemas': []})
+    else:
+        backend = ion.set_backend({'kind': 'snapshot', 'path': str(tmp_path)})
+    yield backend
+    backend.dispose()
+    ion._backend = previous
+
+def read(table_name):
+    return ion.get_backend().query('data', f'select * from {table_name}').sort_values('name', ignore_index=True)
+
+
+def test_missing_keys_replace_nothing(backend):
+    # Store only products have no Gtin, Neta only products no ean
+    current = pd.DataFrame({'ean': ['1', '2', None, None], 'gtin': ['1', None, '3', None],
+                            'name': ['both', 'store', 'neta', 'store no ean']})
+    ion.push_table(current, 'products', 'data', if_exists='replace')
+
+    delta = pd.DataFrame({'ean': ['2', '5'], 'gtin': [None, None], 'name': ['store new', 'other']})
+    ion.upsert_table(delta, 'products', 'data', ['ean', 'gtin'], logging)
+
+    assert read('products')['name'].tolist() == ['both', 'neta', 'other', 'store new', 'store no ean']
@@ -1,2 +1,12 @@
-from .ion import ion as ion
-from .managers import managers as managers
\ No newline at end of file
+import importlib
+
+# Modules imported on first use, so `import varietybenchmark` and the command line start fast
+_lazy_modules = {'ion': '.ion.ion', 'managers': '.managers.managers'}
+
+
+def __getattr__(name):
+    if name in _lazy_modules:
+        module = importlib.import_module(_lazy_modules[name], __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,6 @@
+import sys
+from .cli.cli import main
+
+# Guarded: charts are rendered in spawned processes, which import the main module
+if __name__ == '__main__':
+    sys.exit(main())
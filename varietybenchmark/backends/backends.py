@@ -0,0 +1,349 @@
+import os
+import time
+import atexit
+import logging
+import shutil
+import tempfile
+import threading
+import pandas as pd
+from ..config import BACKENDS
+
+# Tables read by the queries of ion, by logical database. Copied by ion.export_snapshot
+snapshot_tables = {
+    'data': ['dataprocessing.benchmark_aurrera', 'dataprocessing.benchmark_chedraui'],
+    'prod': ['netamx.Product', 'product_category_mapping', 'category'],
+}
+
+
+# Settings of the connection pool of each database: connections kept open, extra
+# connections allowed under load, seconds to wait for a free connection, test
+# connections before use, and seconds after which a connection is replaced
+pool_defaults = {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 30,
+                 'pool_pre_ping': True, 'pool_recycle': 1800}
+
+
+class PoolStats:
+    """Checkout wait and query time of the engines of a backend, per logical database"""
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _add(self, db, **values):
+        with self._lock:
+            stats = self._stats.setdefault(db, {'checkouts': 0, 'checkout_wait_s': 0.0, 'max_checkout_wait_s': 0.0,
+                                                'connections_opened': 0, 'queries': 0, 'query_s': 0.0})
+            for key, value in values.items():
+                if key.startswith('max_'):
+                    stats[key] = max(stats[key], value)
+                else:
+                    stats[key] += value
+
+    def checkout(self, db, seconds):
+        self._add(db, checkouts=1, checkout_wait_s=seconds, max_checkout_wait_s=seconds)
+
+    def connection_opened(self, db):
+        self._add(db, connections_opened=1)
+
+    def query(self, db, seconds):
+        self._add(db, queries=1, query_s=seconds)
+
+    def summary(self):
+        """Stats per database, times rounded to 4 decimals"""
+        with self._lock:
+            return {db: {k: round(v, 4) if isinstance(v, float) else v for k, v in stats.items()}
+                    for db, stats in self._stats.items()}
+
+
+def _timed_pool(poolclass, stats, db):
+    """Subclass of poolclass recording the time to get a connection from the pool
+    (waiting for a free one or opening a new one)"""
+
+    class TimedPool(poolclass):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                stats.checkout(db, time.perf_counter() - start)
+
+    return TimedPool
+
+
+def _literal_sql(sql, params):
+    """Query text with its bind parameters rendered as escaped literals, for netadata,
+    which only takes the text of a query"""
+    if not params:
+        return sql
+    from sqlalchemy import text
+    return str(text(sql).bindparams(**params).compile(compile_kwargs={'literal_binds': True}))
+
+
+class RDSBackend:
+    """Remote databases in rds. Each logical database gets one pooled SQLAlchemy
+    engine, built from the environment variable RDS_<DB>_URL (e.g. RDS_DATA_URL)
+    and shared by every query and push of the backend. Without the url, queries 
+    and pushes go through netadata. Credentials are loaded from the .env file
+    on first use, not on import.
+
+    :param pool: settings of the connection pools, see pool_defaults, defaults to None
+    :type pool: dict, optional
+    """
+
+    name = 'rds'
+
+    def __init__(self, pool=None):
+        self._engines = {}
+        self._env_loaded = False
+        self._lock = threading.Lock()
+        self.pool = dict(pool_defaults, **(pool or {}))
+        self.stats = PoolStats()
+        self._unpooled = set()
+
+    def _load_env(self):
+        if not self._env_loaded:
+            from dotenv import find_dotenv, load_dotenv
+            load_dotenv(find_dotenv())
+            self._env_loaded = True
+
+    def _url(self, db):
+        self._load_env()
+        return os.environ.get(f'RDS_{db.upper()}_URL')
+
+    def _warn_unpooled(self, db):
+        """Warn once per database that it goes through netadata, outside the pool"""
+        with self._lock:
+            if db in self._unpooled:
+                return
+            self._unpooled.add(db)
+        logging.warning(f'RDS_{db.upper()}_URL is not set: {db} is read and written through netadata, '
+                        f'without the connection pool and missing from the pool stats. Tables are '
+                        f'replaced in place, without a staging table.')
+
+    def query(self, db, sql, params=None):
+        if self._url(db) is None:
+            self._warn_unpooled(db)
+            from netadata.ion import query_rds
+            return query_rds(db, _literal_sql(sql, params), False)
+
+        from sqlalchemy import text
+        with self.query_engine(db).connect() as conn:
+            return pd.read_sql(text(sql), conn, params=params)
+
+    def push_table(self, df, table_name, db, if_exists='fail'):
+        if self._url(db) is None:
+            self._warn_unpooled(db)
+            from netadata.ion import push_table
+            push_table(df, table_name, db, if_exists = if_exists)
+            return
+        df.to_sql(table_name, self.engine(db), if_exists=if_exists, index=False)
+
+    def engine(self, db):
+        """Pooled engine of db, None without its url: tables are then pushed whole
+        through netadata, see ion.bulk_replace_table"""
+        url = self._url(db)
+        if url is None:
+            self._warn_unpooled(db)
+            return None
+        with self._lock:
+            if db not in self._engines:
+                self._engines[db] = self._pooled_engine(url, db)
+            return self._engines[db]
+
+    def query_engine(self, db):
+        return self.engine(db)
+
+    def _pooled_engine(self, url, db, **kwargs):
+        """Engine of url with the pool settings of the backend, timed in self.stats"""
+        from sqlalchemy import create_engine, event
+        from sqlalchemy.engine import make_url
+        from sqlalchemy.pool import QueuePool
+
+        url = make_url(url)
+        poolclass = kwargs.pop('poolclass', QueuePool)
+        options = dict(self.pool)
+        if not issubclass(poolclass, QueuePool):
+            # e.g. StaticPool: a single connection, without size or timeout
+            options = {k: v for k, v in options.items() if k in ('pool_pre_ping', 'pool_recycle')}
+        engine = create_engine(url, poolclass=_timed_pool(poolclass, self.stats, db), **options, **kwargs)
+
+        @event.listens_for(engine, 'connect')
+        def count_connection(dbapi_connection, connection_record):
+            self.stats.connection_opened(db)
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def start_query(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def end_query(conn, cursor, statement, parameters, context, executemany):
+            self.stats.query(db, time.perf_counter() - conn.info['query_start'].pop())
+
+        return engine
+
+    def pool_stats(self):
+        """Checkout wait and query time per logical database, see PoolStats"""
+        return self.stats.summary()
+
+    def dispose(self):
+        """Close the connections of every engine of the backend"""
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+
+
+class SQLBackend(RDSBackend):
+    """Databases reached with SQLAlchemy urls, e.g. local SQLite files, DuckDB
+    (with duckdb_engine) or a Postgres stand-in.
+
+    :param urls: url of each logical database, e.g. {'data': 'sqlite:///data/offline/data.db'}
+    :type urls: dict
+    :param schemas: schemas used by the queries. In SQLite they are attached as <schema>.db 
+        next to the database file, defaults to None (the schemas in snapshot_tables)
+    :type schemas: list, optional
+    :param pool: settings of the connection pools, see pool_defaults, defaults to None
+    :type pool: dict, optional
+    """
+
+    def __init__(self, urls, schemas=None, pool=None):
+        super().__init__(pool)
+        self.urls = dict(urls)
+        self.name = f'sql:{sorted(self.urls.items())}'
+        if schemas is None:
+            schemas = {t.split('.')[0] for tables in snapshot_tables.values() for t in tables if '.' in t}
+        self.schemas = sorted(schemas)
+
+    def query(self, db, sql, params=None):
+        from sqlalchemy import text
+        with self.query_engine(db).connect() as conn:
+            return pd.read_sql(text(sql), conn, params=params)
+
+    def push_table(self, df, table_name, db, if_exists='fail'):
+        df.to_sql(table_name, self.engine(db), if_exists=if_exists, index=False)
+
+    def engine(self, db):
+        with self._lock:
+            if db not in self._engines:
+                if db not in self.urls:
+                    raise KeyError(f'No url for database {db}. Add it to run_params["IO"]["backend"]["urls"].')
+                self._engines[db] = self._create_engine(self.urls[db], db)
+            return self._engines[db]
+
+    def _create_engine(self, url, db):
+        from sqlalchemy import event
+        from sqlalchemy.engine import make_url
+        from sqlalchemy.pool import StaticPool
+
+        url = make_url(url)
+        if url.get_backend_name() != 'sqlite':
+            return self._pooled_engine(url, db)
+
+        in_memory = url.database in (None, '', ':memory:')
+        if in_memory:
+            # An in-memory database lives in its connection: share a single one
+            engine = self._pooled_engine(url, db, poolclass=StaticPool, connect_args={'check_same_thread': False})
+        else:
+            engine = self._pooled_engine(url, db)
+        folder = os.path.dirname(url.database) if not in_memory else None
+
+        @event.listens_for(engine, 'connect')
+        def attach_schemas(dbapi_connection, connection_record):
+            for schema in self.schemas:
+                target = ':memory:' if in_memory else os.path.join(folder, f'{schema}.db')
+                dbapi_connection.execute(f"attach database '{target}' as {schema}")
+
+        return engine
+
+
+class SnapshotBackend(SQLBackend):
+    """Offline copy of the rds tables as parquet files, under <path>/<db>/<table>.parquet
+    (e.g. ./data/offline/data/dataprocessing.benchmark_aurrera.parquet). The tables of a
+    database are loaded into a temporary SQLite database the first time it is queried.
+    Pushed tables are written as parquet files in the same place.
+
+    :param path: directory of the snapshot, defaults to './data/offline'
+    :type path: str, optional
+    :param pool: settings of the connection pools of the temporary databases, defaults to None
+    :type pool: dict, optional
+    """
+
+    def __init__(self, path='./data/offline', pool=None):
+        super().__init__({}, pool=pool)
+        self.path = path
+        self.name = f'snapshot:{os.path.abspath(path)}'
+        self._loaded = {}
+
+    def engine(self, db):
+        # Writes go to parquet files, there is no database to run statements on
+        return None
+
+    def query_engine(self, db):
+        with self._lock:
+            if db not in self._loaded:
+                self._loaded[db] = self._load(db)
+            return self._loaded[db]
+
+    def _load(self, db):
+        folder = os.path.join(self.path, db)
+        if not os.path.isdir(folder):
+            raise FileNotFoundError(f'No snapshot of database {db} in {folder}. Create it with ion.export_snapshot.')
+
+        tables = [f[:-len('.parquet')] for f in sorted(os.listdir(folder)) if f.endswith('.parquet')]
+        # A file, not memory, so each thread gets its own connection
+        tmp = tempfile.mkdtemp(prefix='varietybenchmark_')
+        atexit.register(shutil.rmtree, tmp, ignore_errors=True)
+        target = os.path.join(tmp, f'{db}.db')
+        backend = SQLBackend({db: f'sqlite:///{target}'}, schemas={t.split('.')[0] for t in tables if '.' in t},
+                             pool=self.pool)
+        # Queries of the snapshot are timed with the other databases of this backend
+        backend.stats = self.stats
+        engine = backend.engine(db)
+        for table in tables:
+            schema, _, name = table.rpartition('.')
+            df = pd.read_parquet(os.path.join(folder, f'{table}.parquet'))
+            df.to_sql(name, engine, schema=schema or None, index=False)
+        return engine
+
+    def push_table(self, df, table_name, db, if_exists='fail'):
+        path = os.path.join(self.path, db, f'{table_name}.parquet')
+        if os.path.exists(path):
+            if if_exists == 'fail':
+                raise ValueError(f'Table {table_name} already exists in {path}.')
+            if if_exists == 'append':
+                df = pd.concat([pd.read_parquet(path), df], ignore_index=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df.to_parquet(path, index=False)
+
+        # Queries see the new table
+        with self._lock:
+            engine = self._loaded.pop(db, None)
+        if engine is not None:
+            engine.dispose()
+
+    def dispose(self):
+        with self._lock:
+            for engine in self._loaded.values():
+                engine.dispose()
+            self._loaded.clear()
+
+
+# Class of each kind in BACKENDS
+backend_classes = {'rds': RDSBackend, 'sql': SQLBackend, 'snapshot': SnapshotBackend}
+
+def make_backend(options=None):
+    """Backend described by run_params['IO']['backend']
+
+    :param options: 'kind' is 'rds' (default), 'sql' (with 'urls' and optional 'schemas')
+        or 'snapshot' (with optional 'path'), and optional 'pool' settings (see pool_defaults),
+        defaults to None (rds)
+    :type options: dict, optional
+    :raises ValueError: unknown kind
+    :return: backend
+    :rtype: RDSBackend, SQLBackend or SnapshotBackend
+    """
+    options = dict(options or {})
+    kind = options.pop('kind', 'rds')
+    if kind not in backend_classes:
+        raise ValueError(f'Invalid backend: {kind}. Use one of {BACKENDS}.')
+    return backend_classes[kind](**options)
@@ -0,0 +1,567 @@
+import os
+import json
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from ..preprocessing import preprocessing as prep
+
+
+def timeit(func, *args, repeat=3, **kwargs):
+    """Best wall time of `repeat` calls to func(*args, **kwargs)
+
+    :param func: function to time
+    :type func: callable
+    :param repeat: number of calls, defaults to 3
+    :type repeat: int, optional
+    :return: best time in seconds and the result of the last call
+    :rtype: tuple(float, object)
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def dirty_ids(n_rows, dirty_share=0.05, seed=0):
+    """Column of identifiers as they come from scrapers: strings of
+    8 to 13 digits, mixed with empty values and non numeric codes.
+
+    :param n_rows: number of identifiers
+    :type n_rows: int
+    :param dirty_share: share of non numeric identifiers, defaults to 0.05
+    :type dirty_share: float, optional
+    :param seed: random seed, defaults to 0
+    :type seed: int, optional
+    :return: object column of identifiers
+    :rtype: series
+    """
+    rng = np.random.default_rng(seed)
+    ids = rng.integers(10**7, 10**13, size=n_rows).astype(str).astype(object)
+
+    dirty = rng.random(n_rows) < dirty_share
+    ids[dirty] = rng.choice(np.array(['', 'N/A', 'SKU-1234', None], dtype=object), size=dirty.sum())
+
+    return pd.Series(ids)
+
+def _legacy_normalize_ids(ids):
+    """Per-row normalization used before normalize_ids"""
+    ids = ids[ids.apply(lambda x: prep.is_int(x))]
+    return ids.apply(lambda x: prep.complete_13(x))
+
+def bench_normalize_ids(n_rows=1_000_000, repeat=3):
+    """Compare prep.normalize_ids against the per-row is_int/complete_13 applies.
+
+    :param n_rows: number of identifiers, defaults to 1_000_000
+    :type n_rows: int, optional
+    :param repeat: calls per implementation, defaults to 3
+    :type repeat: int, optional
+    :return: timings in seconds and speedup
+    :rtype: dict
+    """
+    ids = dirty_ids(n_rows)
+
+    t_legacy, legacy = timeit(_legacy_normalize_ids, ids, repeat=repeat)
+    t_vector, (normalized, valid) = timeit(prep.normalize_ids, ids, repeat=repeat)
+
+    normalized = normalized[valid]
+    if not (legacy.index.equals(normalized.index) and
+            np.array_equal(legacy.to_numpy(dtype=object), normalized.to_numpy(dtype=object))):
+        raise AssertionError('normalize_ids differs from is_int/complete_13')
+
+    return {'n_rows': n_rows, 'legacy_s': t_legacy, 'vectorized_s': t_vector,
+            'speedup': t_legacy / t_vector}
+
+def peak_memory(func, *args, **kwargs):
+    """Peak memory allocated during func(*args, **kwargs), traced with tracemalloc
+
+    :param func: function to measure
+    :type func: callable
+    :return: peak memory in MB and the result of the call
+    :rtype: tuple(float, object)
+    """
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1e6, result
+
+def synthetic_scrape(n_rows, n_categories, seed=0):
+    """Preprocessed scrape with products spread over categories
+
+    :param n_rows: number of products
+    :type n_rows: int
+    :param n_categories: number of categories
+    :type n_categories: int
+    :param seed: random seed, defaults to 0
+    :type seed: int, optional
+    :return: dataframe with BA_ean, BA_product_name and BA_category
+    :rtype: dataframe
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'BA_ean': prep.normalize_ids(pd.Series(rng.integers(10**7, 10**13, size=n_rows)))[0],
+        'BA_product_name': 'product',
+        'BA_category': pd.Series(rng.integers(0, n_categories, size=n_rows)).map('category {}'.format),
+    })
+
+def _legacy_display_order(df, category, display_order):
+    """Per-category loop used before prep.add_display_order"""
+    display_groups = pd.DataFrame(data=None)
+    for name, group in df.groupby(category):
+        group[display_order] = list(range(len(group)))
+        display_groups = pd.concat( [display_groups, group] )
+    display_groups.sort_values([category, display_order], inplace=True)
+    return display_groups
+
+def bench_display_order(n_rows=1_000_000, n_categories=500, repeat=1):
+    """Compare prep.add_display_order against the per-category groupby/concat loop.
+
+    :param n_rows: number of products, defaults to 1_000_000
+    :type n_rows: int, optional
+    :param n_categories: number of categories, defaults to 500
+    :type n_categories: int, optional
+    :param repeat: calls per implementation, defaults to 1
+    :type repeat: int, optional
+    :return: timings in seconds, peak memory in MB and speedup
+    :rtype: dict
+    """
+    df = synthetic_scrape(n_rows, n_categories)
+    args = (df, 'BA_category', 'BA_display_order')
+
+    t_legacy, legacy = timeit(_legacy_display_order, *args, repeat=repeat)
+    t_vector, vector = timeit(prep.add_display_order, *args, repeat=repeat)
+    mem_legacy, _ = peak_memory(_legacy_display_order, *args)
+    mem_vector, _ = peak_memory(prep.add_display_order, *args)
+
+    if not legacy.astype({'BA_display_order': np.int64}).equals(vector):
+        raise AssertionError('add_display_order differs from the groupby/concat loop')
+
+    return {'n_rows': n_rows, 'n_categories': n_categories,
+            'legacy_s': t_legacy, 'vectorized_s': t_vector, 'speedup': t_legacy / t_vector,
+            'legacy_peak_mb': mem_legacy, 'vectorized_peak_mb': mem_vector}
+
+def synthetic_names(n_rows, seed=0):
+    """Product names made of random words, brands and sizes"""
+    rng = np.random.default_rng(seed)
+    words = np.array(['leche', 'entera', 'deslactosada', 'refresco', 'cola', 'galletas', 'jabon',
+                      'agua', 'natural', 'pan', 'blanco', 'queso', 'yogurt', 'fresa', 'cafe',
+                      'soluble', 'arroz', 'frijol', 'negro', 'aceite', 'vegetal', 'azucar'])
+    sizes = np.array(['1 l', '600 ml', '500 g', '1 kg', '170 g', '2 l'])
+    names = pd.Series(rng.choice(words, n_rows)).str.cat([pd.Series(rng.choice(words, n_rows)),
+                                                          pd.Series(rng.integers(0, 5000, n_rows)).astype(str),
+                                                          pd.Series(rng.choice(sizes, n_rows))], sep=' ')
+    return names
+
+def bench_fuzzy_match(n_rows=100_000, n_categories=50, n_misaligned=0, repeat=1):
+    """Time models.fuzzy_match_names on n_rows x n_rows names, blocked by category
+
+    :param n_rows: names on each side, defaults to 100_000
+    :type n_rows: int, optional
+    :param n_categories: number of categories used as blocks, defaults to 50
+    :type n_categories: int, optional
+    :param n_misaligned: store categories renamed so that no Neta category has their 
+        name, as when both sides name categories differently, defaults to 0
+    :type n_misaligned: int, optional
+    :param repeat: calls, defaults to 1
+    :type repeat: int, optional
+    :return: timing in seconds, number of matches and of names in misaligned categories
+    :rtype: dict
+    """
+    from ..models import models
+
+    rng = np.random.default_rng(1)
+    left, right = synthetic_names(n_rows, seed=2), synthetic_names(n_rows, seed=3)
+    left_blocks = rng.integers(0, n_categories, n_rows)
+    right_blocks = rng.integers(0, n_categories, n_rows)
+    misaligned = left_blocks < n_misaligned
+    left_blocks = np.where(misaligned, left_blocks + n_categories, left_blocks)
+
+    t, matches = timeit(models.fuzzy_match_names, left, right, left_blocks=left_blocks,
+                        right_blocks=right_blocks, repeat=repeat)
+
+    return {'n_rows': n_rows, 'n_categories': n_categories, 'n_misaligned': n_misaligned,
+            'misaligned_rows': int(misaligned.sum()), 'seconds': t, 'matches': len(matches)}
+
+def bench_bulk_write(n_rows=100_000, url='sqlite:///./data/interim/bench_write.db', batch_size=10_000):
+    """Time ion.bulk_replace_table against a single to_sql(if_exists='replace') on a 
+    local stand-in of the rds database (SQLite by default, or a Postgres url), and 
+    check that the replaced table holds the same rows.
+
+    :param n_rows: rows written, defaults to 100_000
+    :type n_rows: int, optional
+    :param url: SQLAlchemy url of the stand-in database, defaults to a SQLite file
+    :type url: str, optional
+    :param batch_size: rows per batch, defaults to 10_000
+    :type batch_size: int, optional
+    :return: timing in seconds, rows/s and whether both tables are equal
+    :rtype: dict
+    """
+    import os
+    import logging
+    from ..ion import ion
+
+    if url.startswith('sqlite:///'):
+        os.makedirs(os.path.dirname(url[len('sqlite:///'):]) or '.', exist_ok=True)
+    previous = ion._backend
+    ion.set_backend({'kind': 'sql', 'urls': {'bench': url}, 'schemas': []})
+    engine = ion.get_engine('bench')
+
+    df = synthetic_scrape(n_rows, 100)
+
+    start = time.perf_counter()
+    df.to_sql('bench_push_table', engine, if_exists='replace', index=False)
+    t_legacy = time.perf_counter() - start
+
+    # Replace twice: the second call swaps over an existing table
+    ion.bulk_replace_table(df.head(10), 'bench_bulk', 'bench', logging, batch_size)
+    start = time.perf_counter()
+    ion.bulk_replace_table(df, 'bench_bulk', 'bench', logging, batch_size)
+    t_bulk = time.perf_counter() - start
+
+    legacy = pd.read_sql('select * from bench_push_table', engine)
+    bulk = pd.read_sql('select * from bench_bulk', engine)
+    ion._backend = previous
+
+    return {'n_rows': n_rows, 'batch_size': batch_size, 'dialect': engine.dialect.name,
+            'push_table_s': t_legacy, 'bulk_s': t_bulk, 'bulk_rows_per_s': n_rows / t_bulk,
+            'equal': legacy.equals(bulk)}
+
+# Baseline results of bench_suite, checked in to spot regressions between versions
+PATH_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+def synthetic_gtins(n_rows, rng, upc_share=0.2):
+    """GTIN-13 strings with a valid GS1 check digit. A share of them are 12 digit 
+    UPC-A codes padded with a leading '0', as in the Neta catalog"""
+    body = rng.integers(0, 10, size=(n_rows, 12))
+    body[:, 0] = np.where(rng.random(n_rows) < upc_share, 0, rng.integers(1, 10, size=n_rows))
+    weights = np.tile([1, 3], 6)
+    check = (10 - (body * weights).sum(axis=1) % 10) % 10
+    digits = np.hstack([body, check[:, None]]).astype(np.uint8) + ord('0')
+    return pd.Series(digits.view('S13').ravel()).str.decode('ascii')
+
+def synthetic_neta(n_rows, n_categories=100, seed=0):
+    """Neta catalog as returned by QUERY_PRODUCTS_IN_HOMEPAGE
+
+    :param n_rows: number of products
+    :type n_rows: int
+    :param n_categories: number of categories, defaults to 100
+    :type n_categories: int, optional
+    :param seed: random seed, defaults to 0
+    :type seed: int, optional
+    :return: dataframe with Id, Sku, Gtin, Name, Price, catId and category
+    :rtype: dataframe
+    """
+    rng = np.random.default_rng(seed)
+    cat_id = rng.integers(0, n_categories, size=n_rows)
+    return pd.DataFrame({
+        'Id': np.arange(n_rows, 0, -1),
+        'Sku': pd.Series(np.arange(n_rows)).map('SKU{}'.format),
+        'Gtin': synthetic_gtins(n_rows, rng),
+        'Name': synthetic_names(n_rows, seed=seed),
+        'Price': rng.uniform(5, 500, size=n_rows).round(2),
+        'catId': cat_id,
+        'category': pd.Series(cat_id).map('neta category {}'.format),
+    })
+
+def synthetic_competitor(store, neta, n_rows, n_categories=500, match_rate=0.3, dirty_share=0.05, seed=0):
+    """Raw scrape of a competitor as returned by the scraper queries. A share of the 
+    identifiers is taken from the Neta catalog and a share is dirty (empty, non numeric
+    or without leading zeros).
+
+    :param store: store name: 'aurrera' or 'chedraui'
+    :type store: str
+    :param neta: Neta catalog from synthetic_neta
+    :type neta: dataframe
+    :param n_rows: number of scraped products
+    :type n_rows: int
+    :param n_categories: number of categories, defaults to 500
+    :type n_categories: int, optional
+    :param match_rate: share of products also in Neta, defaults to 0.3
+    :type match_rate: float, optional
+    :param dirty_share: share of dirty identifiers, defaults to 0.05
+    :type dirty_share: float, optional
+    :param seed: random seed, defaults to 0
+    :type seed: int, optional
+    :return: raw scrape
+    :rtype: dataframe
+    """
+    rng = np.random.default_rng(seed)
+    ids = synthetic_gtins(n_rows, rng)
+    in_neta = rng.random(n_rows) < match_rate
+    ids[in_neta] = neta['Gtin'].to_numpy()[rng.integers(0, len(neta), size=in_neta.sum())]
+
+    dirty = np.flatnonzero(rng.random(n_rows) < dirty_share)
+    kind = rng.integers(0, 3, size=len(dirty))
+    ids[dirty[kind == 0]] = ''
+    ids[dirty[kind == 1]] = 'N/A'
+    # Scrapers drop the padding of UPC-A codes: the same product, restored by prep.normalize_ids
+    unpadded = dirty[kind == 2][ids[dirty[kind == 2]].str.startswith('0').to_numpy()]
+    ids[unpadded] = ids[unpadded].str.lstrip('0')
+
+    category = pd.Series(rng.integers(0, n_categories, size=n_rows)).map('category {}'.format)
+    price = rng.uniform(5, 500, size=n_rows).round(2)
+    common = {'product_name': synthetic_names(n_rows, seed=seed + 1), 'normal_price': price}
+    scraped = pd.Timestamp('2022-03-14 14:43:30')
+
+    if store == 'aurrera':
+        return pd.DataFrame({'ean': ids, 'product_id': np.arange(n_rows), **common,
+                             'category': category, 'subcategory': category,
+                             'current_price': price * rng.choice([1, 0.9], size=n_rows),
+                             'url': 'https://despensa.bodegaaurrera.com.mx/',
+                             'scraping_datetime': scraped})
+    if store == 'chedraui':
+        return pd.DataFrame({'upc': ids, **common, 'input_category': category, 'category': category,
+                             'sub_category_1': category, 'sub_category_2': category,
+                             'url': 'https://www.chedraui.com.mx/', 'scraping_datetime': scraped})
+    raise ValueError(f'Unknown store: {store}')
+
+def synthetic_database(path, neta, scrape, store='aurrera'):
+    """Write a synthetic Neta catalog and scrape as the tables read by the queries of 
+    ion (netamx.Product, product_category_mapping, category and the scraper table of 
+    the store), in SQLite files under path
+
+    :param path: directory of the database files. Existing files are replaced
+    :type path: str
+    :param neta: Neta catalog from synthetic_neta
+    :type neta: dataframe
+    :param scrape: raw scrape from synthetic_competitor
+    :type scrape: dataframe
+    :param store: store of the scrape, defaults to 'aurrera'
+    :type store: str, optional
+    :return: options of a 'sql' backend reading them, see backends.make_backend
+    :rtype: dict
+    """
+    from ..backends import backends
+
+    path = os.path.abspath(path)
+    os.makedirs(path, exist_ok=True)
+    for f in os.listdir(path):
+        if f.endswith('.db'):
+            os.remove(os.path.join(path, f))
+    options = {'kind': 'sql', 'urls': {db: f'sqlite:///{path}/{db}.db' for db in ('data', 'prod')}}
+    backend = backends.make_backend(options)
+
+    prod = backend.engine('prod')
+    neta[['Id', 'Sku', 'Gtin', 'Name', 'Price']].assign(Deprecated=0, Deleted=0, Published=1).to_sql(
+        'Product', prod, schema='netamx', index=False)
+    pd.DataFrame({'Id': neta['catId'], 'ProductId': neta['Id'], 'CategoryId': neta['catId']}).to_sql(
+        'product_category_mapping', prod, index=False)
+    neta[['catId', 'category']].drop_duplicates('catId').rename(columns={'catId': 'Id', 'category': 'Name'}).to_sql(
+        'category', prod, index=False)
+
+    schema, _, table = backends.snapshot_tables['data'][['aurrera', 'chedraui'].index(store)].rpartition('.')
+    scrape.to_sql(table, backend.engine('data'), schema=schema, index=False)
+    backend.dispose()
+    return options
+
+def bench_stages(n_rows, n_categories=500, neta_rows=None, match_rate=0.3, dirty_share=0.05,
+                 fmt='parquet', path='./data/interim/bench'):
+    """Time the stages of an aurrera run (VarietyBenchmark.run) on synthetic data read
+    from SQLite files with the 'sql' backend: queries, dtypes, Neta cleaning and 
+    shaping, preprocessing, store shaping, matching and the save stages (coincidences, 
+    price gaps, push, history and local writers). Charts are not rendered: they run in 
+    other processes, off the critical path. Stages are measured with profiling.RunProfiler 
+    (wall time, CPU time and peak RSS).
+
+    :param n_rows: scraped products
+    :type n_rows: int
+    :param n_categories: scraped categories, defaults to 500
+    :type n_categories: int, optional
+    :param neta_rows: products in the Neta catalog, defaults to n_rows // 10
+    :type neta_rows: int, optional
+    :param match_rate: share of scraped products also in Neta, defaults to 0.3
+    :type match_rate: float, optional
+    :param dirty_share: share of dirty identifiers, defaults to 0.05
+    :type dirty_share: float, optional
+    :param fmt: local file format, defaults to 'parquet'
+    :type fmt: str, optional
+    :param path: directory of the databases and of every file written by the run, 
+        defaults to './data/interim/bench'
+    :type path: str, optional
+    :return: stage records keyed by stage name, prefixed with the store as checkpoints 
+        (e.g. 'clean_neta', 'aurrera/match')
+    :rtype: dict
+    """
+    import copy
+    from ..checkpoints import checkpoints
+    from ..managers.managers import VarietyBenchmark
+
+    path = os.path.abspath(path)
+    neta_rows = neta_rows or max(1, n_rows // 10)
+    neta_raw = synthetic_neta(neta_rows)
+    scrape = synthetic_competitor('aurrera', neta_raw, n_rows, n_categories, match_rate, dirty_share)
+    backend = synthetic_database(path, neta_raw, scrape)
+    del neta_raw, scrape
+
+    man = VarietyBenchmark(copy.deepcopy(VarietyBenchmark.run_params))
+    man.run_params['IO'].update(store='aurrera', format=fmt, charts=False, cache={'enabled': False},
+                                snapshot=None, incremental=False, streaming=False, resume_from=None,
+                                backend=dict(backend, pool=man.run_params['IO']['backend'].get('pool')))
+    man.run_params['data']['fuzzy'] = dict(man.run_params['data'].get('fuzzy', {}), enabled=False)
+
+    # Local files, history and manifest of the run go under path
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        man.run()
+    finally:
+        os.chdir(cwd)
+
+    return {checkpoints.CheckpointStore.key(record['stage'], record['store']):
+            {k: record[k] for k in ['rows_in', 'rows_out', 'wall_s', 'cpu_s', 'peak_rss_mb']}
+            for record in man.run_params['log']['profile']['stages']}
+
+def bench_suite(sizes=(10_000, 100_000, 1_000_000), path=None, **kwargs):
+    """Run bench_stages for each size. Sizes that run out of memory are reported as failed.
+    10_000_000 is opt-in: it needs more memory than the machine of the baseline has, 
+    add it to sizes (and to the baseline) on a larger one.
+
+    :param sizes: scraped products of each run, defaults to (10_000, 100_000, 1_000_000)
+    :type sizes: tuple, optional
+    :param path: save the results as JSON in path (e.g. PATH_BASELINE), defaults to None
+    :type path: str, optional
+    :return: version, machine and stage records per size
+    :rtype: dict
+    """
+    import platform
+    from ..managers.managers import VarietyBenchmark
+
+    results = {'version': '.'.join(map(str, VarietyBenchmark.version)),
+               'machine': {'python': platform.python_version(), 'pandas': pd.__version__,
+                           'numpy': np.__version__, 'processor': platform.machine(),
+                           'cpus': os.cpu_count()},
+               'sizes': {}}
+    for n_rows in sizes:
+        try:
+            results['sizes'][str(n_rows)] = bench_stages(n_rows, **kwargs)
+        except MemoryError:
+            results['sizes'][str(n_rows)] = 'MemoryError'
+
+        # Saved after each size, so results survive a run killed by the OS
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=4)
+    return results
+
+def compare_to_baseline(results, path=PATH_BASELINE, tolerance=1.5):
+    """Stages slower than tolerance times the baseline. Sizes and stages missing from 
+    the baseline, or failed, are not compared and are logged as warnings.
+
+    :param results: output of bench_suite
+    :type results: dict
+    :param path: baseline results, defaults to PATH_BASELINE
+    :type path: str, optional
+    :param tolerance: allowed ratio of wall times, defaults to 1.5
+    :type tolerance: float, optional
+    :return: size, stage, baseline and current wall time of each regression
+    :rtype: list
+    """
+    with open(path) as f:
+        baseline = json.load(f)
+
+    import logging
+
+    regressions = []
+    for size, stages in results['sizes'].items():
+        base = baseline['sizes'].get(size)
+        if base is None:
+            logging.warning(f'Size {size} not compared: it is not in the baseline.')
+            continue
+        if not isinstance(stages, dict) or not isinstance(base, dict):
+            # e.g. 'MemoryError'
+            failed = stages if not isinstance(stages, dict) else base
+            logging.warning(f'Size {size} not compared: {failed}')
+            continue
+        missing = [stage for stage in stages if stage not in base]
+        if missing:
+            logging.warning(f'Stages of size {size} without baseline: {missing}')
+        for stage, record in stages.items():
+            if stage in base and record['wall_s'] > tolerance * base[stage]['wall_s']:
+                regressions.append({'size': int(size), 'stage': stage,
+                                    'baseline_s': base[stage]['wall_s'], 'current_s': record['wall_s']})
+    return regressions
+
+def bench_price_gaps(n_rows=1_000_000, n_categories=500, repeat=3):
+    """Time pricing.gap_summary against the same statistics with a pandas groupby, per
+    category and for the whole store
+
+    :param n_rows: matched products, defaults to 1_000_000
+    :type n_rows: int, optional
+    :param n_categories: number of categories, defaults to 500
+    :type n_categories: int, optional
+    :param repeat: calls per implementation, defaults to 3
+    :type repeat: int, optional
+    :return: timings in seconds and whether the medians agree
+    :rtype: dict
+    """
+    from ..pricing import pricing
+
+    rng = np.random.default_rng(0)
+    current = rng.uniform(5, 500, size=n_rows)
+    df = synthetic_scrape(n_rows, n_categories).assign(
+        is_in='ambos', BA_normal_price=current * rng.choice([1, 1.1], size=n_rows),
+        BA_current_price=current, NETA_Price=current * rng.normal(1, 0.1, size=n_rows))
+    gaps = pricing.price_gaps(df)
+
+    def with_pandas(gaps):
+        # The same statistics as gap_summary: per category and for the whole store
+        qs = [q / 100 for q in pricing.summary_percentiles]
+        grouped = gaps.groupby('BA_category')
+        per_category = grouped.agg(n_products=('gap_pct', 'size'), n_priced=('gap_pct', 'count'),
+                                   mean_gap_pct=('gap_pct', 'mean'),
+                                   mean_store_discount_pct=('store_discount_pct', 'mean'),
+                                   n_cheaper=('neta_cheaper', 'sum')).join(grouped['gap_pct'].quantile(qs).unstack())
+        per_store = pd.concat([gaps['gap_pct'].quantile(qs),
+                               gaps[['gap_pct', 'store_discount_pct']].mean(), gaps[['gap_pct', 'neta_cheaper']].count()])
+        return per_category, per_store
+
+    t_pandas, expected = timeit(with_pandas, gaps, repeat=repeat)
+    t_numpy, summary = timeit(pricing.gap_summary, gaps, repeat=repeat)
+
+    medians = summary[summary['level'] == 'category'].set_index('BA_category')['p50_gap_pct']
+    return {'n_rows': n_rows, 'n_categories': n_categories, 'pandas_s': t_pandas, 'numpy_s': t_numpy,
+            'speedup': t_pandas / t_numpy, 'equal': bool(np.allclose(medians, expected[0][0.5].loc[medians.index]))}
+
+def bench_nearest_neighbors(n_train=20_000, n_query=5_000, n_features=64, n_classes=500, n_jobs=None, repeat=1):
+    """Time and peak memory of models.NearestNeighborClassifier against the brute force
+    TemplateClassifier, on clustered embeddings, and share of equal predictions
+
+    :param n_train: training rows, defaults to 20_000
+    :type n_train: int, optional
+    :param n_query: predicted rows, defaults to 5_000
+    :type n_query: int, optional
+    :param n_features: embedding size, defaults to 64
+    :type n_features: int, optional
+    :param n_classes: number of classes, e.g. categories, defaults to 500
+    :type n_classes: int, optional
+    :param n_jobs: threads of NearestNeighborClassifier, defaults to None
+    :type n_jobs: int, optional
+    :param repeat: calls per estimator, defaults to 1
+    :type repeat: int, optional
+    :return: timings in seconds, peak memory in MB and agreement of the predictions
+    :rtype: dict
+    """
+    from ..models import models
+
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(n_classes, n_features))
+    y = rng.integers(0, n_classes, n_train)
+    X = centers[y] + rng.normal(scale=0.5, size=(n_train, n_features))
+    queries = centers[rng.integers(0, n_classes, n_query)] + rng.normal(scale=0.5, size=(n_query, n_features))
+
+    results = {'n_train': n_train, 'n_query': n_query, 'n_features': n_features}
+    predictions = {}
+    for name, model in [('template', models.TemplateClassifier()),
+                        ('nearest', models.NearestNeighborClassifier(n_jobs=n_jobs))]:
+        model.fit(X, y)
+        t, _ = timeit(model.predict, queries, repeat=repeat)
+        mb, predictions[name] = peak_memory(model.predict, queries)
+        results[f'{name}_s'], results[f'{name}_peak_mb'] = t, mb
+
+    results['speedup'] = results['template_s'] / results['nearest_s']
+    results['agreement'] = float(np.mean(predictions['template'] == predictions['nearest']))
+    return results
@@ -0,0 +1,161 @@
+import os
+import json
+import shutil
+import hashlib
+import datetime
+import threading
+import pandas as pd
+from ..config import PATH_CHECKPOINTS
+
+# Each run keeps the output of its stages under <path>/<run_id>/<store>/<stage>.parquet 
+# and describes them in <path>/<run_id>/manifest.json: fingerprint of the inputs, file, 
+# rows. A run resuming from another one loads the outputs whose fingerprint matches 
+# instead of computing them again, and records their location in its own manifest.
+
+
+def fingerprint(*inputs):
+    """Short hash of JSON serializable inputs (other values are hashed as strings)"""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class CheckpointStore:
+    """Checkpoints and manifest of a run
+
+    :param run_id: run identifier, also the directory of the run
+    :type run_id: str
+    :param path: directory of the runs, defaults to PATH_CHECKPOINTS
+    :type path: str, optional
+    :param resume_from: run to take checkpoints from: a run id, 'latest' (newest previous 
+        run) or None, defaults to None
+    :type resume_from: str, optional
+    :param enabled: write checkpoints of this run. The manifest is always written, defaults to True
+    :type enabled: bool, optional
+    """
+
+    def __init__(self, run_id, path=PATH_CHECKPOINTS, resume_from=None, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self.run_id = run_id
+        self.run_dir = os.path.join(path, run_id)
+        self._lock = threading.Lock()
+
+        if resume_from == 'latest':
+            previous = [r for r in self.runs(path) if r < run_id]
+            resume_from = previous[-1] if previous else None
+        self.resume_from = resume_from
+        self._resumable = load_manifest(os.path.join(path, resume_from))['stages'] if resume_from else {}
+
+        self.manifest = {'run_id': run_id, 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                         'resumed_from': resume_from, 'stages': {}}
+
+    @staticmethod
+    def runs(path=PATH_CHECKPOINTS):
+        """Identifiers of the runs with a manifest, oldest first"""
+        if not os.path.isdir(path):
+            return []
+        return sorted(r for r in os.listdir(path) if os.path.exists(os.path.join(path, r, 'manifest.json')))
+
+    @staticmethod
+    def key(stage, store=None):
+        return f'{store}/{stage}' if store else stage
+
+    def resume(self, stage, store, fp):
+        """Output of a stage in the run resumed from, if its inputs had the same fingerprint
+
+        :param stage: stage name
+        :type stage: str
+        :param store: store of the stage, None for stages of the whole run
+        :type store: str
+        :param fp: fingerprint of the inputs of the stage
+        :type fp: str
+        :return: (True, dataframe or None for stages without output) or (False, None)
+        :rtype: tuple
+        """
+        entry = self._resumable.get(self.key(stage, store))
+        if entry is None or entry['fingerprint'] != fp or entry['status'] != 'ok':
+            return False, None
+        if entry['file'] is not None:
+            if not os.path.exists(entry['file']):
+                return False, None
+            df = pd.read_parquet(entry['file'])
+        else:
+            df = None
+        self._record(stage, store, dict(entry, resumed=True))
+        return True, df
+
+    def save(self, stage, store, fp, df=None):
+        """Record a finished stage and write its output
+
+        :param stage: stage name
+        :type stage: str
+        :param store: store of the stage, None for stages of the whole run
+        :type store: str
+        :param fp: fingerprint of the inputs of the stage
+        :type fp: str
+        :param df: output of the stage, defaults to None (a stage without output, e.g. save)
+        :type df: dataframe, optional
+        """
+        entry = {'fingerprint': fp, 'file': None, 'rows': None, 'status': 'ok', 'resumed': False}
+        if df is not None:
+            entry['rows'] = len(df)
+            if not self.enabled:
+                # Without a file the stage cannot be resumed
+                entry['status'] = 'not_saved'
+            else:
+                file_name = os.path.join(self.run_dir, store or '_run', f'{stage}.parquet')
+                os.makedirs(os.path.dirname(file_name), exist_ok=True)
+                try:
+                    df.to_parquet(file_name)
+                    entry['file'] = file_name
+                except (TypeError, ValueError) as e:
+                    # e.g. object columns mixing numbers and strings
+                    entry['status'] = 'not_saved'
+                    entry['error'] = repr(e)
+        self._record(stage, store, entry)
+
+    def _record(self, stage, store, entry):
+        with self._lock:
+            self.manifest['stages'][self.key(stage, store)] = entry
+            self._write()
+
+    def write(self, run_params=None, version=None):
+        """Write the manifest of the run, with its parameters and package version"""
+        with self._lock:
+            if run_params is not None:
+                self.manifest['run_params'] = run_params
+            if version is not None:
+                self.manifest['version'] = version
+            self._write()
+
+    def _write(self):
+        os.makedirs(self.run_dir, exist_ok=True)
+        write_manifest(self.manifest, os.path.join(self.run_dir, 'manifest.json'))
+
+    def prune(self, keep):
+        """Delete the oldest runs, keeping the newest keep ones (and the run resumed from)"""
+        runs = [r for r in self.runs(self.path) if r not in (self.run_id, self.resume_from)]
+        for run in runs[:max(0, len(runs) - keep + 1)]:
+            shutil.rmtree(os.path.join(self.path, run), ignore_errors=True)
+
+
+def write_manifest(manifest, file_name):
+    """Save a manifest as JSON, replacing the file at once"""
+    os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+    with open(f'{file_name}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4, default=str)
+    os.replace(f'{file_name}.tmp', file_name)
+
+def load_manifest(path):
+    """Manifest of a run, from its directory or its file
+
+    :param path: run directory or manifest file
+    :type path: str
+    :raises FileNotFoundError: no manifest
+    :return: manifest
+    :rtype: dict
+    """
+    file_name = os.path.join(path, 'manifest.json') if os.path.isdir(path) else path
+    if not os.path.exists(file_name):
+        raise FileNotFoundError(f'No run manifest in {path}')
+    with open(file_name) as f:
+        return json.load(f)
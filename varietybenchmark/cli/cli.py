@@ -0,0 +1,124 @@
+import argparse
+from ..config import FILE_FORMATS, BACKENDS
+
+# pandas and the rest of the package are imported only once a command runs,
+# so `varietybenchmark --help` answers right away
+
+
+def database_url(value):
+    """(database, url) from a DB=URL argument"""
+    db, _, url = value.partition('=')
+    if not db or not url:
+        raise argparse.ArgumentTypeError(f'expected DB=URL, e.g. data=sqlite:///data.db, got {value!r}')
+    return db, url
+
+def build_parser():
+    """Parser of the command line"""
+    parser = argparse.ArgumentParser(prog='varietybenchmark',
+                                     description='Benchmarking of products in competitor shops')
+    parser.add_argument('--version', action='store_true', help='print the package version and exit')
+    commands = parser.add_subparsers(dest='command')
+
+    run = commands.add_parser('run', help='match the products of one or more stores and save the results')
+    run.add_argument('--store', nargs='+', default=['aurrera'],
+                     help='store names: aurrera, chedraui. Several stores run in parallel (default: aurrera)')
+    run.add_argument('--format', choices=FILE_FORMATS, default='parquet', help='format of local files (default: parquet)')
+    run.add_argument('--excel', action='store_true', help='also export local files as .xlsx')
+    run.add_argument('--incremental', action='store_true', help='only process rows added since the last run')
+    run.add_argument('--streaming', action='store_true', help='process the scraper history in chunks')
+    run.add_argument('--chunk-size', type=int, default=100_000, help='rows per chunk when streaming (default: 100000)')
+    run.add_argument('--snapshot', choices=['all', 'latest', 'batch'], default='all',
+                     help='scraped rows to use: whole history, newest row per product or newest scraping day (default: all)')
+    run.add_argument('--as-of', help='ignore rows scraped after this datetime')
+    run.add_argument('--cache', action='store_true', help='cache query results locally')
+    run.add_argument('--workers', type=int, default=4, help='stores processed at the same time (default: 4)')
+    run.add_argument('--fuzzy', action='store_true', help='also match products without a Gtin match by name')
+    run.add_argument('--profile', choices=['cprofile', 'pyinstrument'], help='save a profile of the run')
+    run.add_argument('--backend', choices=BACKENDS, default='rds',
+                     help='read from rds, from SQLAlchemy urls (sql) or from a local snapshot (default: rds)')
+    run.add_argument('--backend-url', action='append', type=database_url, metavar='DB=URL',
+                     help='SQLAlchemy url of a database of the sql backend, e.g. data=sqlite:///data.db. '
+                          'Repeat it for each database (data, prod)')
+    run.add_argument('--pool-size', type=int, help='connections kept open per database (default: 5)')
+    run.add_argument('--snapshot-path', default='./data/offline', help='directory of the local snapshot (default: ./data/offline)')
+    run.add_argument('--resume-from', help="run id (or 'latest') whose unchanged stages are reused")
+    run.add_argument('--checkpoints', action='store_true', help='save stage checkpoints to resume later runs from')
+    run.add_argument('--no-history', dest='history', action='store_false', help='do not append the run to the history store')
+    run.add_argument('--history-products', action='store_true', help='also append the matched products to the history store')
+
+    export = commands.add_parser('export-snapshot', help='copy the tables read by the queries to a local snapshot')
+    export.add_argument('--path', default='./data/offline', help='directory of the snapshot (default: ./data/offline)')
+
+    return parser
+
+def run(args):
+    """Configure and execute VarietyBenchmark from the arguments of the run command
+
+    :param args: parsed arguments
+    :type args: argparse.Namespace
+    :return: exit code, 1 if a store failed
+    :rtype: int
+    """
+    # First line of the log before pandas is imported by the stages
+    import logging
+    from ..profiling import profiling
+    profiling.setup_logging()
+    logging.info(f'Starting run of {", ".join(args.store)} ({args.backend} backend)')
+
+    from ..managers.managers import VarietyBenchmark
+
+    man = VarietyBenchmark()
+    io = man.run_params['IO']
+    io.update({'store': args.store[0], 'stores': args.store, 'format': args.format,
+               'excel_export': args.excel, 'incremental': args.incremental,
+               'streaming': args.streaming, 'chunk_size': args.chunk_size,
+               'snapshot': None if args.snapshot == 'all' else args.snapshot,
+               'as_of': args.as_of, 'workers': args.workers, 'profile': args.profile or False,
+               'history': args.history, 'history_products': args.history_products,
+               'resume_from': args.resume_from})
+    io['checkpoints'] = dict(io['checkpoints'], enabled=args.checkpoints)
+    io['cache'] = dict(io['cache'], enabled=args.cache)
+    if args.backend == 'snapshot':
+        io['backend'] = {'kind': 'snapshot', 'path': args.snapshot_path, 'pool': io['backend'].get('pool')}
+    if args.backend == 'sql':
+        io['backend'] = {'kind': 'sql', 'urls': dict(args.backend_url), 'pool': io['backend'].get('pool')}
+    if args.pool_size:
+        io['backend']['pool'] = dict(io['backend'].get('pool') or {}, pool_size=args.pool_size)
+    man.run_params['data']['fuzzy'] = dict(man.run_params['data']['fuzzy'], enabled=args.fuzzy)
+
+    if len(args.store) == 1:
+        man.run()
+        return 0
+
+    report = man.run_many()
+    return int(any(r['status'] != 'ok' for r in report.values()))
+
+def export_snapshot(args):
+    """Save the rds tables read by the queries in args.path"""
+    import logging
+    from ..ion import ion
+    from ..managers.managers import VarietyBenchmark
+
+    VarietyBenchmark.setup_logging()
+    ion.set_backend()
+    ion.export_snapshot(logging, path=args.path)
+    return 0
+
+def main(argv=None):
+    """Entry point of the `varietybenchmark` command"""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.version:
+        from ..managers.managers import VarietyBenchmark
+        print('.'.join(map(str, VarietyBenchmark.version)))
+        return 0
+    if args.command == 'run':
+        if args.backend == 'sql' and not args.backend_url:
+            parser.error('--backend sql needs the url of each database with --backend-url DB=URL')
+        return run(args)
+    if args.command == 'export-snapshot':
+        return export_snapshot(args)
+
+    parser.print_help()
+    return 0
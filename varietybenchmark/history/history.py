@@ -0,0 +1,185 @@
+import os
+import json
+import datetime
+import threading
+import pandas as pd
+from ..config import PATH_HISTORY
+
+# Append-only history of the outputs of each run, one parquet file per table, store 
+# and run under <path>/<table>/store=<store>/date=<YYYY-MM-DD>/<run_ts>.parquet.
+# <path>/<table>/_manifest.json keeps the min/max of every column of each file, so 
+# queries only read the files that can match.
+
+_lock = threading.Lock()
+
+
+def run_timestamp():
+    """Timestamp identifying a run in the history, e.g. '2022-03-28T14:43:30'"""
+    return datetime.datetime.now().replace(microsecond=0).isoformat()
+
+def _stats(df):
+    """Min and max of each column, as JSON values. Columns without values are left out"""
+    stats = {}
+    for col in df.columns:
+        values = df[col].dropna()
+        if values.empty:
+            continue
+        if pd.api.types.is_bool_dtype(values) or pd.api.types.is_numeric_dtype(values):
+            stats[col] = [float(values.min()), float(values.max())]
+        else:
+            values = values.astype(str)
+            stats[col] = [values.min(), values.max()]
+    return stats
+
+def _load_manifest(path, table):
+    manifest_file = os.path.join(path, table, '_manifest.json')
+    if not os.path.exists(manifest_file):
+        return []
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def _save_manifest(path, table, manifest):
+    manifest_file = os.path.join(path, table, '_manifest.json')
+    with open(f'{manifest_file}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(f'{manifest_file}.tmp', manifest_file)
+
+def append(df, table, store, run_ts=None, path=PATH_HISTORY):
+    """Add the rows of a run to a table of the history. Rows are never replaced: 
+    appending the same table, store and run twice raises an error.
+
+    :param df: rows of the run
+    :type df: dataframe
+    :param table: table name, e.g. 'coincidences'
+    :type table: str
+    :param store: store name
+    :type store: str
+    :param run_ts: run timestamp (ISO format), defaults to now
+    :type run_ts: str, optional
+    :param path: directory of the history, defaults to PATH_HISTORY
+    :type path: str, optional
+    :raises FileExistsError: the run is already in the table
+    :return: written file
+    :rtype: str
+    """
+    run_ts = run_ts or run_timestamp()
+    partition = os.path.join(path, table, f'store={store}', f'date={run_ts[:10]}')
+    file_name = os.path.join(partition, f"{run_ts.replace(':', '')}.parquet")
+
+    df = df.reset_index(drop=True).assign(run_ts=pd.Timestamp(run_ts), store=store)
+    stats = _stats(df)
+
+    with _lock:
+        if os.path.exists(file_name):
+            raise FileExistsError(f'Run {run_ts} of {store} is already in the history table {table}.')
+        os.makedirs(partition, exist_ok=True)
+        df.to_parquet(file_name, index=False)
+
+        manifest = _load_manifest(path, table)
+        manifest.append({'file': os.path.relpath(file_name, os.path.join(path, table)),
+                         'store': store, 'run_ts': run_ts, 'rows': len(df), 'stats': stats})
+        _save_manifest(path, table, manifest)
+    return file_name
+
+def _may_match(entry, where):
+    """False if the min/max of a file show that no row satisfies where"""
+    for col, condition in where.items():
+        if col not in entry['stats']:
+            return False
+        low, high = entry['stats'][col]
+        if isinstance(condition, tuple):
+            lower, upper = condition
+            if (upper is not None and _compare(low, upper) > 0) or (lower is not None and _compare(high, lower) < 0):
+                return False
+        else:
+            values = condition if isinstance(condition, list) else [condition]
+            if not any(_compare(low, v) <= 0 <= _compare(high, v) for v in values):
+                return False
+    return True
+
+def _compare(stat, value):
+    """Compare a min/max stat with a value of a condition: -1, 0 or 1"""
+    if isinstance(stat, float):
+        value = float(value)
+    else:
+        value = str(value)
+    return (stat > value) - (stat < value)
+
+def read(table, store=None, since=None, until=None, columns=None, where=None, path=PATH_HISTORY):
+    """Rows of a history table. Files are pruned with the manifest before reading.
+
+    :param table: table name
+    :type table: str
+    :param store: only this store, defaults to None (all)
+    :type store: str, optional
+    :param since: only runs at or after this timestamp, defaults to None
+    :type since: str, optional
+    :param until: only runs at or before this timestamp, defaults to None
+    :type until: str, optional
+    :param columns: columns to read, defaults to None (all)
+    :type columns: list, optional
+    :param where: conditions per column: a value, a list of values or a (min, max) 
+        tuple (None for an open end), defaults to None
+    :type where: dict, optional
+    :param path: directory of the history, defaults to PATH_HISTORY
+    :type path: str, optional
+    :return: rows, with 'run_ts' and 'store'
+    :rtype: dataframe
+    """
+    where = dict(where or {})
+    if store is not None:
+        where['store'] = store
+    if since is not None or until is not None:
+        where['run_ts'] = (since, until)
+
+    # Timestamps in the manifest are ISO strings: compare them as strings
+    entries = [e for e in _load_manifest(path, table)
+               if _may_match({**e, 'stats': {**e['stats'], 'run_ts': [e['run_ts'], e['run_ts']]}}, where)]
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + ['run_ts', 'store'] + list(where)))
+
+    frames = [pd.read_parquet(os.path.join(path, table, e['file']), columns=columns) for e in entries]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(frames, ignore_index=True)
+
+    # Rows of the files read that do not satisfy where
+    keep = pd.Series(True, index=df.index)
+    for col, condition in where.items():
+        values = df[col]
+        if col == 'run_ts':
+            values = values.astype(str).str.replace(' ', 'T')
+        if isinstance(condition, tuple):
+            lower, upper = condition
+            if lower is not None:
+                keep &= values >= (str(lower) if col == 'run_ts' else lower)
+            if upper is not None:
+                keep &= values <= (str(upper) if col == 'run_ts' else upper)
+        else:
+            keep &= values.isin(condition if isinstance(condition, list) else [condition])
+    return df[keep].reset_index(drop=True)
+
+def coincidence_trend(store='aurrera', days=90, category='BA_category', categories=None, path=PATH_HISTORY):
+    """Percentage of coincidences with Neta per category over the runs of the last days
+
+    :param store: store name, defaults to 'aurrera'
+    :type store: str, optional
+    :param days: days back from now, defaults to 90
+    :type days: int, optional
+    :param category: category column of the store, defaults to 'BA_category'
+    :type category: str, optional
+    :param categories: only these categories, defaults to None (all)
+    :type categories: list, optional
+    :param path: directory of the history, defaults to PATH_HISTORY
+    :type path: str, optional
+    :return: one row per run and one column per category
+    :rtype: dataframe
+    """
+    since = (datetime.datetime.now() - datetime.timedelta(days=days)).replace(microsecond=0).isoformat()
+    where = {'level': 'category'}
+    if categories is not None:
+        where[category] = list(categories)
+
+    df = read('coincidences', store=store, since=since, where=where,
+              columns=[category, 'coincidence_pct'], path=path)
+    return df.pivot_table(index='run_ts', columns=category, values='coincidence_pct', observed=True)
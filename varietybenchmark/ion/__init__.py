@@ -1 +1,8 @@
-from .ion import *
\ No newline at end of file
+import importlib
+
+
+def __getattr__(name):
+    # Names of the ion module, imported on first use
+    if name.startswith('__'):
+        raise AttributeError(name)
+    return getattr(importlib.import_module('.ion', __name__), name)
@@ -1,7 +1,20 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import hashlib
+import uuid
+import threading
 import pandas as pd
-from dotenv import find_dotenv, load_dotenv
+from contextlib import contextmanager
 from ..vis import vis as vis
-from netadata.ion import query_rds, push_table
+from ..profiling import profiling
+from ..backends import backends
+from ..preprocessing import preprocessing as prep
+from ..pricing import pricing
+from ..history import history
+from ..config import PATH_WATERMARKS, PATH_SNAPSHOTS, PATH_CACHE, FILE_FORMATS
 
 # add here the db name for the remote db in rds
 remote_db_names = {
@@ -9,14 +22,95 @@ remote_db_names = {
     'chedraui': 'products_variety_chedraui'
 }
 
-# Load connection credentials
-load_dotenv(find_dotenv())
+# Supported formats of local files
+file_formats = FILE_FORMATS
 
-def read_scraped_file(store):
+# Repeated labels stored as categoricals in local files
+category_columns = ['is_in', 'BA_category', 'BA_subcategory', 'NETA_category',
+                    'CH_input_category', 'CH_category', 'CH_sub_category_1', 'CH_sub_category_2']
+
+# Source of the queries and destination of the tables, see set_backend
+_backend = None
+
+def set_backend(options=None):
+    """Select where queries are read from and tables are pushed to
+
+    :param options: run_params['IO']['backend'], see backends.make_backend. Defaults to None (rds)
+    :type options: dict, optional
+    :return: backend
+    :rtype: class
+    """
+    global _backend
+    _backend = backends.make_backend(options)
+    return _backend
+
+def get_backend():
+    """Current backend. rds unless set_backend was called"""
+    if _backend is None:
+        set_backend()
+    return _backend
+
+@contextmanager
+def connections(options=None):
+    """Backend of a run: one pooled engine per logical database, shared by every 
+    query and push until the with block ends, when its connections are closed
+
+    :param options: run_params['IO']['backend'], with optional 'pool' settings 
+        (see backends.pool_defaults), defaults to None (rds)
+    :type options: dict, optional
+    :yield: backend. Its pool_stats() give the checkout wait and query time per database
+    :rtype: class
+    """
+    backend = set_backend(options)
+    try:
+        yield backend
+    finally:
+        backend.dispose()
+
+def pool_stats():
+    """Checkout wait and query time per logical database of the current backend"""
+    return get_backend().pool_stats()
+
+def push_table(df, table_name, db, if_exists='fail'):
+    """Push df as table_name to the database db of the current backend
+
+    :param df: table
+    :type df: dataframe
+    :param table_name: destination table
+    :type table_name: str
+    :param db: logical database name: 'data', 'prod'
+    :type db: str
+    :param if_exists: 'fail', 'replace' or 'append', defaults to 'fail'
+    :type if_exists: str, optional
+    """
+    get_backend().push_table(prep.widen_floats(df), table_name, db, if_exists = if_exists)
+
+def export_snapshot(logging, path='./data/offline', tables=None):
+    """Copy the tables read by the queries from the current backend to parquet 
+    files that backends.SnapshotBackend can read offline
+
+    :param logging: logger
+    :type logging: class
+    :param path: directory of the snapshot, defaults to './data/offline'
+    :type path: str, optional
+    :param tables: tables by logical database, defaults to backends.snapshot_tables
+    :type tables: dict, optional
+    """
+    backend = get_backend()
+    for db, names in (tables or backends.snapshot_tables).items():
+        os.makedirs(os.path.join(path, db), exist_ok=True)
+        for name in names:
+            df = backend.query(db, f'select * from {name}')
+            df.to_parquet(os.path.join(path, db, f'{name}.parquet'), index=False)
+            logging.info(f'Saved {len(df)} rows of {db}.{name} in the snapshot.')
+
+def read_scraped_file(store, fmt='xlsx'):
     """Read raw files from  scraper. Add store name and path if needed.
 
     :param store: store name
     :type store: str
+    :param fmt: file format: 'parquet', 'feather', 'csv' or 'xlsx', defaults to 'xlsx'
+    :type fmt: str, optional
     :raises ValueError: Invalid store name. It should be in run_params["IO"]["store"]
         from managers
     :return: dataframe with scraped data
@@ -26,34 +120,724 @@ def read_scraped_file(store):
     # This part can be connected  with the price-scraping module
     if store == 'aurrera':
         #scraped_file = '../../data/raw/14-March-2022 14_43_30 despensa_bodegaaurrera_data.xlsx'
-        scraped_file = './data/raw/14-March-2022 14_43_30 despensa_bodegaaurrera_data.xlsx'
+        scraped_file = './data/raw/14-March-2022 14_43_30 despensa_bodegaaurrera_data'
     elif store == 'chedraui':
         #scraped_file = '../../data/raw/08-March-2022 21_37_58 chedraui_mx_data.xlsx'
-        scraped_file = './data/raw/08-March-2022 21_37_58 chedraui_mx_data.xlsx'
+        scraped_file = './data/raw/08-March-2022 21_37_58 chedraui_mx_data'
     else:
         raise ValueError('Invalid store name in run_params["IO"]["store"]. Check docstring for valid names.')
         
-    return pd.read_excel(scraped_file)
+    return read_table(f'{scraped_file}.{fmt}', fmt)
+
+def read_table(path, fmt=None):
+    """Read a table saved with write_table, or any raw file in a supported format
+
+    :param path: file, or directory of a partitioned parquet dataset
+    :type path: str
+    :param fmt: 'parquet', 'feather', 'csv' or 'xlsx'. Inferred from the extension if None
+    :type fmt: str, optional
+    :raises ValueError: unsupported format
+    :return: dataframe
+    :rtype: dataframe
+    """
+    if fmt is None:
+        fmt = 'parquet' if os.path.isdir(path) else os.path.splitext(path)[1].lstrip('.')
+
+    if fmt == 'parquet':
+        if os.path.isdir(path):
+            # Partitions are read as plain strings: pandas cannot unify the dictionaries
+            # of partitions with null values (e.g. Neta products without store category)
+            import pyarrow.dataset as ds
+            return ds.dataset(path, format='parquet', partitioning='hive').to_table().to_pandas()
+        return pd.read_parquet(path)
+    if fmt == 'feather':
+        return pd.read_feather(path)
+    if fmt == 'csv':
+        return pd.read_csv(path)
+    if fmt == 'xlsx':
+        return pd.read_excel(path)
+    raise ValueError(f'Unsupported file format: {fmt}. Use one of {file_formats}')
+
+def write_table(df, path, fmt, partition_cols=None, category_cols=None):
+    """Save a table locally in a columnar or text format.
+
+    :param df: dataframe to save
+    :type df: dataframe
+    :param path: destination without extension. For partitioned parquet it is the
+        directory of the dataset
+    :type path: str
+    :param fmt: 'parquet', 'feather', 'csv' or 'xlsx'
+    :type fmt: str
+    :param partition_cols: parquet only, columns to partition the dataset by. Existing
+        partitions with the same values are replaced, defaults to None
+    :type partition_cols: list, optional
+    :param category_cols: columns stored as categoricals (dictionary encoded), defaults to None
+    :type category_cols: list, optional
+    :raises ValueError: unsupported format
+    """
+    if fmt not in file_formats:
+        raise ValueError(f'Unsupported file format: {fmt}. Use one of {file_formats}')
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    df = prep.widen_floats(df)
+
+    if fmt == 'xlsx':
+        df.to_excel(f'{path}.xlsx')
+        return
+    if fmt == 'csv':
+        df.to_csv(f'{path}.csv', index=False)
+        return
+
+    category_cols = [c for c in category_cols or [] if c in df.columns]
+    df = df.astype({c: 'category' for c in category_cols}).reset_index(drop=True)
+
+    if fmt == 'feather':
+        df.to_feather(f'{path}.feather')
+        return
+
+    if not partition_cols:
+        df.to_parquet(f'{path}.parquet', index=False)
+        return
+
+    # Remove previous runs of the same partitions, e.g. data/processed/aurrera/store=aurrera
+    for values in df[partition_cols[:1]].drop_duplicates().itertuples(index=False):
+        shutil.rmtree(os.path.join(path, f'{partition_cols[0]}={values[0]}'), ignore_errors=True)
+    df.to_parquet(path, partition_cols=partition_cols, index=False)
     
-def query_scraped_store(store, logging):
-    """_summary_
+def query_scraped_store(store, logging, since=None, cache=None, snapshot=None, as_of=None):
+    """Query scraper results of a store
 
     :param store: store name
     :type store: str
     :param logging: logger
     :type logging: class
+    :param since: if given, only rows scraped after this datetime, defaults to None
+    :type since: str, optional
+    :param cache: options of the local query cache, see cached_query, defaults to None
+    :type cache: dict, optional
+    :param snapshot: None for the whole history, 'latest' for the newest row of each
+        product or 'batch' for the rows of the newest scraping day, defaults to None
+    :type snapshot: str, optional
+    :param as_of: ignore rows scraped after this datetime, for reproducible runs, defaults to None
+    :type as_of: str, optional
     :return: dataframe of the resulting query
     :rtype: dataframe
     """
     
     logging.info(f'Querying scraper results from {store}...')    
-    if store == 'aurrera':
-        return query_rds('data', QUERY_BA_SCRAPER, False)
-    
-    if store == 'chedraui':
-        return query_rds('data', QUERY_CHEDRAUI_SCRAPER, False)    
+    query, params = scraper_query(store, since, snapshot, as_of)
+    return cached_query('data', query, logging, params, cache)
+
+_scraper_tables = {'aurrera': 'dataprocessing.benchmark_aurrera',
+                   'chedraui': 'dataprocessing.benchmark_chedraui'}
+
+def scraper_query(store, since=None, snapshot=None, as_of=None):
+    """Select the query of the scraper table of a store. See query_scraped_store
+
+    :param store: store name
+    :type store: str
+    :raises ValueError: Invalid store name or snapshot
+    :return: query and its bind parameters
+    :rtype: tuple(str, dict)
+    """
+    if store not in ('aurrera', 'chedraui'):
+        raise ValueError('Invalid store name in run_params["IO"]["store"]. Check docstring for valid names.')
+
+    if since is not None:
+        if store == 'aurrera':
+            return QUERY_BA_SCRAPER_SINCE, {'since': str(since)}
+        return QUERY_CHEDRAUI_SCRAPER_SINCE, {'since': str(since)}
+
+    if snapshot is None:
+        if store == 'aurrera':
+            return QUERY_BA_SCRAPER, {}
+        return QUERY_CHEDRAUI_SCRAPER, {}
+
+    if snapshot not in ('latest', 'batch'):
+        raise ValueError(f"Invalid snapshot: {snapshot}. Use None, 'latest' or 'batch'.")
+
+    queries = {('aurrera', 'latest'): QUERY_BA_SCRAPER_LATEST,
+               ('aurrera', 'batch'): QUERY_BA_SCRAPER_BATCH,
+               ('chedraui', 'latest'): QUERY_CHEDRAUI_SCRAPER_LATEST,
+               ('chedraui', 'batch'): QUERY_CHEDRAUI_SCRAPER_BATCH}
+    # Without as_of, the filter is left out so the query text (and cache key) stays the same.
+    # The datetime itself is a bind parameter, never part of the text
+    if as_of is None:
+        return queries[(store, snapshot)].format(as_of_filter=''), {}
+    return queries[(store, snapshot)].format(as_of_filter='where scraping_datetime <= :as_of'), {'as_of': str(as_of)}
+
+def query_neta_catalog(logging, min_id=None, cache=None):
+    """Query the Neta products published in homepage
+
+    :param logging: logger
+    :type logging: class
+    :param min_id: if given, only products with a greater Id, defaults to None
+    :type min_id: int, optional
+    :param cache: options of the local query cache, see cached_query, defaults to None
+    :type cache: dict, optional
+    :return: dataframe of the resulting query
+    :rtype: dataframe
+    """
+    if min_id is not None:
+        logging.info(f'Querying Neta products with Id > {min_id}...')
+        return cached_query('prod', QUERY_PRODUCTS_IN_HOMEPAGE_SINCE, logging, {'min_id': int(min_id)}, cache)
+    return cached_query('prod', QUERY_PRODUCTS_IN_HOMEPAGE, logging, cache=cache)
+
+def data_watermark(store=None, as_of=None):
+    """Watermark of the data read by a query stage: newest scraping datetime and rows
+    of the scraper table of a store, or highest Id and rows of the Neta products. It 
+    is not cached: it tells whether the data changed since a checkpoint was saved.
+
+    :param store: store name, None for the Neta catalog, defaults to None
+    :type store: str, optional
+    :param as_of: ignore rows scraped after this datetime, see query_scraped_store, defaults to None
+    :type as_of: str, optional
+    :raises ValueError: Invalid store name
+    :return: values of the watermark, as strings
+    :rtype: dict
+    """
+    if store is None:
+        df = get_backend().query('prod', QUERY_NETA_WATERMARK)
+    else:
+        if store not in _scraper_tables:
+            raise ValueError('Invalid store name in run_params["IO"]["store"]. Check docstring for valid names.')
+        as_of_filter, params = ('', {}) if as_of is None else ('where scraping_datetime <= :as_of', {'as_of': str(as_of)})
+        query = QUERY_SCRAPER_WATERMARK.format(table=_scraper_tables[store], as_of_filter=as_of_filter)
+        df = get_backend().query('data', query, params)
+    return {name: str(value) for name, value in df.iloc[0].items()}
+
+def query_scraped_store_chunks(store, logging, chunk_size, snapshot=None, as_of=None):
+    """Stream scraper results of a store in chunks, so the whole history is 
+    never loaded at once. Results come in the order of the store query. Without
+    an engine (rds without RDS_DATA_URL) the results are queried whole, then split.
+
+    :param store: store name
+    :type store: str
+    :param logging: logger
+    :type logging: class
+    :param chunk_size: rows per chunk
+    :type chunk_size: int
+    :param snapshot: None, 'latest' or 'batch', see query_scraped_store, defaults to None
+    :type snapshot: str, optional
+    :param as_of: ignore rows scraped after this datetime, defaults to None
+    :type as_of: str, optional
+    :yield: chunks of the resulting query
+    :rtype: dataframe
+    """
+    from sqlalchemy import text
+
+    query, params = scraper_query(store, snapshot=snapshot, as_of=as_of)
+
+    engine = get_backend().query_engine('data')
+    if engine is None:
+        # rds without RDS_DATA_URL: netadata returns the whole result at once
+        logging.warning(f'No engine for the data database: scraper results of {store} are read at once, '
+                        f'then processed in chunks of {chunk_size} rows.')
+        df = get_backend().query('data', query, params)
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size]
+        return
+
+    logging.info(f'Streaming scraper results from {store} in chunks of {chunk_size} rows...')
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for chunk in pd.read_sql(text(query), conn, params=params, chunksize=chunk_size):
+            yield chunk
+
+class ParquetChunkWriter:
+    """Write a table to a parquet file, or a partitioned parquet dataset, one chunk 
+    at a time. The schema is taken from the first chunk, with empty columns stored 
+    as strings, and later chunks are cast to it (missing columns are left empty).
+
+    :param path: parquet file, or directory of the dataset if partition_cols are given
+    :type path: str
+    :param partition_cols: columns to partition the dataset by, as in write_table. 
+        Existing partitions with the values of the first chunk are replaced, defaults to None
+    :type partition_cols: list, optional
+    """
+
+    def __init__(self, path, partition_cols=None):
+        self.path = path
+        self.partition_cols = partition_cols
+        self.rows = 0
+        self.schema = None
+        self._writer = None
+        self._chunks = 0
+
+    def write(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if df.empty:
+            return
+        df = prep.widen_floats(df)
+        # Categories change between chunks: store plain values
+        df = df.astype({c: object for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)})
+        if self.schema is None:
+            self.schema = self._schema(df)
+            if self.partition_cols:
+                # Remove previous runs of the same partitions, as write_table
+                for values in df[self.partition_cols[:1]].drop_duplicates().itertuples(index=False):
+                    shutil.rmtree(os.path.join(self.path, f'{self.partition_cols[0]}={values[0]}'), ignore_errors=True)
+                os.makedirs(self.path, exist_ok=True)
+            else:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._writer = pq.ParquetWriter(self.path, self.schema)
+
+        df = df.reindex(columns=self.schema.names)
+        # Text columns may be all missing in a chunk (a float column)
+        text = [f.name for f in self.schema if pa.types.is_string(f.type) or pa.types.is_large_string(f.type)]
+        df = df.assign(**{c: df[c].astype(object).where(df[c].notna(), None) for c in text})
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        if self.partition_cols:
+            pq.write_to_dataset(table, self.path, partition_cols=self.partition_cols,
+                                basename_template=f'chunk-{self._chunks}-{{i}}.parquet')
+        else:
+            self._writer.write_table(table)
+        self._chunks += 1
+        self.rows += len(df)
+
+    def _schema(self, df):
+        import pyarrow as pa
+
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        for i, field in enumerate(schema):
+            if pa.types.is_null(field.type):
+                schema = schema.set(i, field.with_type(pa.string()))
+        return schema
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class LocalChunkWriter(ParquetChunkWriter):
+    """Write a final table of a store one chunk at a time, in the partitioned parquet 
+    layout of save_local (path/store=<store>/<category>=<value>/). Each chunk adds a 
+    file to the partitions of its categories. Labels are stored as plain strings: 
+    dictionaries of different files could not be read back as one categorical.
+
+    :param path: directory of the dataset, e.g. './data/processed/aurrera_neta_products'
+    :type path: str
+    :param store: store name, used as partition
+    :type store: str
+    :param category: category column, used as partition
+    :type category: str
+    """
+
+    def __init__(self, path, store, category):
+        super().__init__(path, partition_cols=['store', category])
+        self.store = store
+
+    def write(self, df):
+        super().write(df.assign(store=self.store))
+
+_cache_lock = threading.Lock()
+
+def cached_query(db, query, logging, params=None, cache=None):
+    """Run a query of the current backend through a local cache. Results are stored 
+    as parquet files keyed by backend, connection name, query text and parameters, expire after a TTL and
+    the least recently used are evicted when the cache is too large.
+
+    :param db: logical database name: 'data', 'prod'
+    :type db: str
+    :param query: query text, with bind parameters as :name
+    :type query: str
+    :param logging: logger
+    :type logging: class
+    :param params: values of the bind parameters of the query, defaults to None
+    :type params: dict, optional
+    :param cache: cache options, defaults to None (no cache):
+        'enabled' (bool), 'ttl' (seconds, default 3600), 'max_size_mb' (default 2048),
+        'refresh' (bool, query again and replace the entry) and 'path' (default PATH_CACHE)
+    :type cache: dict, optional
+    :return: dataframe of the resulting query
+    :rtype: dataframe
+    """
+    params = params or {}
+    if not cache or not cache.get('enabled', False):
+        return get_backend().query(db, query, params)
+
+    path = cache.get('path', PATH_CACHE)
+    key = hashlib.sha256(json.dumps([get_backend().name, db, query, params], sort_keys=True, default=str).encode()).hexdigest()
+    cache_file = os.path.join(path, f'{key}.parquet')
+
+    with _cache_lock:
+        index = _load_cache_index(path)
+        entry = index.get(key)
+        now = time.time()
+        fresh = (entry is not None and os.path.exists(cache_file)
+                 and now - entry['created'] < cache.get('ttl', 3600))
+
+        if fresh and not cache.get('refresh', False):
+            logging.info(f'Query cache hit for {db}: {key[:12]}')
+            entry['last_access'] = now
+            _save_cache_index(path, index)
+            return pd.read_parquet(cache_file)
+
+    logging.info(f'Query cache {"refresh" if fresh else "miss"} for {db}: {key[:12]}')
+    df = get_backend().query(db, query, params)
+
+    with _cache_lock:
+        try:
+            os.makedirs(path, exist_ok=True)
+            df.to_parquet(cache_file)
+        except Exception as e:
+            logging.warning(f'Could not cache query result: {e}')
+            return df
+
+        index = _load_cache_index(path)
+        index[key] = {'db': db, 'created': now, 'last_access': now,
+                      'size': os.path.getsize(cache_file)}
+        _evict_cache(path, index, cache.get('max_size_mb', 2048) * 1e6, logging)
+        _save_cache_index(path, index)
+
+    return df
+
+def _load_cache_index(path):
+    index_file = os.path.join(path, 'index.json')
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file) as f:
+        return json.load(f)
+
+def _save_cache_index(path, index):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=4)
+
+def _evict_cache(path, index, max_size, logging):
+    """Remove the least recently used entries until the cache fits in max_size bytes"""
+    total = sum(entry['size'] for entry in index.values())
+    for key in sorted(index, key=lambda k: index[k]['last_access']):
+        if total <= max_size:
+            break
+        total -= index[key]['size']
+        del index[key]
+        try:
+            os.remove(os.path.join(path, f'{key}.parquet'))
+        except FileNotFoundError:
+            pass
+        logging.info(f'Evicted query cache entry {key[:12]}')
+
+_watermark_lock = threading.Lock()
+
+def load_watermark(store, path=PATH_WATERMARKS):
+    """Read the watermark of the last incremental run of a store
+
+    :param store: store name
+    :type store: str
+    :param path: json file with watermarks of all stores, defaults to PATH_WATERMARKS
+    :type path: str, optional
+    :return: 'scraping_datetime' and 'neta_id' of the last run. Empty if there is no run yet
+    :rtype: dict
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get(store, {})
+
+def save_watermark(store, watermark, path=PATH_WATERMARKS):
+    """Save the watermark of an incremental run of a store
+
+    :param store: store name
+    :type store: str
+    :param watermark: 'scraping_datetime' and 'neta_id' of the run
+    :type watermark: dict
+    :param path: json file with watermarks of all stores, defaults to PATH_WATERMARKS
+    :type path: str, optional
+    """
+    # Stores run in parallel share the file: read, update and replace it one at a time
+    with _watermark_lock:
+        watermarks = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                watermarks = json.load(f)
+        watermarks[store] = watermark
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(watermarks, f, indent=4)
+        os.replace(f'{path}.tmp', path)
+
+def _snapshot_file(store, path):
+    return os.path.join(path, f'{store}_snapshot.parquet')
+
+def has_snapshot(store, path=PATH_SNAPSHOTS):
+    """Whether a store has the final table of an incremental run, without reading it
+
+    :param store: store name
+    :type store: str
+    :param path: directory of snapshots, defaults to PATH_SNAPSHOTS
+    :type path: str, optional
+    :rtype: bool
+    """
+    return os.path.exists(_snapshot_file(store, path))
+
+def load_snapshot(store, path=PATH_SNAPSHOTS):
+    """Read the final table of the last incremental run of a store
+
+    :param store: store name
+    :type store: str
+    :param path: directory of snapshots, defaults to PATH_SNAPSHOTS
+    :type path: str, optional
+    :return: final table, or None if there is no run yet
+    :rtype: dataframe
+    """
+    if not has_snapshot(store, path):
+        return None
+    return pd.read_parquet(_snapshot_file(store, path))
+
+def save_snapshot(store, df, path=PATH_SNAPSHOTS):
+    """Save the final table of an incremental run of a store
+
+    :param store: store name
+    :type store: str
+    :param df: final table
+    :type df: dataframe
+    :param path: directory of snapshots, defaults to PATH_SNAPSHOTS
+    :type path: str, optional
+    """
+    os.makedirs(path, exist_ok=True)
+    snapshot_file = _snapshot_file(store, path)
+    df.to_parquet(f'{snapshot_file}.tmp')
+    os.replace(f'{snapshot_file}.tmp', snapshot_file)
+
+def get_engine(db):
+    """SQLAlchemy engine of the current backend for statements that push_table does 
+    not cover (e.g. deletes). For rds the url is read from the environment variable 
+    RDS_<DB>_URL, e.g. RDS_DATA_URL
+
+    :param db: logical database name: 'data', 'prod'
+    :type db: str
+    :return: engine, or None if the backend writes files, or pushes through netadata 
+        (rds without the url), instead
+    :rtype: sqlalchemy.engine.Engine
+    """
+    return get_backend().engine(db)
+
+def upsert_table(df, table_name, db, key_cols, logging):
+    """Replace the rows of table_name sharing a key with df. Rows are pushed to
+    a staging table, then deleted and inserted in a single transaction. Without an 
+    engine (see get_engine) the table is read, updated in pandas and pushed whole.
+
+    :param df: rows to upsert
+    :type df: dataframe
+    :param table_name: destination table
+    :type table_name: str
+    :param db: logical database name: 'data', 'prod'
+    :type db: str
+    :param key_cols: columns identifying the rows to replace. A row of table_name is 
+        replaced if any of its keys is found in df. Missing keys never match
+    :type key_cols: list
+    :param logging: logger
+    :type logging: class
+    """
+    from sqlalchemy import text
+
+    engine = get_engine(db)
+    if engine is None:
+        current = get_backend().query(db, f'select * from {table_name}')
+        replaced = pd.Series(False, index=current.index)
+        for k in key_cols:
+            # As SQL in: a missing key matches nothing
+            replaced |= current[k].notna() & current[k].isin(df[k].dropna())
+        push_table(pd.concat([current[~replaced], df], ignore_index=True), table_name, db, if_exists = 'replace')
+        logging.info(f'Upserted {len(df)} rows in {table_name} ({replaced.sum()} replaced).')
+        return
+
+    # Unique, so writers of the same table at the same time do not share a staging table
+    staging = f'{table_name}_staging_{uuid.uuid4().hex[:8]}'
+    push_table(df, staging, db, if_exists = 'replace')
+
+    quote = engine.dialect.identifier_preparer.quote
+    cols = ', '.join(quote(c) for c in df.columns)
+    keys = ' or '.join(f'{quote(k)} in (select {quote(k)} from {quote(staging)})' for k in key_cols)
+
+    with engine.begin() as conn:
+        deleted = conn.execute(text(f'delete from {quote(table_name)} where {keys}')).rowcount
+        conn.execute(text(f'insert into {quote(table_name)} ({cols}) select {cols} from {quote(staging)}'))
+        conn.execute(text(f'drop table {quote(staging)}'))
+
+    logging.info(f'Upserted {len(df)} rows in {table_name} ({deleted} replaced).')
+
+# Bound parameters allowed in one statement, by dialect
+_max_params = {'mysql': 65_535}
+
+def bulk_replace_table(df, table_name, db, logging, batch_size=10_000):
+    """Replace table_name with df. Rows are loaded in batches into a staging table 
+    (COPY on PostgreSQL, multi-row inserts on MySQL) and the staging table is 
+    swapped with table_name in a single transaction, so readers see either the 
+    old or the new table. If loading fails, table_name is left untouched. Without 
+    an engine (see get_engine) the table is pushed whole with push_table.
+
+    :param df: rows of the new table
+    :type df: dataframe
+    :param table_name: destination table
+    :type table_name: str
+    :param db: logical database name: 'data', 'prod'
+    :type db: str
+    :param logging: logger
+    :type logging: class
+    :param batch_size: rows per committed batch, defaults to 10_000
+    :type batch_size: int, optional
+    """
+    if get_engine(db) is None:
+        push_table(df, table_name, db, if_exists = 'replace')
+        logging.info(f'Replaced {table_name} with {len(df)} rows.')
+        return
+
+    start = time.perf_counter()
+    writer = TableChunkWriter(table_name, db, logging, batch_size, total_rows=len(df))
+    try:
+        writer.write(df)
+    except Exception:
+        writer.abort()
+        raise
+    writer.commit()
+
+    seconds = time.perf_counter() - start
+    logging.info(f'Replaced {table_name} with {len(df)} rows in {seconds:.1f} s '
+                 f'({len(df) / max(seconds, 1e-9):.0f} rows/s).')
+
+
+class TableChunkWriter:
+    """Replace a table with rows written one chunk at a time, as bulk_replace_table: 
+    chunks are loaded in batches into a staging table, swapped with the table by 
+    commit, so readers see the old table until the last chunk is loaded and a failed 
+    load (abort) leaves it untouched. Without an engine (see get_engine) chunks are 
+    kept in a local parquet file and commit pushes the whole table with push_table.
+
+    :param table_name: destination table
+    :type table_name: str
+    :param db: logical database name: 'data', 'prod'
+    :type db: str
+    :param logging: logger
+    :type logging: class
+    :param batch_size: rows per committed batch, defaults to 10_000
+    :type batch_size: int, optional
+    :param total_rows: rows expected, only to log the progress, defaults to None
+    :type total_rows: int, optional
+    """
+
+    def __init__(self, table_name, db, logging, batch_size=10_000, total_rows=None):
+        self.table_name = table_name
+        self.db = db
+        self.logging = logging
+        self.batch_size = batch_size
+        self.total_rows = total_rows
+        self.rows = 0
+        self.engine = get_engine(db)
+        # Unique, so writers of the same table at the same time do not share a staging table
+        self.staging = f'{table_name}_staging_{uuid.uuid4().hex[:8]}'
+        self._columns = None
+        self._local = None
+
+    def write(self, df):
+        from sqlalchemy import text
+
+        df = prep.widen_floats(df)
+        if self._columns is None:
+            self._columns = df.head(0)
+            if self.engine is None:
+                self._local = ParquetChunkWriter(os.path.join(tempfile.mkdtemp(prefix='varietybenchmark_'),
+                                                              f'{self.staging}.parquet'))
+            else:
+                with self.engine.begin() as conn:
+                    conn.execute(text(f'drop table if exists {self._quote(self.staging)}'))
+                    self._columns.to_sql(self.staging, conn, index=False)
+
+        if self.engine is None:
+            self._local.write(df)
+            self.rows += len(df)
+            return
+
+        dialect = self.engine.dialect.name
+        for begin in range(0, len(df), self.batch_size):
+            batch = df.iloc[begin:begin + self.batch_size]
+            with self.engine.begin() as conn:
+                if dialect == 'postgresql':
+                    _copy_rows(conn, batch, self.staging, self._quote)
+                elif dialect == 'sqlite':
+                    # No round trips to save: executemany is faster than multi-row inserts
+                    batch.to_sql(self.staging, conn, if_exists='append', index=False)
+                else:
+                    rows = max(1, _max_params.get(dialect, 999) // max(1, len(df.columns)))
+                    batch.to_sql(self.staging, conn, if_exists='append', index=False, method='multi', chunksize=rows)
+            self.rows += len(batch)
+            total = f'/{self.total_rows}' if self.total_rows is not None else ''
+            self.logging.info(f'{self.table_name}: loaded {self.rows}{total} rows')
+
+    def commit(self):
+        """Replace the table with the chunks written"""
+        if self._columns is None:
+            return
+        if self.engine is not None:
+            _swap_tables(self.engine, self.staging, self.table_name)
+            return
+
+        self._local.close()
+        df = pd.read_parquet(self._local.path) if os.path.exists(self._local.path) else self._columns
+        push_table(df, self.table_name, self.db, if_exists = 'replace')
+        shutil.rmtree(os.path.dirname(self._local.path), ignore_errors=True)
+
+    def abort(self):
+        """Drop the chunks written, the table is left untouched"""
+        from sqlalchemy import text
+
+        if self._columns is None:
+            return
+        if self.engine is not None:
+            with self.engine.begin() as conn:
+                conn.execute(text(f'drop table if exists {self._quote(self.staging)}'))
+            return
+        self._local.close()
+        shutil.rmtree(os.path.dirname(self._local.path), ignore_errors=True)
 
-def save_aurrera(neta_aurrera, logging):
+    def _quote(self, name):
+        return self.engine.dialect.identifier_preparer.quote(name)
+
+def _copy_rows(conn, df, table_name, quote):
+    """Load df into table_name with COPY through the DBAPI connection of conn"""
+    import io
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cols = ', '.join(quote(c) for c in df.columns)
+    sql = f'copy {quote(table_name)} ({cols}) from stdin with csv'
+    cursor = conn.connection.cursor()
+    if hasattr(cursor, 'copy_expert'):
+        cursor.copy_expert(sql, buffer)
+    else:
+        # pg8000
+        cursor.execute(sql, stream=buffer)
+
+def _swap_tables(engine, staging, table_name):
+    """Atomically replace table_name with staging"""
+    from sqlalchemy import text, inspect
+
+    quote = engine.dialect.identifier_preparer.quote
+    exists = inspect(engine).has_table(table_name)
+
+    if engine.dialect.name == 'mysql':
+        # DDL is not transactional in MySQL, but a multi-table rename is atomic
+        old = f'{staging}_old'
+        with engine.begin() as conn:
+            conn.execute(text(f'drop table if exists {quote(old)}'))
+            if exists:
+                conn.execute(text(f'rename table {quote(table_name)} to {quote(old)}, {quote(staging)} to {quote(table_name)}'))
+                conn.execute(text(f'drop table {quote(old)}'))
+            else:
+                conn.execute(text(f'rename table {quote(staging)} to {quote(table_name)}'))
+        return
+
+    with engine.begin() as conn:
+        if exists:
+            conn.execute(text(f'drop table {quote(table_name)}'))
+        conn.execute(text(f'alter table {quote(staging)} rename to {quote(table_name)}'))
+
+def save_aurrera(neta_aurrera, logging, fmt='parquet', excel=False, batch_size=10_000, charts=True, chart_workers=2,
+                 history=True, history_products=False, run_ts=None):
     """Save processed data locally and remotely for BA. Additionally, 
     split and save tables depending on the existence of products in BA or in Neta
 
@@ -61,27 +845,72 @@ def save_aurrera(neta_aurrera, logging):
     :type neta_aurrera: dataframe
     :param logging: logger 
     :type logging: class
+    :param fmt: local file format: 'parquet', 'feather', 'csv' or 'xlsx', defaults to 'parquet'.
+        Parquet files are partitioned by store and category
+    :type fmt: str, optional
+    :param excel: also export the local files as .xlsx, defaults to False
+    :type excel: bool, optional
+    :param batch_size: rows per batch written to rds, defaults to 10_000
+    :type batch_size: int, optional
+    :param charts: render the charts of coincidences in the background (see vis.wait_charts), 
+        defaults to True
+    :type charts: bool, optional
+    :param chart_workers: processes rendering charts, defaults to 2
+    :type chart_workers: int, optional
+    :param history: append coincidences, price gap summary and assortment of the run 
+        to the history store (see history.append), defaults to True
+    :type history: bool, optional
+    :param history_products: also append the matched products, defaults to False
+    :type history_products: bool, optional
+    :param run_ts: timestamp of the run in the history, defaults to None (now)
+    :type run_ts: str, optional
     """
     
-    # save plot of percentage of product coincidences
-    vis.plot_ba_percentage_coincidences(neta_aurrera, logging)
-    
+    # save percentage of product coincidences per category and subcategory, and its charts
+    with profiling.stage('coincidences', len(neta_aurrera)):
+        coincidences = vis.coincidence_table(neta_aurrera, 'BA_category', 'BA_subcategory')
+        write_table(coincidences, './data/processed/aurrera_coincidences', fmt)
+    if charts:
+        vis.submit_charts(vis.chart_specs(coincidences, 'BA_category', 'BA_subcategory', 'Bodega Aurrerá',
+                                          'BA_coincidencias.jpg', './data/figures/aurrera'),
+                          logging, chart_workers)
+
+    # save price gaps of the products in both catalogs and their distribution per category
+    with profiling.stage('price_gaps', len(neta_aurrera)):
+        gaps = pricing.price_gaps(neta_aurrera)
+        gap_summary = pricing.gap_summary(gaps)
+        write_table(gaps, './data/interim/aurrera_price_gaps', fmt)
+        write_table(gap_summary, './data/processed/aurrera_price_gap_summary', fmt)
+
     # push to Data BI db
     table_name = remote_db_names['aurrera']
     logging.info(f'Pushing table to destination in rds: {table_name}')
-    push_table(neta_aurrera, table_name, 'data', if_exists = 'replace')
+    with profiling.stage('push_table', len(neta_aurrera)):
+        bulk_replace_table(neta_aurrera, table_name, 'data', logging, batch_size)
+    
+    # keep the tables of this run in the history, to follow them over time. Only once
+    # pushed: a failed run is not part of the history
+    if history:
+        tables = {'coincidences': coincidences, 'price_gap_summary': gap_summary,
+                  'assortment': assortment(neta_aurrera, 'BA_category')}
+        if history_products:
+            tables['products'] = neta_aurrera
+        save_history(tables, 'aurrera', logging, run_ts)
     
     # save final dataframe locally
     logging.info('Saving files locally...')
-    neta_aurrera.to_excel('./data/processed/aurrera_neta_products.xlsx')
     
     # Coincidences with aurrera
     yes_from_aurrera = neta_aurrera[neta_aurrera.is_in=='ambos']
-    yes_from_aurrera.to_excel('./data/interim/ba_products_coincidence.xlsx')
     
     # Products only in aurrera catalog
     no_from_aurrera =  neta_aurrera[neta_aurrera.is_in=='BA']
-    no_from_aurrera.to_excel('./data/interim/ba_products_no_coincidence.xlsx')
+
+    with profiling.stage('write_local', len(neta_aurrera)):
+        for df, path in [(neta_aurrera, './data/processed/aurrera_neta_products'),
+                         (yes_from_aurrera, './data/interim/ba_products_coincidence'),
+                         (no_from_aurrera, './data/interim/ba_products_no_coincidence')]:
+            save_local(df, path, 'aurrera', 'BA_category', fmt, excel)
     
     # Additional information about categories
     # print coincidences of categories
@@ -89,25 +918,107 @@ def save_aurrera(neta_aurrera, logging):
 
     return
 
-def save_chedraui(df, logging):
+def save_chedraui(df, logging, fmt='parquet', excel=False, batch_size=10_000, history=True,
+                  history_products=False, run_ts=None, **kwargs):
     """Save processed data locally and remotely for Chedraui
 
     :param df: final dataframe of products for chedraui
     :type df: dataframe
     :param logging: logger
     :type logging: class
+    :param fmt: local file format: 'parquet', 'feather', 'csv' or 'xlsx', defaults to 'parquet'.
+        Parquet files are partitioned by store and category
+    :type fmt: str, optional
+    :param excel: also export the local files as .xlsx, defaults to False
+    :type excel: bool, optional
+    :param batch_size: rows per batch written to rds, defaults to 10_000
+    :type batch_size: int, optional
+    :param history: append the assortment of the run to the history store, defaults to True
+    :type history: bool, optional
+    :param history_products: also append the products, defaults to False
+    :type history_products: bool, optional
+    :param run_ts: timestamp of the run in the history, defaults to None (now)
+    :type run_ts: str, optional
+    :param kwargs: options of save_aurrera that do not apply to Chedraui (charts)
+    :type kwargs: dict, optional
     """    
+
     # push to Data BI db
     table_name = remote_db_names['chedraui']
     logging.info(f'Pushing table to destination in rds: {table_name}')
-    push_table(df, table_name, 'data', if_exists = 'replace')
+    with profiling.stage('push_table', len(df)):
+        bulk_replace_table(df, table_name, 'data', logging, batch_size)
     
+    # keep the assortment of this run in the history, once pushed
+    if history:
+        tables = {'assortment': assortment(df, 'CH_input_category')}
+        if history_products:
+            tables['products'] = df
+        save_history(tables, 'chedraui', logging, run_ts)
+
     # save final datafram locally
     logging.info('Saving files locally...')
-    df.to_excel('./data/processed/chedraui_products.xlsx')
+    with profiling.stage('write_local', len(df)):
+        save_local(df, './data/processed/chedraui_products', 'chedraui', 'CH_input_category', fmt, excel)
     
     return
 
+def assortment(df, category):
+    """Number of products per category of a store. Neta only products are left out
+
+    :param df: final table of a store
+    :type df: dataframe
+    :param category: category column of the store
+    :type category: str
+    :return: category and 'n_products'
+    :rtype: dataframe
+    """
+    rows = df[df[category].notna()]
+    return rows.groupby(category, observed=True).size().rename('n_products').reset_index()
+
+def save_history(tables, store, logging, run_ts=None):
+    """Append the tables of a run of a store to the history store
+
+    :param tables: dataframe of each history table, e.g. {'coincidences': df}
+    :type tables: dict
+    :param store: store name
+    :type store: str
+    :param logging: logger
+    :type logging: class
+    :param run_ts: timestamp of the run, defaults to None (now)
+    :type run_ts: str, optional
+    """
+    run_ts = run_ts or history.run_timestamp()
+    with profiling.stage('history', sum(len(df) for df in tables.values())):
+        for table, df in tables.items():
+            history.append(prep.widen_floats(df), table, store, run_ts)
+    logging.info(f'Run {run_ts} of {store} added to the history: {", ".join(tables)}')
+
+def save_local(df, path, store, category, fmt, excel):
+    """Save a final table of a store in fmt and, optionally, as .xlsx
+
+    :param df: final table
+    :type df: dataframe
+    :param path: destination without extension
+    :type path: str
+    :param store: store name, used as partition in parquet
+    :type store: str
+    :param category: category column, used as partition in parquet
+    :type category: str
+    :param fmt: 'parquet', 'feather', 'csv' or 'xlsx'
+    :type fmt: str
+    :param excel: also export as .xlsx
+    :type excel: bool
+    """
+    if fmt == 'parquet':
+        write_table(df.assign(store=store), path, fmt, partition_cols=['store', category],
+                    category_cols=category_columns)
+    else:
+        write_table(df, path, fmt, category_cols=category_columns)
+
+    if excel and fmt != 'xlsx':
+        write_table(df, path, 'xlsx')
+
 
 QUERY_PRODUCTS_IN_HOMEPAGE = """select 
 p.Id,
@@ -160,4 +1071,187 @@ QUERY_CHEDRAUI_SCRAPER = """
 select *
 
 from dataprocessing.benchmark_chedraui
-"""
\ No newline at end of file
+"""
+
+QUERY_PRODUCTS_IN_HOMEPAGE_SINCE = """select 
+p.Id,
+p.Sku,
+p.Gtin,
+p.Name,
+p.Price,
+pcm.Id as catId,
+cat.Name as category
+
+from netamx.Product p
+    left join product_category_mapping pcm
+    on p.Id = pcm.ProductId
+    left join category cat
+    on pcm.CategoryId = cat.Id
+
+    where p.Id > :min_id
+    and p.Sku not like '%F1%'
+    and p.Sku not like '%F2%'
+    and p.Sku not like '%SP%'
+    and p.Sku not like '%LB%'
+    and p.Deprecated != 1
+    and p.Deleted != 1
+    and p.Published = 1
+    order by p.Id Desc;
+"""
+
+QUERY_BA_SCRAPER_SINCE = """
+select 
+
+ean,
+product_id,
+product_name,
+category,
+subcategory,
+normal_price,
+current_price,
+url,
+scraping_datetime
+
+from dataprocessing.benchmark_aurrera
+
+where scraping_datetime > :since
+
+order by scraping_datetime desc
+"""
+
+QUERY_CHEDRAUI_SCRAPER_SINCE = """
+select *
+
+from dataprocessing.benchmark_chedraui
+
+where scraping_datetime > :since
+
+order by scraping_datetime desc
+"""
+
+# Newest row of each product, by the identifier the pipeline matches on (ean for
+# Aurrera, upc for Chedraui). Rows without one are dropped by preprocessing anyway.
+# as_of_filter limits the rows to a point in time
+QUERY_BA_SCRAPER_LATEST = """
+select 
+
+ean,
+product_id,
+product_name,
+category,
+subcategory,
+normal_price,
+current_price,
+url,
+scraping_datetime
+
+from (
+    select 
+    ean, product_id, product_name, category, subcategory,
+    normal_price, current_price, url, scraping_datetime,
+    row_number() over (partition by ean order by scraping_datetime desc) as newest
+
+    from dataprocessing.benchmark_aurrera
+    {as_of_filter}
+) products
+
+where newest = 1
+
+order by scraping_datetime desc
+"""
+
+# Rows of the newest scraping day
+QUERY_BA_SCRAPER_BATCH = """
+select 
+
+ean,
+product_id,
+product_name,
+category,
+subcategory,
+normal_price,
+current_price,
+url,
+scraping_datetime
+
+from (
+    select 
+    ean, product_id, product_name, category, subcategory,
+    normal_price, current_price, url, scraping_datetime,
+    max(date(scraping_datetime)) over () as last_batch
+
+    from dataprocessing.benchmark_aurrera
+    {as_of_filter}
+) products
+
+where date(scraping_datetime) = last_batch
+
+order by scraping_datetime desc
+"""
+
+QUERY_CHEDRAUI_SCRAPER_LATEST = """
+select 
+
+upc,
+product_name,
+input_category,
+category,
+sub_category_1,
+sub_category_2,
+normal_price,
+url,
+scraping_datetime
+
+from (
+    select 
+    upc, product_name, input_category, category, sub_category_1,
+    sub_category_2, normal_price, url, scraping_datetime,
+    row_number() over (partition by upc order by scraping_datetime desc) as newest
+
+    from dataprocessing.benchmark_chedraui
+    {as_of_filter}
+) products
+
+where newest = 1
+"""
+
+QUERY_CHEDRAUI_SCRAPER_BATCH = """
+select 
+
+upc,
+product_name,
+input_category,
+category,
+sub_category_1,
+sub_category_2,
+normal_price,
+url,
+scraping_datetime
+
+from (
+    select 
+    upc, product_name, input_category, category, sub_category_1,
+    sub_category_2, normal_price, url, scraping_datetime,
+    max(date(scraping_datetime)) over () as last_batch
+
+    from dataprocessing.benchmark_chedraui
+    {as_of_filter}
+) products
+
+where date(scraping_datetime) = last_batch
+"""
+
+# Cheap summaries of the tables read by the query stages: rows added or removed change
+# them, so the checkpoints of a stage are not resumed once its data changed
+QUERY_SCRAPER_WATERMARK = """
+select max(scraping_datetime) as max_scraping_datetime, count(*) as n_rows
+
+from {table}
+{as_of_filter}
+"""
+
+QUERY_NETA_WATERMARK = """
+select max(p.Id) as max_id, count(*) as n_rows
+
+from netamx.Product p
+"""
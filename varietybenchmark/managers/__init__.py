@@ -1 +1,8 @@
-from .managers import *
\ No newline at end of file
+import importlib
+
+
+def __getattr__(name):
+    # Names of the managers module, imported on first use
+    if name.startswith('__'):
+        raise AttributeError(name)
+    return getattr(importlib.import_module('.managers', __name__), name)
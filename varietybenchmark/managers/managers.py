@@ -1,11 +1,17 @@
-import pandas as pd
-from ..ion import ion
 import datetime
-import pickle
-from ..preprocessing import preprocessing as prep
+from ..profiling import profiling
+from ..config import PATH_PROFILES, PATH_CHECKPOINTS
 import logging
-from netadata.ion import query_rds
-import sys
+import time
+import os
+import json
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+class FetchCancelled(Exception):
+    """A source stopped loading because another source of the run failed"""
+
 
 class Manager:
     ## Main class managers inherit from. DO NOT use this as template, use ManagerTemplate below
@@ -33,41 +39,107 @@ class Manager:
         return 
 
     def save_run_file(self, path : str):
-        """ Saves runfile to path
+        """ Saves a JSON run manifest to path: run parameters, package version and, 
+        if the manager keeps checkpoints, the location of the artifacts of the last run
         Args:
-            path (str): [description]
+            path (str): destination file, e.g. '../data/runfiles/run.json'
         """
+        from ..checkpoints import checkpoints
 
-        self.run_params['savetime'] = datetime.datetime.now().strptime('$Y-$m-$d')
+        self.run_params['savetime'] = datetime.datetime.now().isoformat(timespec='seconds')
         self.run_params['version'] = self.version
-        pickle.dump(self.run_params, open(path, 'wb'))
+        manifest = {'version': self.version, 'run_params': self.run_params}
+
+        checkpoint_store = getattr(self, 'checkpoint_store', None)
+        if checkpoint_store is not None:
+            manifest.update(run_id=checkpoint_store.run_id, resumed_from=checkpoint_store.resume_from,
+                            stages=checkpoint_store.manifest['stages'])
+        checkpoints.write_manifest(manifest, path)
         
 
     def load_run_file(self, path : str):
-        """Loads runfile to manager
+        """Loads the run parameters of a run manifest (saved by save_run_file, or the 
+        manifest.json of a run in PATH_CHECKPOINTS) to manager
 
         Args:
-            path (str): path to file
+            path (str): path to file, or directory of a run
+
+        Returns:
+            dict: the whole manifest
         """
-        self.run_params = pickle.load(self.run_params, open(path, 'rb'))
+        from ..checkpoints import checkpoints
+        manifest = checkpoints.load_manifest(path)
+        self.run_params = manifest['run_params']
+        return manifest
 
 
 
 
 class VarietyBenchmark(Manager): #Use this template to make your own experiment
     log = ''
-    version = (0,1,4) # Everytime you change something in the code, please update this so we can keep track of changes
+    version = (0,1,60) # Everytime you change something in the code, please update this so we can keep track of changes
     run_params = {
                     'name':'', # To identify between run files
                     'description':"""A manager to read scraper files and return data frames of product's coincidences""",
-                    'data' : {}, # Targets, features, models, etc....
+                    'data' : {
+                        # Match by product name the products left without a Gtin match,
+                        # comparing only categories that already share exact matches
+                        'fuzzy': {'enabled': False, 'k': 1, 'min_score': 0.8},
+                        }, # Targets, features, models, etc....
                     'IO':{
                         # Specify store to analize: 'aurrera', 'chedraui', 'scorpion', 'walmart'
                         'store': "aurrera", 
+                        # Only re-match rows scraped (or Neta products added) since the last run
+                        # and upsert them into the destination table
+                        'incremental': False,
+                        # Stores and number of parallel workers used by run_many
+                        'stores': ['aurrera', 'chedraui'],
+                        'workers': 4,
+                        # Local files: 'parquet' (partitioned by store and category), 'feather', 'csv' or 'xlsx'
+                        'format': 'parquet',
+                        # Also export local files as .xlsx
+                        'excel_export': False,
+                        # Local cache of RDS reads. Set 'refresh' to query again and replace cached results
+                        'cache': {'enabled': False, 'ttl': 3600, 'max_size_mb': 2048, 'refresh': False},
+                        # Read, match and save the scraper history in chunks of chunk_size rows
+                        'streaming': False,
+                        'chunk_size': 100_000,
+                        # Scraped rows to use: None (whole history), 'latest' (newest row of each product)
+                        # or 'batch' (newest scraping day), as of a datetime (None for now)
+                        'snapshot': None,
+                        'as_of': None,
+                        # Save a cProfile ('cprofile') or pyinstrument ('pyinstrument') dump of the run
+                        'profile': False,
+                        # Rows per batch when replacing the tables in rds
+                        'batch_size': 10_000,
+                        # Source of queries and destination of tables: {'kind': 'rds'}, 
+                        # {'kind': 'sql', 'urls': {'data': ..., 'prod': ...}} or {'kind': 'snapshot', 'path': ...}.
+                        # Each database gets one pooled engine per run, with the settings in 'pool'
+                        'backend': {'kind': 'rds', 'pool': {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 30,
+                                                            'pool_pre_ping': True, 'pool_recycle': 1800}},
+                        # Render the charts of coincidences in a pool of processes, off the critical path.
+                        # Processes are spawned: scripts calling run() need an `if __name__ == '__main__':` guard
+                        'charts': True,
+                        'chart_workers': 2,
+                        # Append the tables of each run to the history store (PATH_HISTORY), 
+                        # optionally with all the products
+                        'history': True,
+                        'history_products': False,
+                        # Save the output of each stage (query_scrape, preprocess, load_neta, match) 
+                        # in PATH_CHECKPOINTS, keeping the newest 'keep' runs, to resume later runs from
+                        'checkpoints': {'enabled': False, 'keep': 5},
+                        # Run id (or 'latest') whose stages are reused when their inputs did not change
+                        'resume_from': None,
                         }, # Path to DBs used, functions to load / save data
                     'version':{}, # Keep track of different versions of the package in case of debug/reproducibility
                     'log':{}
                             }
+    catalog_index = None
+    _catalog_source = None
+    checkpoint_store = None
+    _neta_fingerprint = None
+    # Set when a source fails, so the sources loading at the same time stop
+    _cancel = None
 
 
     def __init__(self, run_params = None ) -> None:
@@ -86,114 +158,824 @@ class VarietyBenchmark(Manager): #Use this template to make your own experiment
 
         # IO: LOAD ----------------------------------------------------
         
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s [%(levelname)s] %(message)s",
-            handlers=[
-                logging.FileHandler("logfile.log"),
-                logging.StreamHandler(sys.stdout)
-            ]
-        )
+        self.setup_logging()
         
         # Store name
         store = self.run_params['IO']['store']
 
+        with self.checkpoint_run(), self.connect_run(), self.profile_run() as profiler, profiling.activate(profiler, store):
+            # Neta is read from 'prod' while the store is read from 'data'
+            with self.fetch_neta([store], profiler) as neta:
+                try:
+                    self.run_store(store, neta)
+                except BaseException:
+                    self._cancel.set()
+                    raise
+
+    def run_many(self, stores=None):
+        """Execute the pipeline for several stores. The Neta catalog is loaded and 
+        indexed once, while each store is queried, preprocessed, matched and saved 
+        in a pool of run_params['IO']['workers'] workers. A failing store does not 
+        stop the others; if Neta fails, the stores stop.
+
+        Args:
+            stores (list, optional): store names. Defaults to run_params['IO']['stores'].
+
+        Returns:
+            dict: for each store, its 'status' ('ok' or 'failed'), 'seconds' and 'error'
+        """
+        self.setup_logging()
+
+        stores = stores or self.run_params['IO'].get('stores', [self.run_params['IO']['store']])
+        workers = self.run_params['IO'].get('workers', len(stores))
+
+        report = {}
+        with self.checkpoint_run(), self.connect_run(), self.profile_run() as profiler, profiling.activate(profiler):
+            with self.fetch_neta(stores, profiler) as neta, ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(self._timed_run_store, store, neta, profiler): store for store in stores}
+                for future in as_completed(futures):
+                    store = futures[future]
+                    report[store] = future.result()
+                    if report[store]['status'] == 'ok':
+                        logging.info(f"{store} finished in {report[store]['seconds']:.1f} s")
+                    else:
+                        logging.error(f"{store} failed after {report[store]['seconds']:.1f} s: {report[store]['error']}")
+
+        self.run_params['log']['stores'] = report
+        return report
+
+    def _timed_run_store(self, store, neta, profiler=None):
+        start = time.perf_counter()
+        try:
+            with profiling.activate(profiler, store):
+                self.run_store(store, neta)
+        except Exception as e:
+            logging.exception(f'Error while resolving for store: {store}')
+            return {'status': 'failed', 'seconds': time.perf_counter() - start, 'error': repr(e)}
+        return {'status': 'ok', 'seconds': time.perf_counter() - start, 'error': None}
+
+    def run_store(self, store, neta):
+        """Query, preprocess, match and save the products of one store
+
+        Args:
+            store (str): store name
+            neta (dataframe or Future): Neta catalog, as returned by load_neta, or the 
+                future of fetch_neta, waited for after the store is preprocessed. Only 
+                needed for stores matched against Neta.
+        """
+        from ..ion import ion
+        from ..preprocessing import preprocessing as prep
+        if store not in store_specs:
+            raise ValueError(f'Impossible to match products for store: {store}')
+
+        incremental = self.run_params['IO'].get('incremental', False)
+
         logging.info('----------------------------')
         logging.info(f'Resolving for store: {store}')
+
+        if self.runs_incremental(store):
+            with profiling.stage('incremental'):
+                # Loaded once here: runs_incremental only checks that the file exists
+                self.run_incremental(store, ion.load_snapshot(store))
+            logging.info('Finished!')
+            return
+
+        if self.run_params['IO'].get('streaming', False):
+            with profiling.stage('streaming'):
+                self.run_streaming(store, self.wait_neta(neta))
+            logging.info(f'Finished {store}!')
+            return
         
-        # Query to db of scraped store
-        scrapeddf = ion.query_scraped_store(store, logging)
+        # Each stage is skipped when the run resumed from has its output for the same inputs
+        def query_scrape():
+            # Query to db of scraped store
+            with profiling.stage('query_scrape') as record:
+                scrapeddf = ion.query_scraped_store(store, logging, cache=self.run_params['IO'].get('cache'),
+                                                    snapshot=self.run_params['IO'].get('snapshot'),
+                                                    as_of=self.run_params['IO'].get('as_of'))
+                record['rows_out'] = len(scrapeddf)
+
+            with profiling.stage('dtypes', len(scrapeddf)):
+                return self.apply_schema(store, scrapeddf)
+
+        start = time.perf_counter()
+        scrapeddf, scrape_fp = self.checkpoint_stage('query_scrape', store, query_scrape, self.query_inputs(store))
+        if self.needs_neta(store):
+            self.check_cancelled(store, neta)
         
         # Read scraped files
         #logging.info('Reading raw scraped file...')
         #scrapeddf = ion.read_scraped_file(store)
         
         # Pre-processing:
-        logging.info('Running preprocessing of data...')
-        dfstore = prep.preprocess_df(store, scrapeddf, logging)
-    
-        # Get data from RDS NETA
-        logging.info('Reading Neta catalog from RDS...')
-        neta = query_rds('prod', ion.QUERY_PRODUCTS_IN_HOMEPAGE, False)    
-        neta = neta[ neta['Gtin'].apply( lambda x: prep.is_int(x)) ]
-        neta['Gtin'] = neta['Gtin'].apply(lambda x: prep.complete_13(x))
-        neta_cols = [ "NETA_"+c for c in neta.columns.to_list()]
-        neta.columns = neta_cols
+        def preprocess():
+            logging.info(f'Running preprocessing of data for {store}...')
+            with profiling.stage('preprocess', len(scrapeddf)) as record:
+                dfstore = prep.preprocess_df(store, scrapeddf, logging)
+                record['rows_out'] = len(dfstore)
+            return dfstore
+
+        dfstore, preprocess_fp = self.checkpoint_stage('preprocess', store, preprocess, scrape_fp)
+        self.log_latency(store, start)
+        if self.needs_neta(store):
+            self.check_cancelled(store, neta)
+        neta = self.wait_neta(neta) if self.needs_neta(store) else None
 
         # IO: Your Work -----------------------------------------------
         
-        # Bodega Aurrerá
-        if str(store) == 'aurrera':
-            
-            logging.info(f'Matching products between Neta and Aurrera...')
+        def match():
+            # Bodega Aurrerá
+            if str(store) == 'aurrera':
+                
+                with profiling.stage('shape_store', len(dfstore)) as record:
+                    deduped = self.shape_store(store, dfstore, neta)
+                    record['rows_out'] = len(deduped)
+
+                logging.info(f'Matching products between Neta and Aurrera...')
+                with profiling.stage('match', len(deduped)) as record:
+                    aur_display_groups = self.add_display_order(store, deduped)
+                    neta_aurrera = self.match_neta(store, aur_display_groups, self.get_catalog_index(neta))
+                    record['rows_out'] = len(neta_aurrera)
+                return neta_aurrera
+
+            elif store == 'chedraui':
+                
+                logging.info(f'Matching products between Neta and Chedraui...')
+                with profiling.stage('match', len(dfstore)) as record:
+                    ched_display_groups = self.add_display_order(store, dfstore)
+                    ched_display_groups.reset_index(inplace=True, drop=True)
+                    record['rows_out'] = len(ched_display_groups)
+                return ched_display_groups
+
+        neta_fp = self._neta_fingerprint if self.needs_neta(store) else None
+        result, match_fp = self.checkpoint_stage('match', store, match, [preprocess_fp, neta_fp])
+
+        # IO: OUT -----------------------------------------------------
+
+        def save():
+            # Save
+            logging.info(f'Saving final tables for {store}...')
             
-            # Add display order, grouped by category
-            # NOTE: This is different to the display_order in benchmark_aurrera, since that 
-            # display_order is not refreshed each time the category changes.
-            aur_display_groups = pd.DataFrame(data=None)
-            for name, group in dfstore.groupby('BA_category'):
-                group['BA_display_order'] = list(range(len(group)))
-                aur_display_groups = pd.concat( [aur_display_groups, group] )
+            if store == 'aurrera':
+                if self.run_params['data'].get('fuzzy', {}).get('enabled', False):
+                    with profiling.stage('fuzzy_match', len(result)) as record:
+                        fuzzy_matches = self.fuzzy_match(store, result)
+                        record['rows_out'] = len(fuzzy_matches)
+
+                with profiling.stage('save', len(result)):
+                    ion.save_aurrera(result, logging, **self.output_options())
+
+                if self.run_params['data'].get('fuzzy', {}).get('enabled', False):
+                    ion.write_table(fuzzy_matches, f'./data/interim/{store}_fuzzy_matches',
+                                    self.output_options()['fmt'])
                 
-            aur_display_groups.sort_values(['BA_category','BA_display_order'], inplace=True)
+            elif store == 'chedraui':
+                with profiling.stage('save', len(result)):
+                    ion.save_chedraui(result, logging, **self.output_options())
+
+        options = {k: v for k, v in self.output_options().items() if k != 'run_ts'}
+        # Never resumed: the destination table may have changed since the run resumed from
+        self.checkpoint_stage('save', store, save, [match_fp, options, self.run_params['data'].get('fuzzy'),
+                                                    ion.get_backend().name], resumable=False)
+
+        if incremental:
+            # Keep state for the next incremental run
+            ion.save_snapshot(store, result)
+            neta_ids = neta['NETA_Id'] if neta is not None else None
+            ion.save_watermark(store, self.get_watermark(scrapeddf, neta_ids))
+            
+        logging.info(f'Finished {store}!')
 
-            # Reorder columns
-            aur_display_groups = aur_display_groups[['BA_ean', 'BA_product_name', 
-                                                     'BA_display_order', 'BA_category', 
-                                                     'BA_subcategory', 'BA_normal_price', 
-                                                     'BA_current_price', 'BA_url']]
-            # Merge tables
-            neta_aurrera = pd.merge(aur_display_groups, neta, right_on='NETA_Gtin', left_on='BA_ean', how='outer', indicator=True)
+    @contextmanager
+    def profile_run(self):
+        """Profile the stages of a run. The summary is kept in run_params['log']['profile'] 
+        and logged as JSON. If run_params['IO']['profile'] is set ('cprofile' or 'pyinstrument'), 
+        a profile of the whole run and the summary are saved in PATH_PROFILES. Charts sent 
+        to render during the run are waited for at the end.
 
-            # Change labels
-            neta_aurrera['_merge'] = neta_aurrera['_merge'].apply(lambda x: prep.say_if_its_in(x))
+        Yields:
+            RunProfiler: profiler of the run
+        """
+        from ..vis import vis
+        from ..history import history
+        profiler = profiling.RunProfiler(logging)
+        # Every store of the run goes to the history under the same timestamp
+        self.run_params['log']['run_ts'] = history.run_timestamp()
+        mode = self.run_params['IO'].get('profile', False)
+        path = os.path.join(PATH_PROFILES, f'profile_{profiling.run_id()}')
+
+        try:
+            with profiling.profile_dump(mode, path, logging):
+                try:
+                    yield profiler
+                finally:
+                    # Charts are rendered off the critical path: wait for them before the run ends
+                    with profiler.stage('wait_charts'):
+                        vis.wait_charts(logging)
+        finally:
+            summary = profiler.summary(self.version)
+            self.run_params['log']['profile'] = summary
+            logging.info('PROFILE ' + json.dumps(summary['totals']))
+            if mode:
+                with open(f'{path}.json', 'w') as f:
+                    json.dump(summary, f, indent=4, default=str)
+
+    @contextmanager
+    def fetch_neta(self, stores, profiler=None):
+        """Load and index the Neta catalog in a background thread, if a store needs it, 
+        so the stores are queried at the same time. Incremental stores only query the 
+        Neta products added since their last run, so they do not need the catalog. Each source normalizes its Gtins 
+        as soon as it arrives. If a source fails, the others stop at their next stage 
+        (a query already sent to the database runs to the end).
 
-            neta_aurrera.rename(columns={'_merge':'is_in'}, inplace=True)
+        Args:
+            stores (list): store names of the run
+            profiler (RunProfiler, optional): profiler of the run. Defaults to None.
 
-            # Fill Nan
-            neta_aurrera['BA_display_order'] = neta_aurrera['BA_display_order'].fillna(-1)
+        Yields:
+            Future: Neta catalog, or None if no store needs it
+        """
+        self._cancel = threading.Event()
+        if not any(self.needs_neta(store) and not self.runs_incremental(store) for store in stores):
+            yield None
+            return
+
+        def load():
+            start = time.perf_counter()
+            with profiling.activate(profiler):
+                try:
+                    neta = self.load_neta()
+                    with profiling.stage('index_neta', len(neta)):
+                        self.get_catalog_index(neta)
+                except FetchCancelled:
+                    raise
+                except BaseException as e:
+                    self._cancel.set()
+                    logging.error(f'Neta catalog failed after {time.perf_counter() - start:.2f} s: {e!r}')
+                    raise
+            self.log_latency('neta', start)
+            return neta
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            yield executor.submit(load)
+
+    def wait_neta(self, neta):
+        """Neta catalog from fetch_neta. Raises FetchCancelled if it failed"""
+        if not isinstance(neta, Future):
+            return neta
+        try:
+            return neta.result()
+        except Exception as e:
+            raise FetchCancelled(f'Neta catalog failed: {e!r}') from e
+
+    def check_cancelled(self, source, neta=None):
+        """Raise FetchCancelled if another source of the run failed, with the error of 
+        Neta if neta is its failed future. Stores that are not matched against Neta do 
+        not call it: they do not depend on other sources"""
+        if self._cancel is not None and self._cancel.is_set():
+            logging.warning(f'Stopped loading {source}: another source failed')
+            if isinstance(neta, Future) and neta.done():
+                self.wait_neta(neta)
+            raise FetchCancelled(f'{source} stopped: another source failed')
+
+    def log_latency(self, source, start):
+        """Log and keep in run_params['log']['latency'] the seconds to load a source"""
+        seconds = time.perf_counter() - start
+        self.run_params['log'].setdefault('latency', {})[source] = round(seconds, 4)
+        logging.info(f'{source} loaded in {seconds:.2f} s')
+
+    @contextmanager
+    def connect_run(self):
+        """Open the backend of run_params['IO']['backend'] for the run: one pooled engine 
+        per database, shared by all stages. Checkout wait and query time per database 
+        are kept in run_params['log']['connections'] and logged as JSON at the end.
+
+        Yields:
+            class: backend of the run
+        """
+        from ..ion import ion
+        with ion.connections(self.run_params['IO'].get('backend')) as backend:
+            try:
+                yield backend
+            finally:
+                stats = backend.pool_stats()
+                self.run_params['log']['connections'] = stats
+                logging.info('CONNECTIONS ' + json.dumps(stats))
+
+    @contextmanager
+    def checkpoint_run(self):
+        """Keep the checkpoints and the manifest of a run in PATH_CHECKPOINTS/<run_id>. 
+        The manifest, with the run parameters, is written when the run ends, also if it fails.
+        """
+        from ..checkpoints import checkpoints
+        options = self.run_params['IO'].get('checkpoints', {})
+        run_id = profiling.run_id()
+        while os.path.exists(os.path.join(PATH_CHECKPOINTS, run_id)):
+            # Runs started within the same second
+            run_id = f'{run_id}_'
+        self.run_params['log']['run_id'] = run_id
+        self.checkpoint_store = checkpoints.CheckpointStore(run_id, resume_from=self.run_params['IO'].get('resume_from'),
+                                                            enabled=options.get('enabled', False))
+        if self.checkpoint_store.resume_from:
+            logging.info(f'Resuming from run {self.checkpoint_store.resume_from}')
+
+        try:
+            yield self.checkpoint_store
+        finally:
+            self.checkpoint_store.write(self.run_params, self.version)
+            self.checkpoint_store.prune(options.get('keep', 5))
+            logging.info(f'Run manifest saved in {self.checkpoint_store.run_dir}')
+
+    def checkpoint_stage(self, stage, store, compute, inputs, resumable=True):
+        """Output of a stage: from the run resumed from if it ran the stage with the 
+        same inputs, otherwise from compute(), saved as checkpoint once it succeeded
 
-            neta_aurrera['BA_display_order'] = neta_aurrera['BA_display_order'].astype(int)
+        Args:
+            stage (str): stage name
+            store (str): store name, None for stages of the whole run
+            compute (callable): function computing the output (a dataframe, or None)
+            inputs (object): JSON serializable inputs, e.g. parameters and fingerprints of previous stages
+            resumable (bool, optional): False for stages with side effects (e.g. save), always computed. 
+                Defaults to True.
+
+        Returns:
+            tuple: output and fingerprint of the stage, to chain with the next stages
+        """
+        from ..checkpoints import checkpoints
+        fp = checkpoints.fingerprint(stage, store, list(self.version), inputs)
+        if self.checkpoint_store is None:
+            return compute(), fp
+
+        resumed, df = self.checkpoint_store.resume(stage, store, fp) if resumable else (False, None)
+        if resumed:
+            logging.info(f'{stage} of {store or "run"} taken from run {self.checkpoint_store.resume_from}')
+            return df, fp
+
+        df = compute()
+        self.checkpoint_store.save(stage, store, fp, df)
+        return df, fp
+
+    def query_inputs(self, store=None):
+        """Inputs of the queries of a stage. Data in the database is not hashed, only its 
+        watermark (newest row and number of rows): a stage is not resumed once rows were 
+        added to or removed from its table. The watermark is only queried when stages are
+        saved or resumed, plain runs do not pay for it."""
+        from ..ion import ion
+        io = self.run_params['IO']
+        store_checkpoints = self.checkpoint_store is not None and (self.checkpoint_store.enabled
+                                                                   or self.checkpoint_store.resume_from)
+        watermark = ion.data_watermark(store, io.get('as_of')) if store_checkpoints else None
+        return {'store': store, 'backend': ion.get_backend().name, 'snapshot': io.get('snapshot'),
+                'as_of': io.get('as_of'), 'data': watermark}
+
+    def output_options(self):
+        """Format of local files, rds batch size, charts and history, from run_params['IO']"""
+        return {'fmt': self.run_params['IO'].get('format', 'parquet'),
+                'excel': self.run_params['IO'].get('excel_export', False),
+                'batch_size': self.run_params['IO'].get('batch_size', 10_000),
+                'charts': self.run_params['IO'].get('charts', True),
+                'chart_workers': self.run_params['IO'].get('chart_workers', 2),
+                'history': self.run_params['IO'].get('history', True),
+                'history_products': self.run_params['IO'].get('history_products', False),
+                'run_ts': self.run_params['log'].get('run_ts')}
+
+    @staticmethod
+    def setup_logging():
+        profiling.setup_logging()
+
+    def runs_incremental(self, store):
+        """Whether a store only processes the rows added since its last run: the run is 
+        incremental and the store has the watermark and the snapshot of a previous run"""
+        from ..ion import ion
+        return (self.run_params['IO'].get('incremental', False)
+                and bool(ion.load_watermark(store).get('scraping_datetime')) and ion.has_snapshot(store))
+
+    @staticmethod
+    def needs_neta(store):
+        """Only aurrera is currently matched against the Neta catalog"""
+        return store == 'aurrera'
+
+    def load_neta(self):
+        """Get the Neta catalog from RDS, with valid Gtins and NETA_ prefix
+
+        Returns:
+            dataframe: Neta catalog ready to match
+        """
+        from ..ion import ion
+        from ..preprocessing import preprocessing as prep
+        def load():
+            logging.info('Reading Neta catalog from RDS...')
+            with profiling.stage('query_neta') as record:
+                neta_raw = ion.query_neta_catalog(logging, cache=self.run_params['IO'].get('cache'))
+                record['rows_out'] = len(neta_raw)
+            self.check_cancelled('neta')
+
+            with profiling.stage('dtypes', len(neta_raw)):
+                neta_raw = self.apply_schema('neta', neta_raw)
+
+            with profiling.stage('clean_neta', len(neta_raw)) as record:
+                neta = self.prepare_neta(neta_raw, logging)
+                record['rows_out'] = len(neta)
+
+            # One row per Gtin, so matching cannot be many-to-many
+            with profiling.stage('shape_neta', len(neta)) as record:
+                neta, report = prep.collapse_catalog(neta)
+                record['rows_out'] = len(neta)
+            self.log_shape('neta', report)
+            return neta
+
+        neta, self._neta_fingerprint = self.checkpoint_stage('load_neta', None, load, self.query_inputs())
+        return neta
+
+    def run_incremental(self, store, snapshot):
+        """Re-match only the products scraped or added to Neta since the last run.
+
+        The rows of the previous result sharing a key (ean/upc or Gtin) with the new
+        rows are merged again with the new rows, replaced in the local snapshot and
+        upserted into the destination table. The display order of new products
+        continues after the products already in their category.
 
-            neta_aurrera.sort_values(['BA_category','BA_display_order'], inplace=True)
+        Args:
+            store (str): store name
+            snapshot (dataframe): final table of the last run, as returned by ion.load_snapshot
+        """
+        import pandas as pd
+        from ..ion import ion
+        from ..preprocessing import preprocessing as prep
+        spec = store_specs[store]
+        key = spec['key']
+        watermark = ion.load_watermark(store)
+
+        logging.info(f'Incremental run since {watermark}')
+        scrapeddf = ion.query_scraped_store(store, logging, since=watermark.get('scraping_datetime'))
+        if self.needs_neta(store):
+            neta_raw = ion.query_neta_catalog(logging, min_id=watermark.get('neta_id'))
+        else:
+            neta_raw = pd.DataFrame(columns=['Id', 'Gtin'])
+
+        if scrapeddf.empty and neta_raw.empty:
+            logging.info('Nothing changed since the last run.')
+            return
+
+        logging.info(f'{len(scrapeddf)} new scraped rows, {len(neta_raw)} new Neta products.')
+        scrapeddf = self.apply_schema(store, scrapeddf)
+        neta_raw = self.apply_schema('neta', neta_raw)
+        dfstore = prep.preprocess_df(store, scrapeddf, logging)
+        offsets = snapshot.groupby(spec['category'], observed=True)[spec['display_order']].max() + 1
+        new_rows = self.add_display_order(store, dfstore, offsets=offsets)
+
+        # With a snapshot, new rows replace the previous rows of the same product
+        replace_old = self.run_params['IO'].get('snapshot') is not None
+        if replace_old:
+            deduped, _ = prep.dedupe_ids(dfstore, key, newest=f"{spec['code']}_scraping_datetime",
+                                         tie_cols=(spec['category'], spec['name']))
+            newest = deduped.index
+            new_rows = new_rows[new_rows.index.isin(newest)]
+
+        neta = self.prepare_neta(neta_raw, logging)
+        if self.needs_neta(store):
+            neta, report = prep.collapse_catalog(neta)
+            self.log_shape('neta', report)
+            new_rows = self.shape_store(store, new_rows, neta)
+            keys = pd.Index(new_rows[key]).union(pd.Index(neta['NETA_Gtin'])).dropna()
+            affected = snapshot[key].isin(keys) | snapshot['NETA_Gtin'].isin(keys)
+
+            # Previous rows of the affected keys, split back into both catalogs
+            old_rows = snapshot[affected & (snapshot['is_in'] != 'neta')][spec['columns']]
+            if replace_old:
+                old_rows = old_rows[~old_rows[key].isin(new_rows[key])]
+            old_neta = snapshot.loc[affected & snapshot['NETA_Gtin'].notna()].reindex(columns=neta.columns)
+
+            # One row per Gtin, the first product as in prep.collapse_catalog
+            catalog = pd.concat([old_neta, neta]).sort_values('NETA_Id', kind='stable').drop_duplicates('NETA_Gtin')
+            catalog = prep.CatalogIndex(catalog)
+            delta = self.match_neta(store, pd.concat([old_rows, new_rows]), catalog)
+        else:
+            keys = pd.Index(new_rows[key]).dropna()
+            affected = snapshot[key].isin(keys)
+            old_rows = snapshot[affected]
+            if replace_old:
+                old_rows = old_rows[~old_rows[key].isin(new_rows[key])]
+            delta = pd.concat([old_rows, new_rows])
+
+        snapshot = pd.concat([snapshot[~affected], delta])
+        snapshot.sort_values([spec['category'], spec['display_order']], inplace=True)
+
+        logging.info(f'Upserting {len(delta)} rows for {keys.size} changed products...')
+        key_cols = [key, 'NETA_Gtin'] if self.needs_neta(store) else [key]
+        ion.upsert_table(delta, ion.remote_db_names[store], 'data', key_cols, logging)
+        ion.save_snapshot(store, snapshot)
+
+        # Only move forward, in case one of the sources had no new rows
+        new_watermark = self.get_watermark(scrapeddf, neta['NETA_Id'])
+        ion.save_watermark(store, {k: watermark.get(k) if v is None else v
+                                   for k, v in new_watermark.items()})
+
+    def run_streaming(self, store, neta):
+        """Query, preprocess, match and save the products of one store in chunks of 
+        run_params['IO']['chunk_size'] rows, so memory does not grow with the scraper 
+        history. Each chunk is loaded into a staging table, swapped with the destination 
+        table once every chunk is loaded (see ion.TableChunkWriter), and appended to the 
+        local parquet datasets of the normal run, partitioned by store and category (see 
+        ion.save_local): the final table and, for stores matched against Neta, the interim 
+        tables of products with and without a coincidence. Neta products not found in 
+        any chunk are written at the end.
+
+        The outputs that need the whole table are skipped: the coincidence table and its 
+        charts, the price gaps, the history and the Excel export. Local files are parquet 
+        whatever run_params['IO']['format'] is. Read the final dataset back to compute 
+        the rest, e.g. vis.coincidence_table on ion.read_table of it.
 
+        Args:
+            store (str): store name
+            neta (dataframe): Neta catalog, as returned by load_neta. Only needed for 
+                stores matched against Neta.
+        """
+        import pandas as pd
+        import numpy as np
+        from ..ion import ion
+        from ..preprocessing import preprocessing as prep
+        from ..history import history
+        spec = store_specs[store]
+        chunk_size = self.run_params['IO'].get('chunk_size', 100_000)
+        table_name = ion.remote_db_names[store]
+
+        if self.needs_neta(store):
+            catalog_index = self.get_catalog_index(neta)
+            matched = np.zeros(len(catalog_index.neta), dtype=bool)
+
+        writer = ion.LocalChunkWriter(f"./data/processed/{spec['local_file']}", store, spec['category'])
+        # Products with and without a coincidence, as the interim tables of ion.save_aurrera
+        interim = {}
+        if self.needs_neta(store):
+            interim = {'ambos': ion.LocalChunkWriter(f"./data/interim/{spec['code'].lower()}_products_coincidence",
+                                                     store, spec['category']),
+                       spec['code']: ion.LocalChunkWriter(f"./data/interim/{spec['code'].lower()}_products_no_coincidence",
+                                                          store, spec['category'])}
+        # Readers see the previous table until the last chunk is loaded
+        table = ion.TableChunkWriter(table_name, 'data', logging, self.output_options()['batch_size'])
+        offsets = pd.Series(dtype=np.int64)
+        high_water = profiling.rss_mb() or 0
+
+        def save_chunk(df):
+            table.write(df)
+            writer.write(df)
+            for is_in, interim_writer in interim.items():
+                interim_writer.write(df[df['is_in'] == is_in])
+
+        try:
+            chunks = ion.query_scraped_store_chunks(store, logging, chunk_size,
+                                                    snapshot=self.run_params['IO'].get('snapshot'),
+                                                    as_of=self.run_params['IO'].get('as_of'))
+            for i, chunk in enumerate(chunks):
+                chunk = self.apply_schema(store, chunk)
+                dfstore = prep.preprocess_df(store, chunk, logging)
+                display_groups = self.add_display_order(store, dfstore, offsets)
+
+                # Display order continues in the next chunk
+                last_order = display_groups.groupby(spec['category'], observed=True)[spec['display_order']].max() + 1
+                offsets = last_order.combine_first(offsets)
+
+                if self.needs_neta(store):
+                    # Repeated identifiers are only resolved inside each chunk
+                    display_groups = self.shape_store(store, display_groups, neta)
+                    display_groups = self.match_neta(store, display_groups, catalog_index, matched=matched)
+                save_chunk(display_groups)
+
+                high_water = max(high_water, profiling.rss_mb() or 0)
+                logging.info(f'Chunk {i}: {len(chunk)} rows read, {writer.rows} rows written, RSS {high_water:.0f} MB')
+
+            if self.needs_neta(store):
+                neta_only = catalog_index.neta_only(matched, spec['code'])
+                save_chunk(neta_only.assign(**{spec['display_order']: -1}))
+        except BaseException:
+            table.abort()
+            raise
+        finally:
+            for w in [writer, *interim.values()]:
+                w.close()
+        table.commit()
+
+        logging.info(f'Streamed {writer.rows} rows for {store}. Memory high-water: {high_water:.0f} MB')
+        self.run_params['log'].setdefault('memory_high_water_mb', {})[store] = high_water
+
+    def fuzzy_match(self, store, neta_store):
+        """Second matching stage: compare by name the store products and the Neta products 
+        left without a Gtin match. Store categories are only compared with the Neta categories 
+        they share exact matches with (or with every Neta product if they share none).
 
-        elif store == 'chedraui':
-            
-            logging.info(f'Matching products between Neta and Chedraui...')
-             
-            ched_display_groups = pd.DataFrame(data=None)
+        Args:
+            store (str): store name
+            neta_store (dataframe): matched products, as returned by match_neta
 
-            for name, group in dfstore.groupby('CH_input_category'):
+        Returns:
+            dataframe: store and Neta products matched by name, with their 'match_score'
+        """
+        import pandas as pd
+        from ..models import models
 
-                group['CH_display_order'] = list(range(len(group)))
-                ched_display_groups = pd.concat( [ched_display_groups, group] )
+        spec = store_specs[store]
+        options = self.run_params['data'].get('fuzzy', {})
 
-            ched_display_groups.sort_values(['CH_input_category','CH_display_order'], inplace=True)
-        
-            ched_display_groups.reset_index(inplace=True, drop=True)
+        store_only = neta_store[neta_store['is_in'] == spec['code']]
+        neta_only = neta_store[neta_store['is_in'] == 'neta']
+        both = neta_store[neta_store['is_in'] == 'ambos']
 
-            ched_display_groups = ched_display_groups[['CH_upc','CH_product_name',
-                                                       'CH_display_order','CH_input_category',
-                                                       'CH_category','CH_sub_category_1',
-                                                       'CH_sub_category_2','CH_normal_price',
-                                                       'CH_url']]
+        candidates = both.groupby(spec['category'], observed=True)['NETA_category'].unique()
+        logging.info(f'Fuzzy matching {len(store_only)} {store} products with {len(neta_only)} Neta products by name...')
 
-        else: 
-            logging.error(f'Impossible to match products for store: {store}')
+        pairs = models.fuzzy_match_names(store_only[spec['name']], neta_only['NETA_Name'],
+                                         k=options.get('k', 1), min_score=options.get('min_score', 0.8),
+                                         left_blocks=store_only[spec['category']],
+                                         right_blocks=neta_only['NETA_category'],
+                                         candidates={cat: list(v) for cat, v in candidates.items()},
+                                         logging=logging)
 
-        # IO: OUT -----------------------------------------------------
+        store_cols = [spec['key'], spec['name'], spec['category']]
+        neta_cols = ['NETA_Gtin', 'NETA_Name', 'NETA_category']
+        fuzzy_matches = pd.concat([store_only[store_cols].iloc[pairs['left']].reset_index(drop=True),
+                                   neta_only[neta_cols].iloc[pairs['right']].reset_index(drop=True)], axis=1)
+        fuzzy_matches['match_score'] = pairs['score'].to_numpy()
 
-        # Save
-        logging.info(f'Saving final tables for {store}...')
-        
-        if store == 'aurrera':
-            ion.save_aurrera(neta_aurrera, logging)
-            
-        elif store == 'chedraui':
-            ion.save_chedraui(ched_display_groups, logging)
-            
-        logging.info('Finished!')
-            
+        logging.info(f'{len(fuzzy_matches)} products matched by name.')
+        return fuzzy_matches
+
+    def apply_schema(self, source, df):
+        """Cast a raw table to the dtypes in prep.schemas and keep the memory 
+        saved in run_params['log']['dtypes']
+
+        Args:
+            source (str): 'aurrera', 'chedraui' or 'neta'
+            df (dataframe): raw table
+
+        Returns:
+            dataframe: table with the new dtypes
+        """
+        from ..preprocessing import preprocessing as prep
+        df, report = prep.apply_schema(df, source, logging)
+        self.run_params['log'].setdefault('dtypes', {})[source] = report
+        return df
 
+    @staticmethod
+    def prepare_neta(neta, logging):
+        """Keep Neta products with a valid Gtin and add the NETA_ prefix to columns
+
+        Args:
+            neta (dataframe): Neta catalog, as returned by QUERY_PRODUCTS_IN_HOMEPAGE
+            logging (class): logger
+
+        Returns:
+            dataframe: Neta catalog ready to match
+        """
+        from ..preprocessing import preprocessing as prep
+        neta = prep.filter_valid_ids(neta, 'Gtin', logging)
+        neta_cols = [ "NETA_"+c for c in neta.columns.to_list()]
+        neta.columns = neta_cols
+        return neta
 
+    def shape_store(self, store, dfstore, neta):
+        """Keep one row per identifier of a store matched against Neta: the newest 
+        scraped, then the first by category and name. The rows a many-to-many match 
+        would have produced, against the Neta rows each Gtin collapsed, are reported 
+        in run_params['log']['shape'][store].
+
+        Args:
+            store (str): store name
+            dfstore (dataframe): preprocessed store products
+            neta (dataframe): Neta catalog collapsed by prep.collapse_catalog
+
+        Returns:
+            dataframe: store products with unique identifiers
+        """
+        from ..preprocessing import preprocessing as prep
+        spec = store_specs[store]
+        n_rows = neta['NETA_n_rows'] if 'NETA_n_rows' in neta.columns else None
+        join_rows_before, _ = prep.join_fanout(dfstore[spec['key']], neta['NETA_Gtin'], n_rows)
+
+        deduped, report = prep.dedupe_ids(dfstore, spec['key'], newest=f"{spec['code']}_scraping_datetime",
+                                          tie_cols=(spec['category'], spec['name']))
+
+        join_rows, matched_keys = prep.join_fanout(deduped[spec['key']], neta['NETA_Gtin'])
+        report.update(matched_keys=matched_keys, join_rows_before=join_rows_before, join_rows=join_rows,
+                      fanout_prevented=join_rows_before - join_rows)
+        self.log_shape(store, report)
+        return deduped
+
+    def log_shape(self, source, report):
+        """Log and keep in run_params['log']['shape'] the report of a shaping stage"""
+        self.run_params['log'].setdefault('shape', {})[source] = report
+        logging.info(f'Shaped {source}: ' + json.dumps(report))
+
+    @staticmethod
+    def add_display_order(store, dfstore, offsets=None):
+        """Add display order, grouped by category, and reorder columns.
+
+        NOTE: This is different to the display_order in benchmark_aurrera, since that 
+        display_order is not refreshed each time the category changes.
+
+        Args:
+            store (str): store name
+            dfstore (dataframe): preprocessed scraped data
+            offsets (series, optional): first display order per category. Defaults to 0.
+
+        Returns:
+            dataframe: products sorted by category and display order
+        """
+        from ..preprocessing import preprocessing as prep
+        spec = store_specs[store]
+
+        display_groups = prep.add_display_order(dfstore, spec['category'], spec['display_order'], offsets)
+
+        # Reorder columns
+        return display_groups[spec['columns']]
+
+    def get_catalog_index(self, neta):
+        """Index over the Gtins of the Neta catalog. It is built once and reused 
+        by every store matched in this process.
+
+        Args:
+            neta (dataframe): Neta catalog with NETA_ prefix
+
+        Returns:
+            CatalogIndex: index to match stores against
+        """
+        from ..preprocessing import preprocessing as prep
+        if self._catalog_source is not neta:
+            self.catalog_index = prep.CatalogIndex(neta)
+            self._catalog_source = neta
+        return self.catalog_index
+
+    @staticmethod
+    def match_neta(store, display_groups, catalog_index, matched=None):
+        """Outer match of the store products with the Neta catalog, labeling
+        where each product is found ('neta', 'ambos' or the store code, e.g. 'BA')
+
+        Args:
+            store (str): store name
+            display_groups (dataframe): store products with display order
+            catalog_index (CatalogIndex): index over the Neta catalog with NETA_ prefix
+            matched (array, optional): when matching in chunks, catalog rows already 
+                found. It is updated and Neta only products are not added. Defaults to None.
+
+        Returns:
+            dataframe: matched products
+        """
+        spec = store_specs[store]
+
+        neta_store = catalog_index.match(display_groups, spec['key'], spec['code'],
+                                         outer=matched is None, matched=matched)
+
+        # Fill Nan
+        neta_store[spec['display_order']] = neta_store[spec['display_order']].fillna(-1).astype(int)
+
+        neta_store.sort_values([spec['category'], spec['display_order']], inplace=True)
+
+        return neta_store
+
+    @staticmethod
+    def get_watermark(scrapeddf, neta_ids):
+        """Latest scraping datetime and Neta product Id seen in a run
+
+        Args:
+            scrapeddf (dataframe): raw scraped data
+            neta_ids (series): Ids of the Neta catalog, None if not queried
+
+        Returns:
+            dict: watermark with 'scraping_datetime' and 'neta_id' (None if unknown)
+        """
+        watermark = {'scraping_datetime': None, 'neta_id': None}
+        if 'scraping_datetime' in scrapeddf and scrapeddf['scraping_datetime'].notna().any():
+            watermark['scraping_datetime'] = str(scrapeddf['scraping_datetime'].max())
+        if neta_ids is not None and neta_ids.notna().any():
+            watermark['neta_id'] = int(neta_ids.max())
+        return watermark
+
+
+# Columns and keys of the final tables, per store
+store_specs = {
+    'aurrera': {
+        'code': 'BA',
+        'key': 'BA_ean',
+        'name': 'BA_product_name',
+        'local_file': 'aurrera_neta_products',
+        'category': 'BA_category',
+        'display_order': 'BA_display_order',
+        'columns': ['BA_ean', 'BA_product_name', 
+                    'BA_display_order', 'BA_category', 
+                    'BA_subcategory', 'BA_normal_price', 
+                    'BA_current_price', 'BA_url'],
+    },
+    'chedraui': {
+        'code': 'CH',
+        'key': 'CH_upc',
+        'name': 'CH_product_name',
+        'local_file': 'chedraui_products',
+        'category': 'CH_input_category',
+        'display_order': 'CH_display_order',
+        'columns': ['CH_upc','CH_product_name',
+                    'CH_display_order','CH_input_category',
+                    'CH_category','CH_sub_category_1',
+                    'CH_sub_category_2','CH_normal_price',
+                    'CH_url'],
+    },
+}
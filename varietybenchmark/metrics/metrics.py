@@ -1,9 +1,141 @@
 import pandas as pd
 import numpy as np
-import warnings
 
 # Refer to read.me info
-def mape(y_true, y_pred, remove_zero_targets = True):
+# Every metric is computed from per group sums accumulated over chunks of rows, so the
+# whole evaluation (all metrics, all groups) is one pass over the data with bounded
+# memory. Inputs are only read: they are never copied as a whole nor modified.
+
+# Rows per chunk of the accumulation
+CHUNK_SIZE = 1 << 20
+
+# Sums accumulated per group
+_sums = ['n', 'abs_err', 'sq_err', 'abs_true', 'n_ape', 'ape', 'sape']
+
+# Metric computed from the sums, in percent for mape, smape and wape
+_metrics = {
+    'mape': lambda s: s['ape'] / s['n_ape'] * 100,
+    'smape': lambda s: s['sape'] / s['n'] * 100,
+    'mae': lambda s: s['abs_err'] / s['n'],
+    'rmse': lambda s: np.sqrt(s['sq_err'] / s['n']),
+    'wape': lambda s: s['abs_err'] / s['abs_true'] * 100,
+}
+
+
+def _group_codes(groups, n_rows):
+    """Integer code of each row (-1 for missing groups) and label of each code
+
+    Args:
+        groups (array-like): Group id of each row, e.g. categories or stores
+        n_rows (int): Number of rows of the targets
+
+    Returns:
+        Tuple(np.array, np.array, np.array): Codes, label of each code and whether each
+            code appears in groups
+    """
+    if len(groups) != n_rows:
+        raise ValueError(f'groups has {len(groups)} rows, targets have {n_rows}.')
+    values = groups.values if isinstance(groups, pd.Series) else groups
+    if isinstance(values, np.ndarray) and values.dtype.kind in 'iu' and (len(values) == 0 or values.min() >= 0):
+        if len(values) == 0 or values.max() < 2 * len(values) + 1024:
+            # Already codes: no need to hash them
+            present = np.bincount(values) > 0
+            return values, np.arange(len(present)), present
+        # Sparse ids (e.g. eans): one sum per id up to the largest would not fit in memory
+        labels, codes = np.unique(values, return_inverse=True)
+        return codes, labels, np.ones(len(labels), dtype=bool)
+    codes, labels = pd.factorize(values, sort=True)
+    return codes, np.asarray(labels), np.ones(len(labels), dtype=bool)
+
+def _accumulate(y_true, y_pred, mask=None, codes=None, n_groups=1, remove_zero_targets=True):
+    """Sums of errors per group, in chunks of CHUNK_SIZE rows. Rows with a missing
+    target or prediction, a False mask or a missing group are left out.
+
+    Returns:
+        Dict: Array of n_groups values per sum
+    """
+    y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+    if y_true.shape != y_pred.shape:
+        raise ValueError(f'y_true has shape {y_true.shape}, y_pred has shape {y_pred.shape}.')
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+
+    sums = {name: np.zeros(n_groups) for name in _sums}
+    for start in range(0, len(y_true), CHUNK_SIZE):
+        chunk = slice(start, start + CHUNK_SIZE)
+        t = y_true[chunk].astype(np.float64, copy=False)
+        p = y_pred[chunk].astype(np.float64, copy=False)
+
+        valid = np.isfinite(t) & np.isfinite(p)
+        if mask is not None:
+            valid &= mask[chunk]
+        c = codes[chunk] if codes is not None else np.zeros(len(t), dtype=np.intp)
+        if codes is not None:
+            valid &= c >= 0
+        if not valid.all():
+            t, p, c = t[valid], p[valid], c[valid]
+
+        abs_err = np.abs(t - p)
+        abs_true = np.abs(t)
+        zero = abs_true == 0
+        if remove_zero_targets:
+            # Zero targets do not count in mape
+            ape = np.divide(abs_err, abs_true, out=np.zeros_like(abs_err), where=~zero)
+            ape_rows = ~zero
+        else:
+            # Zero targets and their predictions are shifted by 1: the error is divided by 1
+            ape = abs_err / np.where(zero, 1.0, abs_true)
+            ape_rows = np.ones(len(t), dtype=bool)
+        denominator = abs_true + np.abs(p)
+        # A perfect prediction of 0 has no error
+        sape = np.divide(2 * abs_err, denominator, out=np.zeros_like(abs_err), where=denominator != 0)
+
+        for name, weights in [('n', None), ('abs_err', abs_err), ('sq_err', abs_err ** 2), ('abs_true', abs_true),
+                              ('n_ape', ape_rows), ('ape', ape), ('sape', sape)]:
+            sums[name] += np.bincount(c, weights=weights, minlength=n_groups)
+    return sums
+
+def evaluate(y_true, y_pred, groups=None, mask=None, metrics=None, remove_zero_targets=True):
+    """Computes several metrics at once, optionally per group, in a single pass.
+
+    Args:
+        y_true (np.array): Target
+        y_pred (np.array): Predictions
+        groups (np.array, optional): Group id of each row (e.g. category or store). Non negative
+            integers are used as they are. Defaults to None (no groups).
+        mask (np.array, optional): Boolean, rows to evaluate. Defaults to None (all).
+        metrics (list, optional): Names among 'mape', 'smape', 'mae', 'rmse' and 'wape'. Defaults to None (all).
+        remove_zero_targets (bool, optional): If True, 0 targets do not count in mape. If False, they are
+            mapped to 1 (and their predictions shifted by 1). Defaults to True.
+
+    Returns:
+        Dict or pd.DataFrame: Value per metric, or one row per group with 'n' and a column per metric.
+            Metrics without rows to evaluate are nan.
+    """
+    metrics = list(_metrics) if metrics is None else list(metrics)
+    unknown = set(metrics) - set(_metrics)
+    if unknown:
+        raise ValueError(f'Unknown metrics: {sorted(unknown)}. Use {list(_metrics)}.')
+
+    if groups is None:
+        sums = _accumulate(y_true, y_pred, mask, remove_zero_targets=remove_zero_targets)
+    else:
+        codes, labels, present = _group_codes(groups, len(y_true))
+        sums = _accumulate(y_true, y_pred, mask, codes, len(labels), remove_zero_targets)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = {name: _metrics[name](sums) for name in metrics}
+
+    if groups is None:
+        return {name: float(value[0]) for name, value in values.items()}
+    table = pd.DataFrame({'n': sums['n'].astype(np.int64), **values}, index=pd.Index(labels, name='group'))
+    return table[present]
+
+def _metric(name, y_true, y_pred, groups, mask, remove_zero_targets=True):
+    result = evaluate(y_true, y_pred, groups, mask, [name], remove_zero_targets)
+    return result[name] if groups is None else result[name].rename(name)
+
+def mape(y_true, y_pred, remove_zero_targets = True, mask=None, groups=None):
     """Computes mean absolute percent error.
 
     Args:
@@ -11,23 +143,66 @@ def mape(y_true, y_pred, remove_zero_targets = True):
         y_pred (np.array): Predictions
         remove_zero_targets (bool, optional): If True, does not count 0s as part of the benchmark. If false, maps
         0s to 1 to avoid divide by inifinity error Defaults to True.
-        name (Str): Name of metric that will be displayed on 
+        mask (np.array, optional): Boolean, rows to evaluate. Defaults to None (all).
+        groups (np.array, optional): Group id of each row. Defaults to None.
 
     Returns:
-        Float: Mean absolute percent error
+        Float or pd.Series: Mean absolute percent error, per group if groups is given
     """
-    # remove_zeros
-    if remove_zero_targets:
-        if len(y_true) > 1:
-            nonZeroIndices = np.array([ind for ind, val in enumerate(y_true == 0) if val == 0])
-        else:
-            return (np.abs(y_true - y_pred)/y_true)[0]
-    else:
-        for i in range(len(y_true)):
-            if y_true[i] == 0:
-                y_true[i] += 1
-                y_pred[i] += 1
+    return _metric('mape', y_true, y_pred, groups, mask, remove_zero_targets)
+
+def smape(y_true, y_pred, mask=None, groups=None):
+    """Computes symmetric mean absolute percent error, 2|y_pred - y_true| / (|y_true| + |y_pred|).
+
+    Args:
+        y_true (np.array): Target
+        y_pred (np.array): Predictions
+        mask (np.array, optional): Boolean, rows to evaluate. Defaults to None (all).
+        groups (np.array, optional): Group id of each row. Defaults to None.
+
+    Returns:
+        Float or pd.Series: Symmetric mean absolute percent error, per group if groups is given
+    """
+    return _metric('smape', y_true, y_pred, groups, mask)
+
+def mae(y_true, y_pred, mask=None, groups=None):
+    """Computes mean absolute error.
+
+    Args:
+        y_true (np.array): Target
+        y_pred (np.array): Predictions
+        mask (np.array, optional): Boolean, rows to evaluate. Defaults to None (all).
+        groups (np.array, optional): Group id of each row. Defaults to None.
 
-    return np.mean(np.abs((y_true[nonZeroIndices] - y_pred[nonZeroIndices]) / y_true[nonZeroIndices])) * 100
+    Returns:
+        Float or pd.Series: Mean absolute error, per group if groups is given
+    """
+    return _metric('mae', y_true, y_pred, groups, mask)
+
+def rmse(y_true, y_pred, mask=None, groups=None):
+    """Computes root mean squared error.
+
+    Args:
+        y_true (np.array): Target
+        y_pred (np.array): Predictions
+        mask (np.array, optional): Boolean, rows to evaluate. Defaults to None (all).
+        groups (np.array, optional): Group id of each row. Defaults to None.
+
+    Returns:
+        Float or pd.Series: Root mean squared error, per group if groups is given
+    """
+    return _metric('rmse', y_true, y_pred, groups, mask)
 
+def wape(y_true, y_pred, mask=None, groups=None):
+    """Computes weighted absolute percent error, sum |y_pred - y_true| / sum |y_true|.
+
+    Args:
+        y_true (np.array): Target
+        y_pred (np.array): Predictions
+        mask (np.array, optional): Boolean, rows to evaluate. Defaults to None (all).
+        groups (np.array, optional): Group id of each row. Defaults to None.
 
+    Returns:
+        Float or pd.Series: Weighted absolute percent error, per group if groups is given
+    """
+    return _metric('wape', y_true, y_pred, groups, mask)
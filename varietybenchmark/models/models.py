@@ -1,7 +1,7 @@
 import numpy as np
 from sklearn.base import BaseEstimator, ClassifierMixin
 from sklearn.utils.validation import check_X_y, check_array, check_is_fitted
-from sklearn.utils.multiclass import unique_labels
+from sklearn.utils.multiclass import unique_labels, check_classification_targets
 from sklearn.metrics import euclidean_distances
 
 
@@ -35,4 +35,222 @@ class TemplateClassifier(BaseEstimator, ClassifierMixin):
         X = check_array(X)
 
         closest = np.argmin(euclidean_distances(X, self.X_), axis=1)
-        return self.y_[closest]
\ No newline at end of file
+        return self.y_[closest]
+
+class NearestNeighborClassifier(ClassifierMixin, BaseEstimator):
+    """Nearest neighbour classifier for large inputs, e.g. product embeddings. Training
+    data is kept as a contiguous float32 array. Queries are answered in chunks run in
+    n_jobs threads, either by brute force (one matrix product per chunk) or with a
+    KD/Ball tree. Chunks are split so that all threads together hold at most
+    max_chunk_elements distances instead of n_query x n_train.
+
+    Args:
+        n_neighbors (int, optional): neighbours voting for the class. Defaults to 1.
+        algorithm (str, optional): 'brute', 'kd_tree', 'ball_tree' or 'auto' (kd_tree up to
+            15 features, brute otherwise). Defaults to 'auto'.
+        leaf_size (int, optional): leaf size of the trees. Defaults to 40.
+        max_chunk_elements (int, optional): distances computed at once by all threads in
+            brute force, or neighbours returned at once with trees. Defaults to 20_000_000.
+        n_jobs (int, optional): threads answering chunks, -1 for one per core. Defaults to None (1).
+    """
+
+    def __init__(self, n_neighbors=1, algorithm='auto', leaf_size=40, max_chunk_elements=20_000_000, n_jobs=None):
+        self.n_neighbors = n_neighbors
+        self.algorithm = algorithm
+        self.leaf_size = leaf_size
+        self.max_chunk_elements = max_chunk_elements
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y):
+
+        X, y = check_X_y(X, y, dtype=np.float32)
+        check_classification_targets(y)
+        if self.algorithm not in ('auto', 'brute', 'kd_tree', 'ball_tree'):
+            raise ValueError(f"Invalid algorithm: {self.algorithm}. Use 'auto', 'brute', 'kd_tree' or 'ball_tree'.")
+
+        # Classes are stored as codes: votes are counted on integers
+        self.classes_, self._y_codes = np.unique(y, return_inverse=True)
+        self.X_ = np.ascontiguousarray(X, dtype=np.float32)
+        self.n_features_in_ = X.shape[1]
+
+        self.algorithm_ = self.algorithm
+        if self.algorithm == 'auto':
+            self.algorithm_ = 'kd_tree' if X.shape[1] <= 15 else 'brute'
+
+        if self.algorithm_ == 'brute':
+            self._tree = None
+            # Distances are computed on centered data: with features far from 0 (e.g. an
+            # offset of 1e4) the float32 expansion below would cancel out small distances
+            self._mean = self.X_.mean(axis=0, dtype=np.float64)
+            self._X_centered = (self.X_ - self._mean).astype(np.float32)
+            self._sq_norms = np.einsum('ij,ij->i', self._X_centered, self._X_centered)
+        else:
+            from sklearn.neighbors import KDTree, BallTree
+            tree = KDTree if self.algorithm_ == 'kd_tree' else BallTree
+            self._tree = tree(self.X_, leaf_size=self.leaf_size)
+        return self
+
+    def _chunk_kneighbors(self, X, k):
+        if self._tree is not None:
+            return self._tree.query(X, k=k)
+
+        # |x - t|^2 = |x|^2 - 2 x.t + |t|^2, in float32 with x and t centered
+        X = (X - self._mean).astype(np.float32)
+        distances = X @ self._X_centered.T
+        distances *= -2
+        distances += self._sq_norms
+        distances += np.einsum('ij,ij->i', X, X)[:, None]
+        np.maximum(distances, 0, out=distances)
+
+        if k < distances.shape[1]:
+            ind = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            ind = np.broadcast_to(np.arange(distances.shape[1]), distances.shape).copy()
+        dist = np.take_along_axis(distances, ind, axis=1)
+        order = np.argsort(dist, axis=1, kind='stable')
+        return np.sqrt(np.take_along_axis(dist, order, axis=1)), np.take_along_axis(ind, order, axis=1)
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """Nearest training rows of each row of X
+
+        Args:
+            X (array): queries
+            n_neighbors (int, optional): neighbours per query. Defaults to None (self.n_neighbors).
+            return_distance (bool, optional): also return the distances. Defaults to True.
+
+        Returns:
+            np.array or Tuple(np.array, np.array): (distances and) positions in the training
+            data, sorted by increasing distance
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from joblib import effective_n_jobs
+
+        check_is_fitted(self)
+        X = np.ascontiguousarray(check_array(X, dtype=np.float32))
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(f'X has {X.shape[1]} features, but {type(self).__name__} is expecting '
+                             f'{self.n_features_in_} features as input.')
+        k = min(n_neighbors or self.n_neighbors, len(self.X_))
+        # -1 is every core, as in scikit-learn
+        n_jobs = effective_n_jobs(self.n_jobs)
+
+        # Each thread holds one chunk: the budget is shared between them
+        budget = self.max_chunk_elements // n_jobs
+        if self._tree is None:
+            chunk = max(1, budget // len(self.X_))
+        else:
+            # A tree query only holds k results per row: split the rows between the threads
+            chunk = max(1, min(-(-len(X) // n_jobs), budget // k))
+        starts = range(0, len(X), chunk)
+        # BLAS and the trees release the GIL: threads share the training data without copies
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(lambda start: self._chunk_kneighbors(X[start:start + chunk], k), starts))
+
+        if results:
+            dist = np.concatenate([r[0] for r in results]).astype(np.float32, copy=False)
+            ind = np.concatenate([r[1] for r in results])
+        else:
+            dist, ind = np.empty((0, k), dtype=np.float32), np.empty((0, k), dtype=np.intp)
+        return (dist, ind) if return_distance else ind
+
+    def predict(self, X):
+
+        ind = self.kneighbors(X, return_distance=False)
+        codes = self._y_codes[ind]
+        if codes.shape[1] == 1:
+            return self.classes_[codes[:, 0]]
+
+        # Most common class among the neighbours, the smallest class on ties
+        from scipy.sparse import csr_matrix
+        rows = np.repeat(np.arange(len(codes)), codes.shape[1])
+        votes = csr_matrix((np.ones(codes.size, dtype=np.int32), (rows, codes.ravel())),
+                           shape=(len(codes), len(self.classes_)))
+        return self.classes_[np.asarray(votes.argmax(axis=1)).ravel()]
+
+def fuzzy_match_names(left, right, k=1, min_score=0.5, left_blocks=None, right_blocks=None,
+                      candidates=None, ngram_range=(3, 3), max_chunk_elements=20_000_000, logging=None):
+    """Match product names with character n-gram TF-IDF and a top-k cosine
+    similarity search. Names are only compared inside blocks (e.g. categories),
+    and similarities are computed in chunks of at most max_chunk_elements, so
+    there is never an all-pairs matrix in memory.
+
+    Args:
+        left (array): names to match, e.g. store products without a Gtin match
+        right (array): names to match against, e.g. Neta products without a match
+        k (int, optional): best matches kept per left name. Defaults to 1.
+        min_score (float, optional): lowest cosine similarity kept. Defaults to 0.5.
+        left_blocks (array, optional): block of each left name. Defaults to None (one block).
+        right_blocks (array, optional): block of each right name. Defaults to None (one block).
+        candidates (dict, optional): right blocks compared with each left block. Left blocks
+            missing here are compared with the right block of the same name or, if there is
+            none, are not matched. Defaults to None.
+        ngram_range (tuple, optional): sizes of character n-grams. Defaults to (3, 3).
+        max_chunk_elements (int, optional): size of the similarity chunks. Defaults to 20_000_000.
+        logging (class, optional): logger of the left blocks without candidates. Defaults to None.
+
+    Returns:
+        pd.DataFrame: 'left' and 'right' positions of each match and its 'score',
+        sorted by left position and decreasing score
+    """
+    import pandas as pd
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    left = pd.Series(left).fillna('').astype(str).to_numpy()
+    right = pd.Series(right).fillna('').astype(str).to_numpy()
+    empty = pd.DataFrame({'left': np.array([], dtype=np.int64), 'right': np.array([], dtype=np.int64),
+                          'score': np.array([], dtype=np.float32)})
+    if len(left) == 0 or len(right) == 0:
+        return empty
+
+    vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=ngram_range, strip_accents='unicode',
+                                 lowercase=True, dtype=np.float32)
+    vectorizer.fit(np.concatenate([left, right]))
+    left_tfidf = vectorizer.transform(left)
+    right_tfidf = vectorizer.transform(right)
+
+    # Positions of each block
+    if left_blocks is None or right_blocks is None:
+        left_groups = {None: np.arange(len(left))}
+        right_groups = {None: np.arange(len(right))}
+    else:
+        left_groups = pd.Series(np.arange(len(left))).groupby(pd.Series(left_blocks).to_numpy(), dropna=False).indices
+        right_groups = pd.Series(np.arange(len(right))).groupby(pd.Series(right_blocks).to_numpy(), dropna=False).indices
+    candidates = candidates or {}
+
+    matches = [empty]
+    unblocked = {}
+    for block, left_idx in left_groups.items():
+        if block in candidates:
+            right_idx = [right_groups[b] for b in candidates[block] if b in right_groups]
+            right_idx = np.concatenate(right_idx) if right_idx else np.array([], dtype=np.int64)
+        elif block in right_groups:
+            right_idx = right_groups[block]
+        else:
+            # Comparing with every right name would be an all-pairs search
+            unblocked[block] = len(left_idx)
+            continue
+        if len(right_idx) == 0:
+            continue
+
+        block_tfidf = right_tfidf[right_idx].T.tocsr()
+        kk = min(k, len(right_idx))
+        chunk = max(1, max_chunk_elements // len(right_idx))
+
+        for start in range(0, len(left_idx), chunk):
+            rows = left_idx[start:start + chunk]
+            scores = (left_tfidf[rows] @ block_tfidf).toarray()
+
+            best = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+            best_scores = np.take_along_axis(scores, best, axis=1)
+            keep = best_scores >= min_score
+
+            matches.append(pd.DataFrame({'left': np.repeat(rows, kk).reshape(-1, kk)[keep],
+                                         'right': right_idx[best[keep]],
+                                         'score': best_scores[keep]}))
+
+    if unblocked and logging is not None:
+        logging.warning(f'{sum(unblocked.values())} names in {len(unblocked)} blocks without candidates '
+                        f'were not matched: {list(unblocked)[:10]}')
+
+    matches = pd.concat(matches, ignore_index=True)
+    return matches.sort_values(['left', 'score'], ascending=[True, False], ignore_index=True)
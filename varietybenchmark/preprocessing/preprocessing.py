@@ -35,7 +35,405 @@ def complete_13(x):
         faltantes = 13 - len(sx)
         complete = "0"*faltantes + sx
         return complete
-    
+
+def normalize_ids(ids, width=13):
+    """Vectorized version of is_int + complete_13 over a whole column.
+    Identifiers are converted to digit strings and padded with '0's to the
+    left until complete `width` digits (longer identifiers are kept as they are).
+    Integral floats such as 7501234567890.0 are converted without the decimal
+    part. Signed, fractional, empty or non numeric identifiers are flagged as
+    invalid instead of being dropped.
+
+    :param ids: column of product identifiers: ean, upc, gtin, etc.
+    :type ids: series
+    :param width: number of digits to complete, defaults to 13
+    :type width: int, optional
+    :return: normalized identifiers (NaN where invalid) and a mask of valid rows
+    :rtype: tuple(series, series)
+    """
+    ids = pd.Series(ids)
+
+    if pd.api.types.is_bool_dtype(ids):
+        text = pd.Series(np.nan, index=ids.index, dtype=object)
+        valid = pd.Series(False, index=ids.index)
+    elif pd.api.types.is_integer_dtype(ids):
+        valid = ids >= 0
+        text = ids.astype(str)
+    elif pd.api.types.is_float_dtype(ids):
+        values = ids.to_numpy(dtype=float)
+        with np.errstate(invalid='ignore'):
+            integral = np.isfinite(values) & (values >= 0) & (np.floor(values) == values)
+        text = pd.Series(np.nan, index=ids.index, dtype=object)
+        text[integral] = values[integral].astype(np.int64).astype(str)
+        valid = pd.Series(integral, index=ids.index)
+    else:
+        text = ids.astype(str)
+        valid = ids.notna() & text.str.fullmatch(r'[0-9]+').fillna(False).astype(bool)
+        # Mixed columns (e.g. Excel reads): floats are rendered as '123.0'
+        dirty = ids.notna() & ~valid
+        if dirty.any():
+            text[dirty] = text[dirty].str.strip().str.replace(r'\.0+$', '', regex=True)
+            valid[dirty] = text[dirty].str.fullmatch(r'[0-9]+').fillna(False).astype(bool)
+
+    normalized = text.where(valid).str.pad(width, side='left', fillchar='0')
+
+    return normalized, valid
+
+def gs1_checksum_ok(gtins):
+    """Verify the GS1 check digit (last digit) of normalized identifiers
+    (GTIN-8, UPC-A, EAN-13 and GTIN-14 padded with '0's to the left)
+
+    :param gtins: normalized identifiers, as returned by normalize_ids
+    :type gtins: series
+    :return: mask of identifiers with a correct check digit. Invalid or
+        identifiers longer than 18 digits are False
+    :rtype: series
+    """
+    gtins = pd.Series(gtins)
+    ok = np.zeros(len(gtins), dtype=bool)
+
+    digits_only, digits = _digit_matrix(gtins, min_digits=8)
+    if digits_only.any():
+        # weights 3,1,3,1... starting from the digit to the left of the check digit
+        weights = np.where(np.arange(17) % 2 == 0, 3, 1)
+        check = (10 - (digits[:, :17] @ weights) % 10) % 10
+        ok[digits_only] = check == digits[:, 17]
+
+    return pd.Series(ok, index=gtins.index)
+
+def _digit_matrix(gtins, min_digits=1):
+    """Digits of identifiers padded to 18 digits, one row per identifier
+
+    :param gtins: normalized identifiers
+    :type gtins: series
+    :param min_digits: shortest identifier accepted, defaults to 1
+    :type min_digits: int, optional
+    :return: mask of identifiers with min_digits to 18 digits and their digits
+    :rtype: tuple(array, array)
+    """
+    gtins = pd.Series(gtins)
+    digits_only = gtins.str.fullmatch(r'[0-9]{%d,18}' % min_digits).fillna(False).to_numpy(dtype=bool)
+
+    padded = gtins[digits_only].str.pad(18, side='left', fillchar='0')
+    digits = np.frombuffer(''.join(padded).encode('ascii'), dtype=np.uint8)
+    digits = digits.reshape(-1, 18).astype(np.int64) - ord('0')
+
+    return digits_only, digits
+
+def gtin_codes(gtins):
+    """Integer keys of normalized identifiers. Identifiers that are not made of
+    1 to 18 digits get -1, so they never match.
+
+    :param gtins: normalized identifiers, as returned by normalize_ids
+    :type gtins: series
+    :return: int64 keys
+    :rtype: array
+    """
+    codes = np.full(len(gtins), -1, dtype=np.int64)
+
+    digits_only, digits = _digit_matrix(gtins)
+    if digits_only.any():
+        codes[digits_only] = digits @ (10 ** np.arange(17, -1, -1, dtype=np.int64))
+
+    return codes
+
+class CatalogIndex:
+    """Integer-keyed index over the normalized Gtins of the Neta catalog.
+    Build it once and match the products of every store against it, instead
+    of an outer pd.merge per store.
+
+    :param neta: Neta catalog with normalized Gtins
+    :type neta: dataframe
+    :param key: column with the Gtins, defaults to 'NETA_Gtin'
+    :type key: str, optional
+    """
+
+    def __init__(self, neta, key='NETA_Gtin'):
+        self.neta = neta.reset_index(drop=True)
+        self.key = key
+
+        codes = gtin_codes(self.neta[key])
+        order = np.argsort(codes, kind='stable')
+        order = order[codes[order] >= 0]
+
+        # Positions of the catalog rows sorted by key, and where each key starts
+        self._order = order
+        self._keys, self._starts, self._counts = np.unique(codes[order], return_index=True, return_counts=True)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def probe(self, keys):
+        """Find the catalog rows of each key, like an inner join: a key found in
+        n rows of the catalog is repeated n times.
+
+        :param keys: normalized identifiers of a store
+        :type keys: series
+        :return: mask of keys found, positions of the keys and positions of
+            the catalog rows
+        :rtype: tuple(array, array, array)
+        """
+        codes = gtin_codes(keys)
+        found = np.zeros(len(codes), dtype=bool)
+        pos = np.zeros(len(codes), dtype=np.int64)
+
+        if len(self._keys):
+            pos = np.minimum(np.searchsorted(self._keys, codes), len(self._keys) - 1)
+            found = (codes >= 0) & (self._keys[pos] == codes)
+
+        counts = self._counts[pos[found]]
+        left = np.repeat(np.flatnonzero(found), counts)
+        # Offset of each repeated key inside its run of catalog rows
+        offsets = np.arange(len(left)) - np.repeat(np.cumsum(counts) - counts, counts)
+        right = self._order[np.repeat(self._starts[pos[found]], counts) + offsets]
+
+        return found, left, right
+
+    def match(self, df, key, label, outer=True, matched=None):
+        """Outer match of a store against the catalog. Returns the same rows as
+        pd.merge(df, neta, how='outer') with an 'is_in' column saying if the
+        product is in 'neta', 'ambos' or the store (label).
+
+        :param df: products of a store with normalized identifiers
+        :type df: dataframe
+        :param key: column of df with the identifiers
+        :type key: str
+        :param label: store code used in is_in, e.g. 'BA'
+        :type label: str
+        :param outer: append the Neta products not found in df, defaults to True.
+            Use False with `matched` to match a store in chunks
+        :type outer: bool, optional
+        :param matched: boolean array of catalog rows already found, updated in place,
+            defaults to None
+        :type matched: array, optional
+        :return: matched products
+        :rtype: dataframe
+        """
+        found, left, right = self.probe(df[key])
+
+        # Store rows in their original order, followed by Neta only products
+        counts = np.ones(len(df), dtype=np.int64)
+        counts[found] = np.bincount(left, minlength=len(df))[found]
+        rows = np.repeat(np.arange(len(df)), counts)
+        catalog_rows = np.full(len(rows), -1, dtype=np.int64)
+        catalog_rows[np.repeat(found, counts)] = right
+
+        if matched is None:
+            matched = np.zeros(len(self.neta), dtype=bool)
+        matched[right] = True
+
+        df_matched = df.iloc[rows].reset_index(drop=True)
+        df_matched = df_matched.join(self.neta.reindex(catalog_rows).reset_index(drop=True))
+        df_matched['is_in'] = pd.Categorical.from_codes(np.where(catalog_rows >= 0, 1, 2),
+                                                        categories=['neta', 'ambos', label])
+
+        if outer:
+            df_matched = pd.concat([df_matched, self.neta_only(matched, label)], ignore_index=True)
+
+        return df_matched
+
+    def neta_only(self, matched, label):
+        """Neta products not found in any store row
+
+        :param matched: boolean array of catalog rows found
+        :type matched: array
+        :param label: store code used in is_in, e.g. 'BA'
+        :type label: str
+        :return: Neta products with is_in 'neta'
+        :rtype: dataframe
+        """
+        neta_only = self.neta[~matched].reset_index(drop=True)
+        neta_only['is_in'] = pd.Categorical.from_codes(np.zeros(len(neta_only), dtype=np.int64),
+                                                       categories=['neta', 'ambos', label])
+        return neta_only
+
+def filter_valid_ids(df, col, logging):
+    """Keep only rows with a valid identifier in `col` and normalize it to
+    13 digits. Dropped rows and wrong check digits are reported to the logger.
+
+    :param df: dataframe with an identifier column
+    :type df: dataframe
+    :param col: name of the identifier column (ean, upc, Gtin)
+    :type col: str
+    :param logging: logger
+    :type logging: class
+    :return: dataframe with valid and normalized identifiers
+    :rtype: dataframe
+    """
+    ids, valid = normalize_ids(df[col])
+
+    n_invalid = int((~valid).sum())
+    if n_invalid:
+        logging.info(f'Dropping {n_invalid} of {len(df)} rows with non numeric {col}.')
+
+    n_bad_checksum = int((~gs1_checksum_ok(ids[valid])).sum())
+    if n_bad_checksum:
+        logging.info(f'{n_bad_checksum} rows have a wrong GS1 check digit in {col}.')
+
+    return df.loc[valid].assign(**{col: ids[valid]})
+
+def collapse_catalog(neta, key='NETA_Gtin', category='NETA_category', order=('NETA_Id', 'NETA_catId'),
+                     categories='NETA_categories'):
+    """Collapse the Neta catalog to one row per Gtin. The category join of the Neta
+    query returns a product once per category, and several products may share a Gtin:
+    the row kept is the first by `order`, with all the categories of the Gtin in
+    `categories`, joined by '|' in alphabetical order (a text column, so it can be pushed
+    to rds), and the number of rows collapsed in NETA_n_rows.
+
+    :param neta: Neta catalog with normalized Gtins
+    :type neta: dataframe
+    :param key: column with the Gtins, defaults to 'NETA_Gtin'
+    :type key: str, optional
+    :param category: category column, defaults to 'NETA_category'. The first category
+        by `order` is kept in it
+    :type category: str, optional
+    :param order: columns choosing the row kept, defaults to ('NETA_Id', 'NETA_catId')
+    :type order: tuple, optional
+    :param categories: column with all the categories, defaults to 'NETA_categories'
+    :type categories: str, optional
+    :return: catalog with one row per Gtin, and a report with 'rows_in', 'rows_out'
+        and 'repeated_keys' (Gtins found in more than one row)
+    :rtype: tuple(dataframe, dict)
+    """
+    order = [c for c in order if c in neta.columns]
+    neta = neta.sort_values([key] + order, kind='stable')
+    first = ~neta[key].duplicated()
+    n_rows = neta.groupby(key, sort=False, observed=True).size()
+
+    collapsed = neta[first].reset_index(drop=True)
+    collapsed['NETA_n_rows'] = n_rows.reindex(collapsed[key]).to_numpy()
+
+    if category in neta.columns:
+        pairs = neta[[key, category]].dropna().drop_duplicates()
+        pairs = pairs.assign(**{category: pairs[category].astype(str)}).sort_values([key, category])
+        joined = pairs.groupby(key, sort=False)[category].agg('|'.join)
+        collapsed[categories] = joined.reindex(collapsed[key]).to_numpy()
+
+    report = {'rows_in': len(neta), 'rows_out': len(collapsed),
+              'repeated_keys': int((collapsed['NETA_n_rows'] > 1).sum())}
+    return collapsed, report
+
+def dedupe_ids(df, key, newest=None, tie_cols=()):
+    """Keep one row per identifier. The row kept is the newest by the `newest` column,
+    then the first by tie_cols, then the first in df, so the result does not depend on
+    the order rows come from the database when `newest` and tie_cols tell them apart.
+
+    :param df: products of a store with normalized identifiers
+    :type df: dataframe
+    :param key: column with the identifiers
+    :type key: str
+    :param newest: datetime column, newest rows are kept, defaults to None
+    :type newest: str, optional
+    :param tie_cols: columns sorted in ascending order to break ties, defaults to ()
+    :type tie_cols: tuple, optional
+    :return: products with unique identifiers, and a report with 'rows_in', 'rows_out'
+        and 'repeated_keys'
+    :rtype: tuple(dataframe, dict)
+    """
+    cols = [c for c in [newest, *tie_cols] if c is not None and c in df.columns]
+    ascending = [c != newest for c in cols]
+    position = np.arange(len(df))
+    ordered = df.assign(_position=position).sort_values([key] + cols + ['_position'],
+                                                        ascending=[True] + ascending + [True],
+                                                        kind='stable', na_position='last')
+    repeated = ordered[key].duplicated()
+    # Keep the original order of the rows kept
+    kept = np.sort(ordered.loc[~repeated, '_position'].to_numpy())
+
+    report = {'rows_in': len(df), 'rows_out': len(kept),
+              'repeated_keys': int(ordered.loc[repeated, key].nunique())}
+    return df.iloc[kept], report
+
+def join_fanout(store_keys, catalog_keys, catalog_rows=None):
+    """Rows of the inner join of two key columns, e.g. a store and the Neta catalog
+
+    :param store_keys: normalized identifiers of a store
+    :type store_keys: series
+    :param catalog_keys: normalized Gtins of the catalog
+    :type catalog_keys: series
+    :param catalog_rows: rows each catalog key stands for (NETA_n_rows of a collapsed 
+        catalog), defaults to None (1)
+    :type catalog_rows: array, optional
+    :return: joined rows and matched keys
+    :rtype: tuple(int, int)
+    """
+    store_codes, store_counts = np.unique(gtin_codes(store_keys), return_counts=True)
+    catalog_codes = gtin_codes(catalog_keys)
+    weights = np.ones(len(catalog_codes)) if catalog_rows is None else np.asarray(catalog_rows, dtype=np.float64)
+    codes, inverse = np.unique(catalog_codes, return_inverse=True)
+    catalog_counts = np.bincount(inverse, weights=weights)
+
+    _, store_pos, catalog_pos = np.intersect1d(store_codes, codes, assume_unique=True, return_indices=True)
+    valid = store_codes[store_pos] >= 0
+    rows = store_counts[store_pos][valid] * catalog_counts[catalog_pos][valid]
+    return int(rows.sum()), int(valid.sum())
+
+# Dtypes of the raw tables, applied right after they are queried (see apply_schema).
+# 'id': product identifiers as Arrow strings (object strings without pyarrow)
+schemas = {
+    'aurrera': {'ean': 'id', 'category': 'category', 'subcategory': 'category',
+                'normal_price': 'float32', 'current_price': 'float32'},
+    'chedraui': {'upc': 'id', 'input_category': 'category', 'category': 'category',
+                 'sub_category_1': 'category', 'sub_category_2': 'category',
+                 'normal_price': 'float32'},
+    'neta': {'Gtin': 'id', 'Price': 'float32', 'category': 'category'},
+}
+
+def _id_dtype():
+    try:
+        import pyarrow
+    except ImportError:
+        return object
+    return 'string[pyarrow]'
+
+def apply_schema(df, source, logging):
+    """Cast the columns of a raw table to the dtypes in schemas[source]: categoricals 
+    for categories, Arrow strings for identifiers and float32 for prices. Numeric 
+    identifiers are left as they are (normalize_ids handles them).
+
+    :param df: raw table
+    :type df: dataframe
+    :param source: 'aurrera', 'chedraui' or 'neta'
+    :type source: str
+    :param logging: logger
+    :type logging: class
+    :return: table with the new dtypes and its memory in MB, before and after
+    :rtype: tuple(dataframe, dict)
+    """
+    before = df.memory_usage(deep=True).sum() / 1e6
+    df = df.copy()
+
+    for col, dtype in schemas[source].items():
+        if col not in df:
+            continue
+        if dtype == 'id':
+            if not (pd.api.types.is_numeric_dtype(df[col]) or pd.api.types.is_bool_dtype(df[col])):
+                df[col] = df[col].astype(_id_dtype())
+        elif dtype == 'float32':
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype(np.float32)
+        else:
+            df[col] = df[col].astype(dtype)
+
+    after = df.memory_usage(deep=True).sum() / 1e6
+    report = {'before_mb': round(float(before), 2), 'after_mb': round(float(after), 2),
+              'reduction': round(float(1 - after / before), 3) if before else 0.0}
+    logging.info(f'{source}: {before:.1f} MB -> {after:.1f} MB after applying dtypes.')
+    return df, report
+
+def widen_floats(df):
+    """float32 columns back to float64, keeping the shortest decimal of each value
+    (12.99 instead of 12.989999771), so outputs keep the schema of the raw tables
+
+    :param df: table
+    :type df: dataframe
+    :return: table without float32 columns (the same object if it has none)
+    :rtype: dataframe
+    """
+    cols = [c for c in df.columns if df[c].dtype == np.float32]
+    if not cols:
+        return df
+    return df.assign(**{c: df[c].to_numpy().astype(str).astype(np.float64) for c in cols})
+
 def rename_columns(store, df, logging):
     """Rename columns of raw dataframes. The changes are done depending 
     on the store
@@ -104,8 +502,7 @@ def preprocess_df(store, df, logging):
     # df = rename_columns(store, df, logging)
 
     if store == 'aurrera':
-        df = df[ df['ean'].apply( lambda x: is_int(x)) ]
-        df['ean'] = df['ean'].apply(lambda x: complete_13(x))
+        df = filter_valid_ids(df, 'ean', logging)
         # Add prefix
         ba_cols = [ "BA_"+c for c in df.columns.to_list()]
         df.columns = ba_cols
@@ -126,14 +523,39 @@ def preprocess_df(store, df, logging):
         return df
     
     if store == 'chedraui':
-        df = df[ df['upc'].apply(lambda x: is_int(x)) ]
-        df['upc'] = df['upc'].apply(lambda x: complete_13(x))
+        df = filter_valid_ids(df, 'upc', logging)
         # Add prefix
         ch_cols = [ "CH_"+c for c in df.columns.to_list()]
         df.columns = ch_cols
         
         return df 
                 
+def add_display_order(df, category, display_order, offsets=None):
+    """Number the products of each category in the order they were scraped and 
+    sort them by category and display order. Products without category are dropped.
+
+    :param df: preprocessed scraped data
+    :type df: dataframe
+    :param category: category column, e.g. 'BA_category'
+    :type category: str
+    :param display_order: name of the new column, e.g. 'BA_display_order'
+    :type display_order: str
+    :param offsets: first display order of each category, defaults to 0
+    :type offsets: series, optional
+    :return: dataframe with display order
+    :rtype: dataframe
+    """
+    df = df[df[category].notna()]
+
+    order = df.groupby(category, sort=False).cumcount()
+    if offsets is not None:
+        order += df[category].map(offsets).fillna(0).astype(np.int64)
+
+    df = df.assign(**{display_order: order})
+    df.sort_values([category, display_order], inplace=True)
+
+    return df
+
 def say_if_its_in(x):
     """Convert default values after merge to explicitly
     say if the product is in 'neta', 'ambos' or 'BA'
@@ -163,7 +585,7 @@ def match_ba_categories(matching, not_matching):
     """
     
     # matching = yes_from_aurrera
-    match_categories_BA = matching.groupby('NETA_category')['BA_category'].agg('unique')
+    match_categories_BA = matching.groupby('NETA_category', observed=True)['BA_category'].agg('unique')
 
     dict_categories_BA = dict(zip(match_categories_BA.index, [list(x) for x in match_categories_BA] ))
 
@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+from ..preprocessing import preprocessing as prep
+
+# Percentiles of the price gap in the summary table
+summary_percentiles = [10, 25, 50, 75, 90]
+
+
+def price_gaps(df, key='BA_ean', category='BA_category', normal_price='BA_normal_price',
+               current_price='BA_current_price', neta_price='NETA_Price'):
+    """Price gaps of the products found in the store and in Neta ('ambos').
+    Gaps are relative to the current (discounted) price of the store; prices 
+    that are missing or not positive give NaN gaps.
+
+    :param df: matched products, with an 'is_in' column
+    :type df: dataframe
+    :param key: identifier column of the store, defaults to 'BA_ean'
+    :type key: str, optional
+    :param category: category column of the store, defaults to 'BA_category'
+    :type category: str, optional
+    :param normal_price: regular price of the store, defaults to 'BA_normal_price'
+    :type normal_price: str, optional
+    :param current_price: current price of the store, defaults to 'BA_current_price'
+    :type current_price: str, optional
+    :param neta_price: price in Neta, defaults to 'NETA_Price'
+    :type neta_price: str, optional
+    :return: key, category, the three prices, 'gap' (Neta - store), 'gap_pct', 
+        'store_discount_pct' (current vs normal price) and 'neta_cheaper'
+    :rtype: dataframe
+    """
+    both = df[df['is_in'] == 'ambos']
+    # float32 prices (see prep.apply_schema) back to their decimal values
+    prices = prep.widen_floats(both[[normal_price, current_price, neta_price]])
+    normal = prices[normal_price].to_numpy(dtype=np.float64)
+    current = prices[current_price].to_numpy(dtype=np.float64)
+    neta = prices[neta_price].to_numpy(dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        valid = (current > 0) & (neta > 0)
+        gap = np.where(valid, neta - current, np.nan)
+        gap_pct = gap * 100 / current
+        discount_pct = np.where(normal > 0, (normal - current) * 100 / normal, np.nan)
+
+    gaps = both[[key, category, normal_price, current_price, neta_price]].reset_index(drop=True)
+    gaps['gap'] = gap
+    gaps['gap_pct'] = gap_pct
+    gaps['store_discount_pct'] = discount_pct
+    gaps['neta_cheaper'] = valid & (neta < current)
+    return gaps
+
+def grouped_quantiles(values, codes, n_groups, qs):
+    """Quantiles of values per group from sorted groups, interpolated linearly 
+    like np.percentile. NaN values are ignored; empty groups give NaN.
+
+    :param values: values
+    :type values: np.array
+    :param codes: group of each value, from 0 to n_groups - 1
+    :type codes: np.array
+    :param n_groups: number of groups
+    :type n_groups: int
+    :param qs: percentiles, from 0 to 100
+    :type qs: list
+    :return: quantiles, one row per group and one column per percentile
+    :rtype: np.array
+    """
+    keep = ~np.isnan(values)
+    values, codes = values[keep], codes[keep]
+    if not len(values):
+        return np.full((n_groups, len(qs)), np.nan)
+    if n_groups == 1:
+        # A partition is enough, no need to sort
+        return np.percentile(values, qs)[None, :]
+
+    counts = np.bincount(codes, minlength=n_groups)
+    small = np.int16 if n_groups <= np.iinfo(np.int16).max else np.int64
+    if n_groups * 32 <= len(values):
+        # Few large groups: gather the groups with a stable sort of the codes (a radix 
+        # sort for small integers), then sort the values of each group in place. 
+        # Sorting values is several times faster than an argsort of them
+        values = values[np.argsort(codes.astype(small), kind='stable')]
+        ends = np.cumsum(counts)
+        for start, end in zip(ends - counts, ends):
+            values[start:end].sort()
+    else:
+        # Many small groups: sort by value, then stable sort by group
+        order = np.argsort(values)
+        values = values[order[np.argsort(codes[order].astype(small), kind='stable')]]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    # Position of each quantile inside its group, then into the sorted array
+    position = np.maximum(counts[:, None] - 1, 0) * (np.asarray(qs, dtype=np.float64)[None, :] / 100)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, np.maximum(counts[:, None] - 1, 0))
+    weight = position - lower
+
+    last = len(values) - 1
+    result = (values[np.minimum(starts[:, None] + lower, last)] * (1 - weight) +
+              values[np.minimum(starts[:, None] + upper, last)] * weight)
+    result[counts == 0] = np.nan
+    return result
+
+def gap_summary(gaps, category='BA_category', store='aurrera'):
+    """Distribution of price gaps per category and for the whole store, computed 
+    with grouped NumPy reductions over the output of price_gaps
+
+    :param gaps: output of price_gaps
+    :type gaps: dataframe
+    :param category: category column, defaults to 'BA_category'
+    :type category: str, optional
+    :param store: store name, defaults to 'aurrera'
+    :type store: str, optional
+    :return: one row per category plus a row for the store ('level' 'store'), with
+        'n_products', 'n_priced', 'mean_gap_pct', the percentiles of 'gap_pct' 
+        ('p10_gap_pct', ...), 'mean_store_discount_pct' and 'share_neta_cheaper'
+    :rtype: dataframe
+    """
+    codes, labels = pd.factorize(gaps[category], sort=True)
+    # Products without category are counted in the store row only
+    n_cat = len(labels)
+    codes = np.where(codes < 0, n_cat, codes)
+
+    gap_pct = gaps['gap_pct'].to_numpy(dtype=np.float64)
+    discount = gaps['store_discount_pct'].to_numpy(dtype=np.float64)
+    cheaper = gaps['neta_cheaper'].to_numpy(dtype=np.float64)
+    priced = ~np.isnan(gap_pct)
+
+    # Sums per category (and products without category), summed again for the store row
+    n_groups = n_cat + 1
+    sums = {'n_products': np.bincount(codes, minlength=n_groups),
+            'n_priced': np.bincount(codes, weights=priced, minlength=n_groups),
+            'gap_pct': np.bincount(codes, weights=np.where(priced, gap_pct, 0), minlength=n_groups),
+            'discount': np.bincount(codes, weights=np.nan_to_num(discount), minlength=n_groups),
+            'n_discount': np.bincount(codes, weights=~np.isnan(discount), minlength=n_groups),
+            'cheaper': np.bincount(codes, weights=cheaper, minlength=n_groups)}
+
+    def reduce(sums, quantiles):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats = {
+                'n_products': sums['n_products'],
+                'n_priced': sums['n_priced'].astype(np.int64),
+                'mean_gap_pct': sums['gap_pct'] / sums['n_priced'],
+                **{f'p{q}_gap_pct': col for q, col in zip(summary_percentiles, quantiles.T)},
+                'mean_store_discount_pct': sums['discount'] / sums['n_discount'],
+                'share_neta_cheaper': sums['cheaper'] / sums['n_priced'],
+            }
+        return pd.DataFrame(stats)
+
+    per_category = reduce(sums, grouped_quantiles(gap_pct, codes, n_groups, summary_percentiles)).iloc[:n_cat]
+    per_category.insert(0, category, np.asarray(labels))
+    per_category.insert(0, 'level', 'category')
+
+    store_quantiles = grouped_quantiles(gap_pct, np.zeros(len(gaps), dtype=np.int64), 1, summary_percentiles)
+    per_store = reduce({name: values.sum(keepdims=True) for name, values in sums.items()}, store_quantiles)
+    per_store.insert(0, category, None)
+    per_store.insert(0, 'level', 'store')
+
+    summary = pd.concat([per_store, per_category], ignore_index=True)
+    summary.insert(0, 'store', store)
+    return summary
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import datetime
+import threading
+from contextlib import contextmanager, nullcontext
+
+# Profiler and store of the stages running in each thread
+_local = threading.local()
+
+
+def rss_mb():
+    """Resident memory of this process, in MB. None if psutil is not installed"""
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 1e6
+
+
+class _PeakRSS:
+    """Sample the resident memory in a background thread and keep the maximum"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.peak = rss_mb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def start(self):
+        if self.peak is not None:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self.peak is None:
+            return None
+        self._stop.set()
+        self._thread.join()
+        return max(self.peak, rss_mb())
+
+
+class RunProfiler:
+    """Collect wall time, CPU time, peak RSS and rows in/out of the stages of a run.
+    Each finished stage is logged as a JSON line.
+
+    :param logging: logger
+    :type logging: class
+    :param sample_interval: seconds between RSS samples, defaults to 0.05
+    :type sample_interval: float, optional
+    """
+
+    def __init__(self, logging, sample_interval=0.05):
+        self.logging = logging
+        self.sample_interval = sample_interval
+        self.stages = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """Profile the code inside the with block. Set record['rows_out'] inside it.
+
+        :param name: stage name
+        :type name: str
+        :param rows_in: rows going into the stage, defaults to None
+        :type rows_in: int, optional
+        :yield: record of the stage
+        :rtype: dict
+        """
+        record = {'stage': name, 'store': getattr(_local, 'store', None),
+                  'rows_in': rows_in, 'rows_out': None, 'status': 'ok'}
+        peak = _PeakRSS(self.sample_interval).start()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            record['wall_s'] = round(time.perf_counter() - wall, 4)
+            # CPU time of the whole process: it includes other threads running at the same time
+            record['cpu_s'] = round(time.process_time() - cpu, 4)
+            record['peak_rss_mb'] = peak.stop()
+            with self._lock:
+                self.stages.append(record)
+            self.logging.info('STAGE ' + json.dumps(record, default=str))
+
+    def summary(self, version=None):
+        """Stages of the run and totals per stage name
+
+        :param version: package version of the run, defaults to None
+        :type version: tuple, optional
+        :return: 'version', 'stages' and 'totals'
+        :rtype: dict
+        """
+        totals = {}
+        for record in self.stages:
+            total = totals.setdefault(record['stage'], {'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': None, 'calls': 0})
+            total['wall_s'] = round(total['wall_s'] + record['wall_s'], 4)
+            total['cpu_s'] = round(total['cpu_s'] + record['cpu_s'], 4)
+            total['calls'] += 1
+            if record['peak_rss_mb'] is not None:
+                total['peak_rss_mb'] = max(total['peak_rss_mb'] or 0, record['peak_rss_mb'])
+        return {'version': version, 'stages': list(self.stages), 'totals': totals}
+
+
+@contextmanager
+def activate(profiler, store=None):
+    """Send the stages of this thread to profiler, tagged with store"""
+    previous = getattr(_local, 'profiler', None), getattr(_local, 'store', None)
+    _local.profiler, _local.store = profiler, store
+    try:
+        yield profiler
+    finally:
+        _local.profiler, _local.store = previous
+
+
+def stage(name, rows_in=None):
+    """Profile a stage with the active profiler of this thread, if any.
+    Use it as `with stage('push_table', len(df)) as record:`
+
+    :param name: stage name
+    :type name: str
+    :param rows_in: rows going into the stage, defaults to None
+    :type rows_in: int, optional
+    :return: context manager yielding the record of the stage
+    :rtype: contextmanager
+    """
+    profiler = getattr(_local, 'profiler', None)
+    if profiler is None:
+        return nullcontext({})
+    return profiler.stage(name, rows_in)
+
+
+@contextmanager
+def profile_dump(mode, path, logging):
+    """Profile the code inside the with block with cProfile or pyinstrument and 
+    save the result in path ('<path>.prof' or '<path>.html').
+
+    :param mode: False/None (do nothing), True or 'cprofile', or 'pyinstrument'
+    :type mode: bool or str
+    :param path: destination without extension
+    :type path: str
+    :param logging: logger
+    :type logging: class
+    """
+    if not mode:
+        yield
+        return
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    if mode == 'pyinstrument':
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(f'{path}.html', 'w') as f:
+                f.write(profiler.output_html())
+            logging.info(f'Profile saved in {path}.html')
+        return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(f'{path}.prof')
+        logging.info(f'Profile saved in {path}.prof')
+
+
+def run_id():
+    """Timestamp used to name the files of a run"""
+    return datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+
+
+def setup_logging():
+    """Log to logfile.log and to stdout. Only imports the standard library, so the 
+    command line can log before pandas is imported"""
+    import sys
+    import logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            logging.FileHandler("logfile.log"),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
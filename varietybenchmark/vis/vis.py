@@ -1,34 +1,176 @@
-import matplotlib.pyplot as plt
-import seaborn as sns 
+import os
+import re
+import threading
 
+# matplotlib and seaborn are slow to import and only needed to plot: they are imported
+# by the functions that render. Charts of a run are rendered in a pool of processes
+# (see submit_charts), so the pipeline does not wait for them.
+_pool = None
+_futures = []
+# Stores of a run submit charts from several threads
+_lock = threading.Lock()
 
-def plot_ba_percentage_coincidences(df, logging):
-    
-    products_coincidence = {}
-    for cat, this_ba_cat in df.groupby('BA_category'): #.get_group('Bebidas y Jugos')
-        n_ba = len(this_ba_cat)
-        n_neta = len(this_ba_cat[this_ba_cat['is_in']=='ambos'])
-        perc = n_neta*100/n_ba
-        products_coincidence[cat] = n_neta*100/n_ba
-        
-    products_coincidence = {k: v for k, v in sorted(products_coincidence.items(), key=lambda item: item[1], reverse=True)}    
 
+def coincidence_table(df, category, subcategory=None):
+    """Number and percentage of store products also in Neta ('ambos'), per category
+    and per subcategory, from a single grouped aggregation. Neta only products
+    (without store category) are left out.
+
+    :param df: matched products, with an 'is_in' column
+    :type df: dataframe
+    :param category: category column of the store, e.g. 'BA_category'
+    :type category: str
+    :param subcategory: subcategory column of the store, e.g. 'BA_subcategory', defaults to None
+    :type subcategory: str, optional
+    :return: 'level' ('category' or 'subcategory'), category, subcategory, 'n_products',
+        'n_coincidences' and 'coincidence_pct', sorted by level and percentage
+    :rtype: dataframe
+    """
+    import pandas as pd
+
+    rows = df[df[category].notna()]
+    keys = [rows[category]] + ([rows[subcategory]] if subcategory else [])
+    counts = (rows['is_in'] == 'ambos').groupby(keys, observed=True, dropna=False).agg(['size', 'sum'])
+    counts.columns = ['n_products', 'n_coincidences']
+
+    tables = [counts.groupby(level=0, observed=True).sum().reset_index().assign(level='category')]
+    if subcategory:
+        tables.append(counts.reset_index().assign(level='subcategory'))
+
+    table = pd.concat(tables, ignore_index=True)
+    table['coincidence_pct'] = table['n_coincidences'] * 100 / table['n_products']
+    table = table[['level', category] + ([subcategory] if subcategory else []) +
+                  ['n_products', 'n_coincidences', 'coincidence_pct']]
+    return table.sort_values(['level', 'coincidence_pct'], ascending=[True, False], ignore_index=True)
 
-    keys = list(products_coincidence.keys())
-    # get values in the same order as keys, and parse percentage values
-    vals = [products_coincidence[k] for k in keys]
+def chart_specs(table, category, subcategory, store_title, store_path, category_dir):
+    """Charts of a coincidence table: one for the store, by category, and one per
+    category, by subcategory
 
+    :param table: output of coincidence_table
+    :type table: dataframe
+    :param category: category column of the store
+    :type category: str
+    :param subcategory: subcategory column of the store, None for no category charts
+    :type subcategory: str
+    :param store_title: store name in the titles, e.g. 'Bodega Aurrerá'
+    :type store_title: str
+    :param store_path: file of the store chart
+    :type store_path: str
+    :param category_dir: directory of the category charts
+    :type category_dir: str
+    :return: arguments of render_bar_chart
+    :rtype: list
+    """
+    categories = table[table['level'] == 'category']
+    specs = [(categories[category].astype(str).tolist(), categories['coincidence_pct'].tolist(),
+              f'Coincidencias con productos de Neta por categorías de {store_title}', store_path)]
+
+    if subcategory:
+        subcategories = table[table['level'] == 'subcategory']
+        for cat, rows in subcategories.groupby(category, observed=True, sort=False):
+            file_name = re.sub(r'[^\w\-]+', '_', str(cat)).strip('_') or 'categoria'
+            specs.append((rows[subcategory].astype(str).tolist(), rows['coincidence_pct'].tolist(),
+                          f'Coincidencias con productos de Neta en {cat} ({store_title})',
+                          os.path.join(category_dir, f'{file_name}.jpg')))
+    return specs
+
+def render_bar_chart(labels, values, title, path, backend=None):
+    """Bar chart of percentages of coincidences, saved in path
+
+    :param labels: bar labels
+    :type labels: list
+    :param values: percentages
+    :type values: list
+    :param title: chart title
+    :type title: str
+    :param path: destination image
+    :type path: str
+    :param backend: matplotlib backend to select first, e.g. 'Agg' in worker processes, defaults to None
+    :type backend: str, optional
+    :return: path
+    :rtype: str
+    """
+    if backend:
+        import matplotlib
+        matplotlib.use(backend)
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
     plt.figure(figsize=(8,5))
     plt.grid(alpha=0.3)
-    sns.barplot(x=keys, y=vals);
-    plt.title('Coincidencias con productos de Neta por categorías de Bodega Aurrerá')
+    sns.barplot(x=labels, y=values);
+    plt.title(title)
     plt.ylabel('% de coincidencias')
     plt.xticks(rotation=90);
     plt.tight_layout()
 
-    plt.savefig('BA_coincidencias.jpg')
-    logging.info('Figure saved in local directory.')
-    
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    plt.savefig(path)
     plt.close()
-    return
\ No newline at end of file
+    return path
+
+def submit_charts(specs, logging, workers=2):
+    """Render charts in a pool of processes with the Agg backend. Wait for them with wait_charts.
+
+    :param specs: arguments of render_bar_chart, e.g. from chart_specs
+    :type specs: list
+    :param logging: logger
+    :type logging: class
+    :param workers: processes of the pool, defaults to 2
+    :type workers: int, optional
+    """
+    global _pool
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with _lock:
+        if _pool is None:
+            # spawn: the pipeline may be running threads, which fork does not copy safely
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        _futures.extend(_pool.submit(render_bar_chart, *spec, backend='Agg') for spec in specs)
+    logging.info(f'{len(specs)} charts sent to render.')
+
+def wait_charts(logging):
+    """Wait for the charts sent by submit_charts and close the pool
+
+    :param logging: logger
+    :type logging: class
+    :return: number of charts rendered and failed
+    :rtype: tuple(int, int)
+    """
+    global _pool
+    # Charts submitted from now on go to a new pool
+    with _lock:
+        pool, futures = _pool, list(_futures)
+        _pool = None
+        _futures.clear()
+
+    rendered = failed = 0
+    for future in futures:
+        try:
+            future.result()
+            rendered += 1
+        except Exception as e:
+            failed += 1
+            logging.warning(f'Could not render chart: {e}')
+
+    if pool is not None:
+        pool.shutdown()
+    if rendered or failed:
+        logging.info(f'{rendered} charts rendered, {failed} failed.')
+    return rendered, failed
+
+def plot_ba_percentage_coincidences(df, logging):
+    """Chart of the percentage of coincidences per category of Bodega Aurrerá,
+    rendered in this process and saved as BA_coincidencias.jpg
+
+    :param df: matched products of Bodega Aurrerá
+    :type df: dataframe
+    :param logging: logger
+    :type logging: class
+    """
+    table = coincidence_table(df, 'BA_category')
+    render_bar_chart(*chart_specs(table, 'BA_category', None, 'Bodega Aurrerá', 'BA_coincidencias.jpg', None)[0])
+    logging.info('Figure saved in local directory.')
+    return